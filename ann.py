@@ -0,0 +1,124 @@
+"""Approximate nearest-neighbour search over unit-normalised embeddings.
+
+    index = IVFIndex.train(units, nlist=256)
+    for rows, scores in index.search(units, queries, k=10, nprobe=8):
+        ...
+
+IVFIndex buckets rows by their nearest of `nlist` spherical k-means
+centroids. A query scores only the rows in its `nprobe` nearest buckets, in
+full precision against the caller's matrix (IVF-flat), so nprobe trades
+recall for latency per query and nprobe = nlist is an exact scan. The index
+keeps centroids and row assignments only; the vectors stay with the caller,
+which reports changed rows through assign(). Centroids are not retrained as
+rows change, so callers retrain once the data has grown well past what the
+index was trained on.
+
+Use `python benchmark.py tune` to measure recall against latency for
+different nprobe settings before picking one.
+"""
+import numpy as np
+
+# Rows scored against the centroids at a time while assigning
+_ASSIGN_BLOCK = 8192
+
+
+def top_k_rows(scores, k):
+    """Column indices of the k highest scores in each row, best first."""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def top_k_indices(scores, k):
+    """Indices of the k highest scores, best first, without sorting the whole array."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def default_nlist(num_rows):
+    """About 4 * sqrt(n) buckets, the usual starting point for IVF."""
+    return max(1, min(num_rows, int(4 * np.sqrt(num_rows))))
+
+
+class IVFIndex:
+    """Inverted-file index over the rows of a caller-owned matrix of unit vectors.
+
+    Rows whose vector is all zeros (users without favorites) are kept out of
+    every bucket and never returned.
+    """
+
+    def __init__(self, centroids):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.trained_size = 0  # rows of the matrix it was trained on
+        self._assignment = np.empty(0, dtype=np.int32)  # row -> bucket, -1 when not indexed
+        self._buckets = {}  # bucket -> row indices, rebuilt when the bucket changes
+        self._stale = set(range(len(self.centroids)))
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, vectors, nlist=None, iterations=8, sample_per_list=64, seed=0):
+        """Spherical k-means on a sample of the non-zero rows, then every row assigned to its bucket."""
+        rng = np.random.default_rng(seed)
+        indexed = np.flatnonzero(np.any(vectors != 0, axis=1))
+        if not len(indexed):
+            index = cls(np.zeros((1, vectors.shape[1]), dtype=np.float32))
+        else:
+            nlist = min(nlist or default_nlist(len(indexed)), len(indexed))
+            sample = vectors[rng.choice(indexed, min(len(indexed), nlist * sample_per_list), replace=False)]
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+            for _ in range(iterations):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                counts = np.bincount(labels, minlength=nlist)
+                starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+                # Buckets that lost every member restart from a random sample row
+                sums = sample[rng.choice(len(sample), nlist)]
+                sums[counts > 0] = np.add.reduceat(sample[np.argsort(labels, kind="stable")], starts[counts > 0])
+                centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+            index = cls(centroids)
+        index.assign(np.arange(len(vectors)), vectors)
+        index.trained_size = len(vectors)
+        return index
+
+    def assign(self, rows, vectors):
+        """(Re)assign the given rows, whose current vectors are `vectors`, to their nearest buckets."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        if rows.max() >= len(self._assignment):
+            grown = np.full(max(rows.max() + 1, 2 * len(self._assignment)), -1, dtype=np.int32)
+            grown[:len(self._assignment)] = self._assignment
+            self._assignment = grown
+        self._stale.update(self._assignment[rows][self._assignment[rows] >= 0].tolist())
+        for start in range(0, len(rows), _ASSIGN_BLOCK):
+            block = np.asarray(vectors[start:start + _ASSIGN_BLOCK], dtype=np.float32)
+            buckets = np.argmax(block @ self.centroids.T, axis=1).astype(np.int32)
+            buckets[~np.any(block != 0, axis=1)] = -1
+            self._assignment[rows[start:start + _ASSIGN_BLOCK]] = buckets
+            self._stale.update(buckets[buckets >= 0].tolist())
+
+    def _bucket(self, bucket):
+        if bucket in self._stale:
+            self._buckets[bucket] = np.flatnonzero(self._assignment == bucket)
+            self._stale.discard(bucket)
+        return self._buckets[bucket]
+
+    def search(self, vectors, queries, k, nprobe):
+        """(rows, scores) of the k best rows of `vectors` for each query, best first, probing `nprobe` buckets."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        probes = top_k_rows(queries @ self.centroids.T, max(nprobe, 1))
+        results = []
+        for query, buckets in zip(queries, probes):
+            rows = np.concatenate([self._bucket(bucket) for bucket in buckets])
+            scores = vectors[rows] @ query
+            best = top_k_indices(scores, k)
+            results.append((rows[best], scores[best]))
+        return results
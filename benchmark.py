@@ -0,0 +1,361 @@
+"""Benchmarks for ingestion, similarity queries and the web routes.
+
+Every workload runs offline against an in-process NumpyStore with synthetic
+data, and ingestion uses a tiny random encoder instead of CLIP, so no database
+or model weights are needed. Results are written as JSON; `compare` reports
+how far a run moved from a baseline.
+
+    python benchmark.py run --output bench.json
+    python benchmark.py run --workloads similarity --users 10 1000 --output new.json
+    python benchmark.py run --workloads quantization --quantization-users 100000
+    python benchmark.py compare bench.json new.json
+
+`tune` instead measures the store configured by EMBEDDINGS_STORE: recall@k
+of similar users and image search against an exhaustive scan, and latency,
+for each index setting given (the defaults sweep nprobe for the numpy store
+and the diskann search list size for Postgres).
+
+    python benchmark.py tune --settings exact nprobe=4 nprobe=16
+    EMBEDDINGS_STORE=postgres python benchmark.py tune --settings search_list_size=50,rescore=50
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from cache import CachedStore
+from numpy_store import NumpyStore
+from quantize import QUANTIZATIONS
+from store import EMBEDDING_DIM, STORE_BACKEND, get_store, set_store
+
+WORKLOADS = ("ingest", "similarity", "routes", "quantization", "ann")
+DEFAULT_ANN_SETTINGS = {
+    "numpy": ["exact", "nprobe=1", "nprobe=2", "nprobe=4", "nprobe=8", "nprobe=16", "nprobe=32"],
+    "postgres": ["exact", *(f"search_list_size={size},rescore=50" for size in (25, 50, 100, 200))],
+}
+
+
+class RandomEncoder:
+    """Stand-in for CLIP: a fixed random projection of a 32x32 thumbnail.
+
+    Similar images still get similar embeddings, and the cost stays small so
+    the benchmark measures the pipeline rather than the model.
+    """
+
+    name = "random-32px"
+
+    def __init__(self, dim=EMBEDDING_DIM, seed=0):
+        self.projection = np.random.default_rng(seed).standard_normal((32 * 32 * 3, dim)).astype(np.float32)
+
+    def preprocess(self, image):
+        return np.asarray(image.convert("RGB").resize((32, 32)), dtype=np.float32).reshape(-1) / 255.0
+
+    def encode(self, images):
+        return np.stack(images) @ self.projection
+
+
+def make_synthetic_images(folder, count, size=256, seed=0):
+    """Write `count` random JPEGs spread over a few category folders."""
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        category = os.path.join(folder, f"category{i % 5}")
+        os.makedirs(category, exist_ok=True)
+        pixels = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(category, f"image_{i}.jpg"), quality=85)
+
+
+def make_synthetic_store(num_users, num_images=1000, favorites_per_user=3, seed=0, usernames=None, quantization="float32",
+                         ann="exact", clusters=0):
+    """A NumpyStore with random image embeddings and random favorites for every user.
+
+    With `clusters`, images are drawn around that many random centres, closer
+    to how real embeddings group than isotropic noise is.
+    """
+    rng = np.random.default_rng(seed)
+    store = NumpyStore(quantization=quantization, ann=ann)
+    embeddings = rng.standard_normal((num_images, EMBEDDING_DIM)).astype(np.float32)
+    if clusters:
+        centres = rng.standard_normal((clusters, EMBEDDING_DIM)).astype(np.float32)
+        embeddings = centres[rng.integers(0, clusters, num_images)] + 0.5 * embeddings
+    store.add_images((f"./static/images/synthetic/image_{i}.jpg", embedding) for i, embedding in enumerate(embeddings))
+    store.initialize_users(usernames or [f"user{i + 1}" for i in range(num_users)])
+    for user_id in range(1, num_users + 1):
+        for image_id in rng.choice(num_images, favorites_per_user, replace=False):
+            store.add_user_favorite(user_id, int(image_id) + 1)
+    return store
+
+
+def summarize(latencies):
+    """Latency percentiles in milliseconds."""
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+    }
+
+
+def bench_ingest(num_images, batch_size, workers):
+    import embeddings
+
+    embeddings.set_encoder(RandomEncoder())
+    set_store(NumpyStore())
+    with tempfile.TemporaryDirectory() as folder:
+        make_synthetic_images(folder, num_images)
+        start = time.perf_counter()
+        processed = embeddings.process_images_folder(folder, batch_size=batch_size, num_workers=workers, use_cache=False)
+        elapsed = time.perf_counter() - start
+    return {"images": processed, "seconds": elapsed, "images_per_sec": processed / elapsed}
+
+
+def bench_similarity(user_counts, queries, limit):
+    results = {}
+    rng = random.Random(0)
+    for num_users in user_counts:
+        store = make_synthetic_store(num_users)
+        user_ids = [rng.randint(1, num_users) for _ in range(queries)]
+        single = []
+        for user_id in user_ids:
+            start = time.perf_counter()
+            store.get_similar_users(user_id, limit)
+            single.append(time.perf_counter() - start)
+        batch = user_ids[: min(100, num_users)]
+        start = time.perf_counter()
+        store.get_similar_users_bulk(batch, limit)
+        bulk_seconds = time.perf_counter() - start
+        results[str(num_users)] = {
+            "get_similar_users": summarize(single),
+            "get_similar_users_bulk": {"users": len(batch), "ms": bulk_seconds * 1000},
+        }
+    return results
+
+
+def bench_quantization(num_users, queries, limit, num_images=20000):
+    """Memory, latency and recall@limit of each storage format against exact float32 search.
+
+    Covers similar users and image search; memory is split into what stays
+    in process memory and the full-precision rows kept in memory-mapped files.
+    """
+    rng = random.Random(0)
+    user_ids = [rng.randint(1, num_users) for _ in range(queries)]
+    vectors = np.random.default_rng(0).standard_normal((queries, EMBEDDING_DIM)).astype(np.float32)
+    targets = {
+        "similar_users": (user_ids, lambda store, user_id: [row[0] for row in store.get_similar_users(user_id, limit)]),
+        "search_images": (list(vectors), lambda store, vector: [image["id"] for image in store.search_images(vector, limit)]),
+    }
+    exact = {}
+    results = {}
+    for quantization in QUANTIZATIONS:
+        store = make_synthetic_store(num_users, num_images=num_images, quantization=quantization)
+        results[quantization] = {}
+        for target, (query_set, search) in targets.items():
+            latencies, found = [], []
+            for query in query_set:
+                start = time.perf_counter()
+                found.append(search(store, query))
+                latencies.append(time.perf_counter() - start)
+            truth = exact.setdefault(target, found)
+            recall = np.mean([len(set(got) & set(want)) / max(len(want), 1) for got, want in zip(found, truth)])
+            results[quantization][target] = {**summarize(latencies), f"recall_at_{limit}": float(recall)}
+        results[quantization].update({f"{part}_bytes": size for part, size in store.memory_usage().items()})
+    return results
+
+
+def parse_search_params(setting):
+    """'exact' or 'name=value,...' as search_params, e.g. 'nprobe=8' -> {"nprobe": 8}."""
+    if setting == "exact":
+        return {"exact": True}
+    return {name: int(value) for name, value in (part.split("=", 1) for part in setting.split(","))}
+
+
+def bench_ann(store, settings, queries, limit, seed=0):
+    """Recall@limit against an exhaustive scan and latency of each search setting, for similar users and image search.
+
+    Similar-user queries start from random users, skipping those without an
+    embedding; image queries are random unit vectors, since the store does not
+    hand out image embeddings.
+    """
+    rng = random.Random(seed)
+    users = [user_id for user_id, _, _ in store.list_users()]
+    vectors = np.random.default_rng(seed).standard_normal((queries, EMBEDDING_DIM)).astype(np.float32)
+    targets = {
+        "similar_users": (
+            rng.sample(users, min(queries, len(users))),
+            lambda user_id, params: [row[0] for row in store.get_similar_users(user_id, limit, params)],
+        ),
+        "search_images": (
+            list(vectors / np.linalg.norm(vectors, axis=1, keepdims=True)),
+            lambda vector, params: [image["id"] for image in store.search_images(vector, limit, params)],
+        ),
+    }
+    results = {}
+    for target, (query_set, search) in targets.items():
+        exact = [(query, truth) for query in query_set if (truth := search(query, {"exact": True}))]
+        if not exact:
+            continue
+        results[target] = {}
+        for setting in settings:
+            params = parse_search_params(setting)
+            search(exact[0][0], params)  # warm up; the numpy store trains its index on first use
+            latencies, recalls = [], []
+            for query, truth in exact:
+                start = time.perf_counter()
+                found = search(query, params)
+                latencies.append(time.perf_counter() - start)
+                recalls.append(len(set(found) & set(truth)) / len(truth))
+            results[target][setting] = {**summarize(latencies), f"recall_at_{limit}": float(np.mean(recalls))}
+    return results
+
+
+def bench_routes(requests_per_route, concurrency, num_users=1000):
+    from starlette.testclient import TestClient
+
+    # The read-through cache the server puts in front of its store when STORE_CACHE_SIZE is set
+    set_store(CachedStore(make_synthetic_store(num_users, num_images=200, favorites_per_user=2)))
+    import main
+
+    client = TestClient(main.app)
+    # Mutations target the users on the first page, which the index route renders
+    user_ids = main.registry.page(1, main.USERS_PAGE_SIZE)
+    image_paths = [f"synthetic/image_{i}.jpg" for i in range(200)]
+    rng = random.Random(0)
+
+    def timed(method, url, **kwargs):
+        start = time.perf_counter()
+        response = client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    def index(_):
+        return timed("GET", "/")
+
+    def add_image(_):
+        data = {"user": rng.choice(user_ids), "image_path": rng.choice(image_paths)}
+        return timed("POST", "/add_image", data=data, headers={"HX-Request": "true"})
+
+    def delete_image(_):
+        user_id = rng.choice(user_ids)
+        return timed("DELETE", f"/delete_image/{user_id}/{rng.randint(1, len(image_paths))}", headers={"HX-Request": "true"})
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for route, call in (("/", index), ("/add_image", add_image), ("/delete_image", delete_image)):
+            start = time.perf_counter()
+            latencies = list(pool.map(call, range(requests_per_route)))
+            elapsed = time.perf_counter() - start
+            results[route] = {**summarize(latencies), "requests_per_sec": requests_per_route / elapsed}
+    return results
+
+
+def run(args):
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args) | {"func": None},
+        },
+        "results": {},
+    }
+    if "ingest" in args.workloads:
+        report["results"]["ingest"] = bench_ingest(args.images, args.batch_size, args.workers)
+    if "similarity" in args.workloads:
+        report["results"]["similarity"] = bench_similarity(args.users, args.queries, args.limit)
+    if "routes" in args.workloads:
+        report["results"]["routes"] = bench_routes(args.requests, args.concurrency, args.route_users)
+    if "quantization" in args.workloads:
+        report["results"]["quantization"] = bench_quantization(
+            args.quantization_users, args.queries, args.limit, args.quantization_images
+        )
+    if "ann" in args.workloads:
+        store = make_synthetic_store(args.ann_users, num_images=args.ann_images, ann="ivf", clusters=64)
+        report["results"]["ann"] = bench_ann(store, DEFAULT_ANN_SETTINGS["numpy"], args.queries, args.limit)
+    print(json.dumps(report["results"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+def tune(args):
+    results = bench_ann(get_store(), args.settings or DEFAULT_ANN_SETTINGS[STORE_BACKEND], args.queries, args.limit)
+    for target, settings in results.items():
+        print(target)
+        for setting, result in settings.items():
+            print(f"  {setting:36s} recall@{args.limit} {result[f'recall_at_{args.limit}']:.3f}  "
+                  f"p50 {result['p50_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"backend": STORE_BACKEND, "limit": args.limit, "results": results}, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+def _flatten(tree, prefix=""):
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}{key}", value
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = dict(_flatten(json.load(f)["results"]))
+    with open(args.candidate) as f:
+        candidate = dict(_flatten(json.load(f)["results"]))
+    for metric in sorted(baseline.keys() & candidate.keys()):
+        if metric.endswith(("count", "bytes")) or not baseline[metric]:
+            continue
+        change = (candidate[metric] - baseline[metric]) / baseline[metric]
+        # Latencies regress when they grow, throughputs and recall when they shrink
+        higher_is_better = metric.endswith("per_sec") or metric.rsplit(".", 1)[-1].startswith("recall_at_")
+        worse = change < 0 if higher_is_better else change > 0
+        flag = "REGRESSION" if worse and abs(change) > args.threshold else ""
+        print(f"{metric:60s} {baseline[metric]:12.3f} -> {candidate[metric]:12.3f} {change:+8.1%} {flag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(required=True)
+
+    run_parser = commands.add_parser("run", help="run workloads and write a JSON report")
+    run_parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS))
+    run_parser.add_argument("--output", help="JSON file for the report")
+    run_parser.add_argument("--images", type=int, default=500, help="synthetic images for the ingest workload")
+    run_parser.add_argument("--batch-size", type=int, default=32)
+    run_parser.add_argument("--workers", type=int, default=None)
+    run_parser.add_argument("--users", type=int, nargs="+", default=[10, 1000, 100000], help="user counts for the similarity workload")
+    run_parser.add_argument("--queries", type=int, default=200, help="get_similar_users calls per user count")
+    run_parser.add_argument("--quantization-users", type=int, default=20000, help="users for the quantization workload")
+    run_parser.add_argument("--quantization-images", type=int, default=20000, help="images for the quantization workload")
+    run_parser.add_argument("--limit", type=int, default=3)
+    run_parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--route-users", type=int, default=1000, help="users in the store for the routes workload")
+    run_parser.add_argument("--ann-users", type=int, default=50000, help="users for the ann workload")
+    run_parser.add_argument("--ann-images", type=int, default=50000, help="images for the ann workload")
+    run_parser.set_defaults(func=run)
+
+    tune_parser = commands.add_parser("tune", help="recall vs. latency of index settings on the configured store")
+    tune_parser.add_argument("--settings", nargs="+", help="'exact' or comma-separated name=value search parameters")
+    tune_parser.add_argument("--queries", type=int, default=200, help="queries per target and setting")
+    tune_parser.add_argument("--limit", type=int, default=10, help="k of recall@k")
+    tune_parser.add_argument("--output", help="JSON file for the results")
+    tune_parser.set_defaults(func=tune)
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="relative change flagged as a regression")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
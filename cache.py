@@ -0,0 +1,181 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded thread-safe mapping that evicts the least recently used entry and counts hits and misses.
+
+    With a `ttl`, entries older than that many seconds are misses too.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expires = self._entries.get(key, (_MISSING, None))
+            if expires is not None and time.monotonic() >= expires:
+                del self._entries[key]
+                value = _MISSING
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, None if self.ttl is None else time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+
+class CachedStore:
+    """Read-through cache in front of another VectorStore.
+
+    Favorites are keyed by (user id, user version) and similarity results by
+    (user id, limit, embedding epoch). A favorite mutation bumps the version of
+    the user it touched, so only that user's favorites miss afterwards. It
+    also bumps the epoch, shared by all users: a neighbour list ranks every
+    user's embedding, so one changed embedding can enter or leave any list,
+    and telling which lists it reaches would cost the scan the cache saves.
+    Entries for old versions are never read again and age out of the LRU.
+
+    Versions live in this process, so a write made by another process (another
+    web worker, ingestion, the rebuild commands) is only seen once the entries
+    it affects expire after `ttl` seconds. That bounds how stale a read can be;
+    where several processes write, keep the ttl short or leave the cache off.
+
+    Methods that are not cached are forwarded to the wrapped store.
+    """
+
+    def __init__(self, store, maxsize=1024, ttl=5.0):
+        self.store = store
+        self.favorites = LRUCache(maxsize, ttl)
+        self.similarity = LRUCache(maxsize, ttl)
+        self._user_versions = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def _touch(self, user_id):
+        """Invalidate a user's favorites and every similarity result. Returns the user's new version."""
+        with self._lock:
+            version = self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+            self._epoch += 1
+            return version
+
+    def _touch_embeddings(self):
+        """Invalidate every similarity result, for changes that leave favorites alone."""
+        with self._lock:
+            self._epoch += 1
+
+    def stats(self):
+        return {"favorites": self.favorites.stats(), "similarity": self.similarity.stats()}
+
+    def get_user_favorites(self, user_id):
+        key = (user_id, self._user_versions.get(user_id, 0))
+        favorites = self.favorites.get(key)
+        if favorites is None:
+            favorites = self.store.get_user_favorites(user_id)
+            self.favorites.put(key, favorites)
+        # Callers get their own list so they cannot mutate the cached one
+        return list(favorites)
+
+    def get_similar_users(self, target_user_id, limit, search_params=None):
+        return self.get_similar_users_bulk([target_user_id], limit, search_params)[target_user_id]
+
+    def get_similar_users_bulk(self, user_ids, limit, search_params=None):
+        if search_params:
+            # Queries with their own index parameters, e.g. from the tuning harness, always reach the backend
+            return self.store.get_similar_users_bulk(user_ids, limit, search_params)
+        epoch = self._epoch
+        results = {}
+        misses = []
+        for user_id in user_ids:
+            cached = self.similarity.get((user_id, limit, epoch))
+            if cached is None:
+                misses.append(user_id)
+            else:
+                results[user_id] = cached
+        if misses:
+            for user_id, similar in self.store.get_similar_users_bulk(misses, limit).items():
+                self.similarity.put((user_id, limit, epoch), similar)
+                results[user_id] = similar
+        return {user_id: list(results[user_id]) for user_id in user_ids}
+
+    def get_user_cards(self, user_ids, limit):
+        epoch = self._epoch
+        results = {}
+        misses = []
+        for user_id in user_ids:
+            favorites = self.favorites.get((user_id, self._user_versions.get(user_id, 0)))
+            similar = self.similarity.get((user_id, limit, epoch))
+            if favorites is None or similar is None:
+                misses.append(user_id)
+            else:
+                results[user_id] = {"favorites": favorites, "similar": similar}
+        if misses:
+            # Everything the page is missing comes from one backend call
+            for user_id, card in self.store.get_user_cards(misses, limit).items():
+                self.favorites.put((user_id, self._user_versions.get(user_id, 0)), card["favorites"])
+                self.similarity.put((user_id, limit, epoch), card["similar"])
+                results[user_id] = card
+        return {
+            user_id: {"favorites": list(results[user_id]["favorites"]), "similar": list(results[user_id]["similar"])}
+            for user_id in user_ids
+        }
+
+    def add_user_favorite(self, user_id, image_id):
+        added = self.store.add_user_favorite(user_id, image_id)
+        if added:
+            self._touch(user_id)
+        return added
+
+    def add_user_favorite_by_url(self, user_id, url):
+        image_id, added = self.store.add_user_favorite_by_url(user_id, url)
+        if added:
+            self._touch(user_id)
+        return image_id, added
+
+    def mutate_favorites(self, user_id, add_urls=(), remove_image_ids=(), max_favorites=None):
+        result = self.store.mutate_favorites(user_id, add_urls, remove_image_ids, max_favorites)
+        if result["added"] or result["removed"]:
+            # The mutation already re-read the favorites, so the next read is a hit
+            self.favorites.put((user_id, self._touch(user_id)), list(result["favorites"]))
+        return result
+
+    def delete_user_favorite(self, user_id, image_id):
+        deleted = self.store.delete_user_favorite(user_id, image_id)
+        if deleted:
+            self._touch(user_id)
+        return deleted
+
+    def update_user_embedding(self, user_id):
+        self.store.update_user_embedding(user_id)
+        self._touch_embeddings()
+
+    def rebuild_user_embeddings(self):
+        count = self.store.rebuild_user_embeddings()
+        self._touch_embeddings()
+        return count
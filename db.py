@@ -0,0 +1,480 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+from metrics import inc, span
+
+# Database connection parameters
+DB_PARAMS = {
+    "dbname": os.environ.get("DB_NAME", "postgres"),
+    "user": os.environ.get("DB_USER", "postgres"),
+    "password": os.environ.get("DB_PASSWORD", "password"),
+    "host": os.environ.get("DB_HOST", "timescaledb"),
+    "port": int(os.environ.get("DB_PORT", 5432)),
+}
+
+# Pool sizing and how long a connection may sit idle before it is pinged on checkout
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.environ.get("DB_POOL_HEALTHCHECK_INTERVAL", 30))
+
+# diskann query-time accuracy vs. speed settings, applied to every similarity query unless it passes its own
+DISKANN_SEARCH_LIST_SIZE = int(os.environ.get("DISKANN_SEARCH_LIST_SIZE", 100))
+DISKANN_RESCORE = int(os.environ.get("DISKANN_RESCORE", 50))
+
+# Hot queries, prepared once per connection and then run with EXECUTE
+PREPARED_STATEMENTS = {
+    "similar_users": """
+        (int, int, int) AS
+        WITH target_user AS (
+            SELECT embedding
+            FROM users
+            WHERE id = $1
+        )
+        SELECT u.id, u.username, 1 - (u.embedding <=> tu.embedding) AS similarity
+        FROM users u, target_user tu
+        WHERE u.id != $2
+          AND u.embedding IS NOT NULL
+          AND tu.embedding IS NOT NULL
+        ORDER BY u.embedding <=> tu.embedding
+        LIMIT $3
+    """,
+    # Top-k neighbours for many users in one round trip, one LATERAL index scan per target
+    "similar_users_bulk": """
+        (int[], int) AS
+        SELECT t.id, n.id, n.username, n.similarity
+        FROM users t
+        CROSS JOIN LATERAL (
+            SELECT u.id, u.username, 1 - (u.embedding <=> t.embedding) AS similarity
+            FROM users u
+            WHERE u.id != t.id
+              AND u.embedding IS NOT NULL
+            ORDER BY u.embedding <=> t.embedding
+            LIMIT $2
+        ) n
+        WHERE t.id = ANY($1)
+          AND t.embedding IS NOT NULL
+        ORDER BY t.id, n.similarity DESC
+    """,
+    "user_favorites": """
+        (int) AS
+        SELECT i.id, i.url
+        FROM user_favorites uf
+        JOIN images i ON uf.image_id = i.id
+        WHERE uf.user_id = $1
+        ORDER BY i.id
+    """,
+    # Favorites and top-k neighbours of a page of users in one round trip, as json arrays per user
+    "user_cards": """
+        (int[], int) AS
+        SELECT t.id,
+               COALESCE((
+                   SELECT json_agg(json_build_object('id', i.id, 'url', i.url) ORDER BY i.id)
+                   FROM user_favorites uf
+                   JOIN images i ON uf.image_id = i.id
+                   WHERE uf.user_id = t.id
+               ), '[]'),
+               COALESCE((
+                   SELECT json_agg(json_build_array(n.id, n.username, n.similarity) ORDER BY n.similarity DESC)
+                   FROM (
+                       SELECT u.id, u.username, 1 - (u.embedding <=> t.embedding) AS similarity
+                       FROM users u
+                       WHERE u.id != t.id
+                         AND u.embedding IS NOT NULL
+                         AND t.embedding IS NOT NULL
+                       ORDER BY u.embedding <=> t.embedding
+                       LIMIT $2
+                   ) n
+               ), '[]')
+        FROM users t
+        WHERE t.id = ANY($1)
+    """,
+    "image_id_by_url": """
+        (text) AS
+        SELECT id FROM images WHERE url = $1
+    """,
+    "insert_favorite": """
+        (int, int) AS
+        INSERT INTO user_favorites (user_id, image_id) VALUES ($1, $2) ON CONFLICT DO NOTHING
+    """,
+    "delete_favorite": """
+        (int, int) AS
+        DELETE FROM user_favorites
+        WHERE user_id = $1 AND image_id = $2
+    """,
+    # Running-sum maintenance: the mean is rescaled from the stored sum and count,
+    # so adding or removing a favorite costs O(dim) no matter how many favorites exist
+    "favorite_added": """
+        (int, int) AS
+        UPDATE users u
+        SET favorite_count = u.favorite_count + 1,
+            embedding_version = u.embedding_version + 1,
+            embedding_sum = COALESCE(u.embedding_sum + i.embedding, i.embedding),
+            embedding = COALESCE(u.embedding_sum + i.embedding, i.embedding)
+                * array_fill(1.0 / (u.favorite_count + 1), ARRAY[vector_dims(i.embedding)])::vector
+        FROM images i
+        WHERE u.id = $1 AND i.id = $2
+    """,
+    "favorite_removed": """
+        (int, int) AS
+        UPDATE users u
+        SET favorite_count = u.favorite_count - 1,
+            embedding_version = u.embedding_version + 1,
+            embedding_sum = CASE WHEN u.favorite_count > 1 THEN u.embedding_sum - i.embedding END,
+            embedding = CASE WHEN u.favorite_count > 1 THEN (u.embedding_sum - i.embedding)
+                * array_fill(1.0 / (u.favorite_count - 1), ARRAY[vector_dims(i.embedding)])::vector END
+        FROM images i
+        WHERE u.id = $1 AND i.id = $2
+    """,
+    "search_images": """
+        (vector, int) AS
+        SELECT id, url, 1 - (embedding <=> $1) AS similarity
+        FROM images
+        WHERE embedding IS NOT NULL
+        ORDER BY embedding <=> $1
+        LIMIT $2
+    """,
+    "image_ids_by_url": """
+        (text[]) AS
+        SELECT id FROM images WHERE url = ANY($1)
+    """,
+    # k nearest neighbours of each given image through the diskann index, stored as one array row per image
+    "refresh_image_neighbors": """
+        (int[], int) AS
+        INSERT INTO image_neighbors (image_id, neighbor_ids, similarities)
+        SELECT t.id, array_agg(n.id ORDER BY n.distance), array_agg((1 - n.distance)::real ORDER BY n.distance)
+        FROM images t
+        CROSS JOIN LATERAL (
+            SELECT i.id, i.embedding <=> t.embedding AS distance
+            FROM images i
+            WHERE i.id != t.id
+              AND i.embedding IS NOT NULL
+            ORDER BY i.embedding <=> t.embedding
+            LIMIT $2
+        ) n
+        WHERE t.id = ANY($1)
+          AND t.embedding IS NOT NULL
+        GROUP BY t.id
+        ON CONFLICT (image_id) DO UPDATE
+        SET neighbor_ids = EXCLUDED.neighbor_ids, similarities = EXCLUDED.similarities
+    """,
+    # Lists the given images can have changed: those that mention them, and those one of them now
+    # enters because it beats their lowest kept similarity (or they hold fewer than $2 entries).
+    # Neighbour lists are not symmetric, so the changed images' own neighbours are not enough.
+    "image_neighbors_affected": """
+        (int[], int) AS
+        SELECT g.image_id
+        FROM image_neighbors g
+        JOIN images o ON o.id = g.image_id
+        WHERE g.neighbor_ids && $1
+           OR cardinality(g.neighbor_ids) < $2
+           OR EXISTS (
+               SELECT 1 FROM images c
+               WHERE c.id = ANY($1) AND c.id != g.image_id
+                 AND 1 - (c.embedding <=> o.embedding) > g.similarities[cardinality(g.similarities)]
+           )
+    """,
+    "image_neighbors": """
+        (text, int) AS
+        SELECT n.id, n.url, s.similarity
+        FROM images t
+        JOIN image_neighbors g ON g.image_id = t.id
+        CROSS JOIN LATERAL unnest(g.neighbor_ids[1:$2], g.similarities[1:$2]) WITH ORDINALITY AS s(id, similarity, rank)
+        JOIN images n ON n.id = s.id
+        WHERE t.url = $1
+        ORDER BY s.rank
+    """,
+    # Users whose stored recommendations predate their current embedding, or who have none
+    "stale_recommendations": """
+        (int) AS
+        SELECT u.id
+        FROM users u
+        LEFT JOIN user_recommendations r ON r.user_id = u.id
+        WHERE r.user_id IS NULL OR r.embedding_version < u.embedding_version
+        ORDER BY u.id
+        LIMIT $1
+    """,
+    # Top-$2 images per user: candidates are the $3 images nearest the user's embedding plus
+    # everything favorited by their $4 most similar users. Each scores its cosine similarity to
+    # the user plus $5 times the summed similarity of the neighbours who favorited it.
+    "refresh_recommendations": """
+        (int[], int, int, int, real) AS
+        WITH targets AS (
+            SELECT id, embedding, embedding_version FROM users WHERE id = ANY($1)
+        ),
+        neighbours AS (
+            SELECT t.id AS user_id, n.id AS neighbour_id, n.similarity
+            FROM targets t
+            CROSS JOIN LATERAL (
+                SELECT u.id, 1 - (u.embedding <=> t.embedding) AS similarity
+                FROM users u
+                WHERE u.id != t.id
+                  AND u.embedding IS NOT NULL
+                ORDER BY u.embedding <=> t.embedding
+                LIMIT $4
+            ) n
+            WHERE t.embedding IS NOT NULL
+        ),
+        social AS (
+            SELECT nb.user_id, uf.image_id, SUM(nb.similarity) AS score
+            FROM neighbours nb
+            JOIN user_favorites uf ON uf.user_id = nb.neighbour_id
+            GROUP BY nb.user_id, uf.image_id
+        ),
+        nearest AS (
+            SELECT t.id AS user_id, n.id AS image_id
+            FROM targets t
+            CROSS JOIN LATERAL (
+                SELECT i.id
+                FROM images i
+                WHERE i.embedding IS NOT NULL
+                ORDER BY i.embedding <=> t.embedding
+                LIMIT $3
+            ) n
+            WHERE t.embedding IS NOT NULL
+        ),
+        ranked AS (
+            SELECT c.user_id, c.image_id,
+                   1 - (i.embedding <=> t.embedding) + $5 * COALESCE(s.score, 0) AS score,
+                   row_number() OVER (
+                       PARTITION BY c.user_id
+                       ORDER BY 1 - (i.embedding <=> t.embedding) + $5 * COALESCE(s.score, 0) DESC, c.image_id
+                   ) AS rank
+            FROM (SELECT user_id, image_id FROM nearest UNION SELECT user_id, image_id FROM social) c
+            JOIN targets t ON t.id = c.user_id
+            JOIN images i ON i.id = c.image_id
+            LEFT JOIN social s ON s.user_id = c.user_id AND s.image_id = c.image_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM user_favorites uf WHERE uf.user_id = c.user_id AND uf.image_id = c.image_id
+            )
+        )
+        INSERT INTO user_recommendations (user_id, image_ids, scores, embedding_version, refreshed_at)
+        SELECT t.id,
+               COALESCE(array_agg(r.image_id ORDER BY r.rank) FILTER (WHERE r.image_id IS NOT NULL), '{}'),
+               COALESCE(array_agg(r.score::real ORDER BY r.rank) FILTER (WHERE r.image_id IS NOT NULL), '{}'),
+               t.embedding_version,
+               now()
+        FROM targets t
+        LEFT JOIN ranked r ON r.user_id = t.id AND r.rank <= $2
+        GROUP BY t.id, t.embedding_version
+        ON CONFLICT (user_id) DO UPDATE
+        SET image_ids = EXCLUDED.image_ids,
+            scores = EXCLUDED.scores,
+            embedding_version = EXCLUDED.embedding_version,
+            refreshed_at = EXCLUDED.refreshed_at
+    """,
+    "user_recommendations": """
+        (int, int) AS
+        SELECT i.id, i.url, s.score
+        FROM user_recommendations r
+        CROSS JOIN LATERAL unnest(r.image_ids[1:$2], r.scores[1:$2]) WITH ORDINALITY AS s(id, score, rank)
+        JOIN images i ON i.id = s.id
+        WHERE r.user_id = $1
+        ORDER BY s.rank
+    """,
+    "lock_user": """
+        (int) AS
+        SELECT id FROM users WHERE id = $1 FOR UPDATE
+    """,
+    # Removes, limit-checked adds, the running-sum update and the re-read in one
+    # statement. Every CTE sees the same snapshot, so the current favorites come
+    # from `existing` and the effect of the writes only through RETURNING.
+    "mutate_favorites": """
+        (int, text[], int[], int) AS
+        WITH existing AS (
+            SELECT image_id FROM user_favorites WHERE user_id = $1
+        ),
+        removed AS (
+            DELETE FROM user_favorites
+            WHERE user_id = $1 AND image_id = ANY($3)
+            RETURNING image_id
+        ),
+        candidates AS (
+            SELECT DISTINCT ON (i.id) i.id, a.ord
+            FROM unnest($2) WITH ORDINALITY AS a(url, ord)
+            JOIN images i ON i.url = a.url
+            WHERE i.id NOT IN (SELECT image_id FROM existing)
+            ORDER BY i.id, a.ord
+        ),
+        inserted AS (
+            INSERT INTO user_favorites (user_id, image_id)
+            SELECT $1, id FROM (
+                SELECT id FROM candidates
+                ORDER BY ord
+                LIMIT GREATEST(COALESCE($4 - (SELECT count(*) FROM existing) + (SELECT count(*) FROM removed), 2147483647), 0)
+            ) allowed
+            ON CONFLICT DO NOTHING
+            RETURNING image_id
+        ),
+        delta AS (
+            SELECT (SELECT count(*) FROM inserted) - (SELECT count(*) FROM removed) AS count,
+                   COALESCE((SELECT SUM(i.embedding) FROM inserted JOIN images i ON i.id = inserted.image_id),
+                            array_fill(0.0, ARRAY[512])::vector)
+                 - COALESCE((SELECT SUM(i.embedding) FROM removed JOIN images i ON i.id = removed.image_id),
+                            array_fill(0.0, ARRAY[512])::vector) AS embedding_sum
+        ),
+        updated AS (
+            UPDATE users u
+            SET favorite_count = u.favorite_count + d.count,
+                embedding_version = u.embedding_version + 1,
+                embedding_sum = CASE WHEN u.favorite_count + d.count > 0
+                    THEN COALESCE(u.embedding_sum, array_fill(0.0, ARRAY[512])::vector) + d.embedding_sum END,
+                embedding = CASE WHEN u.favorite_count + d.count > 0
+                    THEN (COALESCE(u.embedding_sum, array_fill(0.0, ARRAY[512])::vector) + d.embedding_sum)
+                        * array_fill(1.0 / (u.favorite_count + d.count), ARRAY[512])::vector END
+            FROM delta d
+            WHERE u.id = $1
+              AND (EXISTS (SELECT 1 FROM inserted) OR EXISTS (SELECT 1 FROM removed))
+        )
+        SELECT i.id, i.url, f.status
+        FROM (
+            SELECT image_id, 'kept' AS status FROM existing WHERE image_id NOT IN (SELECT image_id FROM removed)
+            UNION ALL SELECT image_id, 'added' FROM inserted
+            UNION ALL SELECT image_id, 'removed' FROM removed
+        ) f
+        JOIN images i ON i.id = f.image_id
+        ORDER BY i.id
+    """,
+    "update_user_embedding": """
+        (int) AS
+        UPDATE users u
+        SET favorite_count = agg.favorite_count,
+            embedding_version = u.embedding_version + 1,
+            embedding_sum = agg.embedding_sum,
+            embedding = agg.embedding
+        FROM (
+            SELECT COUNT(i.id) AS favorite_count, SUM(i.embedding) AS embedding_sum, AVG(i.embedding) AS embedding
+            FROM user_favorites uf
+            JOIN images i ON uf.image_id = i.id
+            WHERE uf.user_id = $1
+        ) agg
+        WHERE u.id = $1
+    """,
+}
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers its prepared statements, diskann settings and when it was last verified."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.search_params = None  # (search_list_size, rescore) the session runs with, None when unknown
+        self.last_checked = time.monotonic()
+
+
+_pool = None
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, connection_factory=PooledConnection, **DB_PARAMS
+                )
+    return _pool
+
+
+def close_pool():
+    """Close every pooled connection, e.g. before forking worker processes."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_checked < DB_POOL_HEALTHCHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+    except psycopg2.Error:
+        return False
+    conn.last_checked = time.monotonic()
+    return True
+
+
+@contextmanager
+def get_connection():
+    """Borrow a pooled connection for one transaction.
+
+    The transaction is committed when the block exits normally and rolled back
+    on error. Callers block while all DB_POOL_MAX connections are in use.
+    """
+    # Time spent waiting for a free slot, separate from checking out and verifying a connection
+    with span("db.wait"):
+        _pool_slots.acquire()
+    try:
+        with span("db.acquire"):
+            pool = get_pool()
+            conn = pool.getconn()
+            while not _is_healthy(conn):
+                inc("db_connections_replaced_total")
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        try:
+            yield conn
+            with span("db.commit"):
+                conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+                # A rollback also undoes settings changed in the transaction
+                conn.search_params = None
+            raise
+        finally:
+            conn.last_checked = time.monotonic()
+            pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _pool_slots.release()
+
+
+def execute_prepared(cur, name, params):
+    """Run one of PREPARED_STATEMENTS, preparing it on this connection the first time."""
+    conn = cur.connection
+    with span("sql", statement=name):
+        if name not in conn.prepared_statements:
+            cur.execute(f"PREPARE {name} {PREPARED_STATEMENTS[name]}")
+            conn.prepared_statements.add(name)
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
+
+def apply_search_params(cur, search_params=None):
+    """Make the diskann settings of the cursor's connection match `search_params` for the queries that follow.
+
+    Takes {"search_list_size", "rescore"}, defaulting to the configured
+    values, and only issues SET when they differ from what the session
+    already runs with. {"exact": True} instead disables index scans for the
+    rest of the transaction, so the query falls back to an exhaustive scan.
+    """
+    conn = cur.connection
+    search_params = search_params or {}
+    if search_params.get("exact"):
+        with span("sql", statement="exact_search"):
+            cur.execute("SET LOCAL enable_indexscan = off")
+        return
+    wanted = (
+        int(search_params.get("search_list_size", DISKANN_SEARCH_LIST_SIZE)),
+        int(search_params.get("rescore", DISKANN_RESCORE)),
+    )
+    if conn.search_params != wanted:
+        with span("sql", statement="search_params"):
+            cur.execute(
+                "SELECT set_config('diskann.query_search_list_size', %s, false), set_config('diskann.query_rescore', %s, false)",
+                [str(value) for value in wanted],
+            )
+        conn.search_params = wanted
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import re
+import numpy as np
+from store import EMBEDDING_DIM
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Content hash of a file, used as the cache key for its embedding."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent image embeddings keyed by file content hash, one cache per model.
+
+    Vectors are appended to a raw float32 file that is read back through
+    np.memmap; a JSON sidecar maps each content hash to its row and remembers
+    which hash was last written to the store for every url. The sidecar is
+    written after the vectors, so rows appended after the last save() are
+    simply dropped on the next open.
+
+    With `read_only`, as in ingestion worker processes next to the writing
+    parent, the cache serves the rows saved so far and leaves the files alone.
+    """
+
+    def __init__(self, directory, model_name, dim=EMBEDDING_DIM, read_only=False):
+        self.dim = dim
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+        self.vectors_path = f"{stem}.f32"
+        self.index_path = f"{stem}.json"
+
+        self._rows = {}  # content hash -> row in the vectors file
+        self._written = {}  # url -> content hash last written to the store
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self._rows = index["rows"]
+            self._written = index["written"]
+        if not read_only:
+            # Drop vectors appended after the last save, their hashes were never indexed
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(len(self._rows) * dim * 4)
+        self._vectors = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, digest):
+        return digest in self._rows
+
+    def _mapped(self):
+        if self._vectors is None or len(self._vectors) < len(self._rows):
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self._rows), self.dim))
+        return self._vectors
+
+    def get(self, digest):
+        """Cached embedding for a content hash, or None."""
+        row = self._rows.get(digest)
+        return None if row is None else np.array(self._mapped()[row])
+
+    def put_many(self, digests, embeddings):
+        """Append embeddings for content hashes that are not cached yet.
+
+        A hash repeated within the batch (identical files) is written once, so
+        every appended row keeps exactly one index entry.
+        """
+        new = {}
+        for digest, embedding in zip(digests, embeddings):
+            if digest not in self._rows and digest not in new:
+                new[digest] = embedding
+        if not new:
+            return
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.asarray(list(new.values()), dtype=np.float32).tobytes())
+        for digest in new:
+            self._rows[digest] = len(self._rows)
+
+    def is_written(self, url, digest):
+        """Whether the store already holds this content for this url."""
+        return self._written.get(url) == digest
+
+    def written_digest(self, url):
+        """Content hash last written to the store for this url, or None."""
+        return self._written.get(url)
+
+    def mark_written(self, urls, digests):
+        self._written.update(zip(urls, digests))
+
+    def save(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"rows": self._rows, "written": self._written}, f)
+        os.replace(tmp_path, self.index_path)
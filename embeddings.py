@@ -1,206 +1,413 @@
 import os
-import psycopg2
-from psycopg2.extras import execute_values
-import torch
+import argparse
+import asyncio
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from PIL import Image
-import clip
+from store import (
+    IMAGE_NEIGHBORS_K,
+    RECOMMENDATION_CANDIDATES,
+    RECOMMENDATION_NEIGHBOURS,
+    RECOMMENDATION_SOCIAL_WEIGHT,
+    RECOMMENDATIONS_N,
+    get_store,
+)
+from embedding_cache import EmbeddingCache, file_digest
+from thumbnails import generate_thumbnails
+from metrics import inc, span
+from encoders import BACKENDS, ENCODER_BACKEND, ENCODER_DRAFT_DECODE, ClipEncoder
 
-# Database connection parameters
-DB_PARAMS = {
-    "dbname": "postgres",
-    "user": "postgres",
-    "password": "password", 
-    "host": "timescaledb",
-    "port": 5432
-}
+# Embeddings by file content hash, so unchanged images are never re-encoded
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "data/embedding_cache")
 
-# Initialize CLIP model
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
+_encoder = ClipEncoder()
+
+def get_encoder():
+    """The encoder used for ingestion."""
+    return _encoder
+
+def set_encoder(encoder):
+    """Swap the ingestion encoder, e.g. for a small random one in offline benchmarks."""
+    global _encoder
+    _encoder = encoder
 
 def create_tables():
     """Create necessary tables in the database."""
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE EXTENSION IF NOT EXISTS vectorscale CASCADE;
-                
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    username TEXT UNIQUE NOT NULL,
-                    embedding VECTOR(512)
-                );
-                
-                CREATE TABLE IF NOT EXISTS images (
-                    id SERIAL PRIMARY KEY,
-                    url TEXT UNIQUE NOT NULL,
-                    embedding VECTOR(512)
-                );
-                
-                CREATE TABLE IF NOT EXISTS user_favorites (
-                    user_id INTEGER REFERENCES users(id),
-                    image_id INTEGER REFERENCES images(id),
-                    PRIMARY KEY (user_id, image_id)
-                );
-                
-                CREATE INDEX IF NOT EXISTS users_embedding_idx ON users USING diskann (embedding);
-            """)
-            # Set query parameters for accuracy vs. speed trade-off
-            cur.execute("SET diskann.query_search_list_size = 100;")
-            cur.execute("SET diskann.query_rescore = 50;")
+    get_store().create_tables()
 
 def initialize_users():
     """Initialize the database with 4 users."""
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        with conn.cursor() as cur:
-            users = [("user1",), ("user2",), ("user3",), ("user4",)]
-            execute_values(cur, "INSERT INTO users (username) VALUES %s ON CONFLICT DO NOTHING", users)
+    get_store().initialize_users(
+        ["user1", "user2", "user3", "user4"], ["John Doe", "Jane Doe", "Bob Smith", "Sarah Lee"]
+    )
+
+def list_users():
+    """Every user as an (id, username, display_name) tuple ordered by id."""
+    return get_store().list_users()
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
 
 def get_image_embedding(image_path):
     """Create an embedding for an image using CLIP."""
-    image = preprocess(Image.open(image_path)).unsqueeze(0).to(device)
-    with torch.no_grad():
-        image_features = model.encode_image(image)
-    return image_features.cpu().numpy().flatten()
+    return get_image_embeddings([load_image_tensor(image_path)])[0]
+
+def load_image_tensor(image_path):
+    """Decode an image and run the CLIP preprocessing transform on it."""
+    with span("model.preprocess"), Image.open(image_path) as image:
+        return get_encoder().preprocess(image)
+
+def get_image_embeddings(image_tensors):
+    """Create embeddings for a batch of preprocessed images in a single forward pass."""
+    with span("model.encode"):
+        embeddings = get_encoder().encode(image_tensors)
+    inc("images_encoded_total", len(image_tensors))
+    return embeddings
 
 def add_image_to_database(url, embedding):
     """Add an image and its embedding to the database."""
-    print(url, "url")
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO images (url, embedding) VALUES (%s, %s) ON CONFLICT (url) DO UPDATE SET embedding = EXCLUDED.embedding",
-                (url, embedding.tolist())
-            )
-
-def process_images_folder(folder_path):
-    """Process all images in a folder and its subfolders."""
+    add_images_to_database([(url, embedding)])
+
+def add_images_to_database(rows):
+    """Upsert a batch of (url, embedding) pairs in a single statement and refresh their neighbour lists.
+
+    Buffering stores only persist the batch on the next flush().
+    """
+    store = get_store()
+    store.add_images(rows)
+    if IMAGE_NEIGHBORS_K > 0:
+        store.update_image_neighbors([url for url, _ in rows], IMAGE_NEIGHBORS_K)
+
+def rebuild_image_neighbors(k=IMAGE_NEIGHBORS_K):
+    """Offline job: recompute the stored k nearest neighbours of every image."""
+    store = get_store()
+    start_time = time.perf_counter()
+    count = store.rebuild_image_neighbors(k)
+    store.flush()
+    print(f"Stored {k} neighbours for {count} images in {time.perf_counter() - start_time:.1f}s")
+    return count
+
+def get_image_neighbors(url, limit=IMAGE_NEIGHBORS_K):
+    """Precomputed "more like this" images for an image url, nearest first."""
+    return get_store().get_image_neighbors(url, limit)
+
+def iter_image_paths(folder_path):
+    """Yield the paths of all images in a folder and its subfolders."""
     for root, _, files in os.walk(folder_path):
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                image_path = os.path.join(root, file)
-                embedding = get_image_embedding(image_path)
-                add_image_to_database(image_path, embedding)
+        for file in sorted(files):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, file)
+
+def prepare_image(image_path, embedding_cache):
+    """Hash an image and, unless its embedding is already cached, decode and preprocess it."""
+    digest = file_digest(image_path) if embedding_cache is not None else None
+    if digest is not None and digest in embedding_cache:
+        return digest, None
+    return digest, load_image_tensor(image_path)
+
+def _prepare_stream(image_paths, pool, prefetch, embedding_cache):
+    """Prepare images on a thread pool, keeping at most `prefetch` images in flight."""
+    pending = deque()
+    for image_path in image_paths:
+        pending.append((image_path, pool.submit(prepare_image, image_path, embedding_cache)))
+        if len(pending) >= prefetch:
+            yield _take_result(*pending.popleft())
+    while pending:
+        yield _take_result(*pending.popleft())
+
+def _take_result(image_path, future):
+    try:
+        return image_path, future.result()
+    except Exception as e:
+        print(f"Skipping {image_path}: {e}")
+        return image_path, None
+
+def ingest_batch(batch, embedding_cache, stored_urls):
+    """Encode and upsert a batch of (path, (digest, tensor)) pairs from prepare_image.
+
+    Cache misses are encoded in one forward pass and added to the cache; only
+    rows whose content the store does not already hold are written. Returns
+    (encoded, written) counts.
+    """
+    to_encode = [(path, digest, tensor) for path, (digest, tensor) in batch if tensor is not None]
+    new_embeddings = {}
+    if to_encode:
+        embeddings = get_image_embeddings([tensor for _, _, tensor in to_encode])
+        new_embeddings = {path: embedding for (path, _, _), embedding in zip(to_encode, embeddings)}
+        if embedding_cache is not None:
+            embedding_cache.put_many([digest for _, digest, _ in to_encode], embeddings)
+
+    rows = []
+    for path, (digest, _) in batch:
+        if embedding_cache is None:
+            rows.append((path, digest, new_embeddings[path]))
+        elif not (embedding_cache.is_written(path, digest) and path in stored_urls):
+            rows.append((path, digest, new_embeddings.get(path, embedding_cache.get(digest))))
+    if rows:
+        add_images_to_database([(path, embedding) for path, _, embedding in rows])
+        stored_urls.update(path for path, _, _ in rows)
+        if embedding_cache is not None:
+            embedding_cache.mark_written([path for path, _, _ in rows], [digest for _, digest, _ in rows])
+    return len(to_encode), len(rows)
+
+def process_images_folder(folder_path, batch_size=32, num_workers=None, use_cache=True):
+    """Process all images in a folder and its subfolders.
+
+    Images are hashed, decoded and preprocessed on a thread pool, encoded in
+    batches of `batch_size` and upserted one batch per statement. With
+    `use_cache`, images whose content is in the embedding cache are not
+    re-encoded, and rows the store already holds with the same content are
+    not rewritten.
+    """
+    num_workers = num_workers or min(8, os.cpu_count() or 1)
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, get_encoder().name) if use_cache else None
+    # Only trust the cache's record of written rows for urls the store still has
+    stored_urls = set(get_store().get_image_urls()) if use_cache else set()
+    start_time = last_save = time.perf_counter()
+    processed = encoded = written = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        stream = _prepare_stream(iter_image_paths(folder_path), pool, 2 * batch_size, embedding_cache)
+        while batch := list(islice(stream, batch_size)):
+            batch = [(path, prepared) for path, prepared in batch if prepared is not None]
+            if not batch:
+                continue
+            batch_encoded, batch_written = ingest_batch(batch, embedding_cache, stored_urls)
+            encoded += batch_encoded
+            written += batch_written
+            if embedding_cache is not None and time.perf_counter() - last_save > 30:
+                get_store().flush()
+                embedding_cache.save()
+                last_save = time.perf_counter()
+
+            processed += len(batch)
+            elapsed = time.perf_counter() - start_time
+            print(f"Processed {processed} images, encoded {encoded}, wrote {written} ({processed / elapsed:.1f} images/sec)")
+    get_store().flush()
+    if embedding_cache is not None:
+        embedding_cache.save()
+    elapsed = time.perf_counter() - start_time
+    print(f"Finished {processed} images in {elapsed:.1f}s ({processed / max(elapsed, 1e-9):.1f} images/sec), "
+          f"encoded {encoded}, wrote {written}")
+    return processed
 
 def add_user_favorite(user_id, image_id):
     """Add a favorite image for a user."""
     print(user_id, image_id)
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO user_favorites (user_id, image_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                (user_id, image_id)
-            )
-        update_user_embedding(user_id)
+    store = get_store()
+    store.add_user_favorite(user_id, image_id)
+    store.flush()
 
 def update_user_embedding(user_id):
-    """Update the embedding for a user based on their favorite images."""
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE users
-                SET embedding = (
-                    SELECT AVG(i.embedding)
-                    FROM user_favorites uf
-                    JOIN images i ON uf.image_id = i.id
-                    WHERE uf.user_id = %s
-                )
-                WHERE id = %s
-            """, (user_id, user_id))
+    """Recompute the embedding, running sum and favorite count for a user from scratch."""
+    store = get_store()
+    store.update_user_embedding(user_id)
+    store.flush()
+
+def rebuild_user_embeddings():
+    """Recompute every user's embedding from their favorites.
+
+    Favorite mutations maintain the embeddings incrementally, so this repairs
+    float drift and picks up images whose embeddings were re-ingested.
+    """
+    store = get_store()
+    count = store.rebuild_user_embeddings()
+    store.flush()
+    print(f"Rebuilt embeddings for {count} users")
+    return count
 
 def get_similar_users(target_user_id, limit=3):
     """Get the most similar users based on embedding similarity."""
     start_time = time.time()
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        with conn.cursor() as cur:
-            
-            cur.execute("""
-                WITH target_user AS (
-                    SELECT embedding
-                    FROM users
-                    WHERE id = %s
-                )
-                SELECT u.id, u.username, 1 - (u.embedding <=> tu.embedding) AS similarity
-                FROM users u, target_user tu
-                WHERE u.id != %s
-                  AND u.embedding IS NOT NULL
-                  AND tu.embedding IS NOT NULL
-                ORDER BY u.embedding <=> tu.embedding
-                LIMIT %s
-            """, (target_user_id, target_user_id, limit))
-            
-            results = cur.fetchall()
-            if not results:
-                print(f"No similar users found. User {target_user_id} might not exist or have an embedding.")
+    results = get_store().get_similar_users(target_user_id, limit)
+    if not results:
+        print(f"No similar users found. User {target_user_id} might not exist or have an embedding.")
             
     end_time = time.time()  # Record the end time
     elapsed_time = end_time - start_time  # Calculate the elapsed time
     
     return {"elapsed_time": elapsed_time, "results": results}
 
+def get_similar_users_bulk(user_ids, limit=3):
+    """Get the most similar users for many users with a single store query."""
+    start_time = time.time()
+    results = get_store().get_similar_users_bulk(user_ids, limit)
+    elapsed_time = time.time() - start_time
+    return {"elapsed_time": elapsed_time, "results": results}
+
+def get_user_cards(user_ids, limit=3):
+    """Favorites and most similar users for a page of users with a single store query."""
+    start_time = time.time()
+    results = get_store().get_user_cards(user_ids, limit)
+    elapsed_time = time.time() - start_time
+    return {"elapsed_time": elapsed_time, "results": results}
+
 def delete_user_favorite(user_id, image_id):
     """Delete a user's favorite image and recalculate embedding."""
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                DELETE FROM user_favorites
-                WHERE user_id = %s AND image_id = %s
-            """, (user_id, image_id))
-            
-            if cur.rowcount == 0:
-                print(f"No favorite found for user {user_id} with image ID {image_id}")
-                return
-            
-            print(f"Deleted favorite for user {user_id} with image ID {image_id}")
-    
-    update_user_embedding(user_id)
+    store = get_store()
+    if not store.delete_user_favorite(user_id, image_id):
+        print(f"No favorite found for user {user_id} with image ID {image_id}")
+        return
+    store.flush()
+    print(f"Deleted favorite for user {user_id} with image ID {image_id}")
+
+def refresh_recommendations(user_ids=None):
+    """Recompute stored recommendations for the given users, or for every user whose embedding changed."""
+    start_time = time.perf_counter()
+    store = get_store()
+    count = store.refresh_recommendations(
+        RECOMMENDATIONS_N, RECOMMENDATION_CANDIDATES, RECOMMENDATION_NEIGHBOURS, RECOMMENDATION_SOCIAL_WEIGHT, user_ids
+    )
+    if count:
+        store.flush()
+        print(f"Refreshed recommendations for {count} users in {time.perf_counter() - start_time:.2f}s")
+    return count
+
+def start_recommendation_refresher(interval):
+    """Refresh stale recommendations every `interval` seconds in a daemon thread; a no-op when interval is 0."""
+    if interval <= 0:
+        return None
+
+    def refresh_forever():
+        while True:
+            try:
+                refresh_recommendations()
+            except Exception as e:
+                print(f"Recommendation refresh failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=refresh_forever, name="recommendation-refresher", daemon=True)
+    thread.start()
+    return thread
+
+def export_snapshot(directory, full=False):
+    """Append new image and changed user embeddings to the memory-mapped snapshot in `directory`, or rewrite it (see snapshots.py)."""
+    from snapshots import export_snapshot as export
+
+    start_time = time.perf_counter()
+    written = export(get_store(), directory, full=full)
+    print(f"Snapshot {directory}: {'wrote a new generation with' if written['full'] else 'appended'} "
+          f"{written['images']} images and {written['users']} users in {time.perf_counter() - start_time:.2f}s")
+    return written
+
+def get_recommendations(user_id, limit=RECOMMENDATIONS_N):
+    """A user's stored image recommendations, best first."""
+    return get_store().get_recommendations(user_id, limit)
+
+def mutate_user_favorites(user_id, add_urls=(), remove_image_ids=(), max_favorites=None):
+    """Apply a burst of favorite adds and removes for one user in one store call.
+
+    Returns {"added", "removed", "favorites"}; see VectorStore.mutate_favorites.
+    """
+    store = get_store()
+    result = store.mutate_favorites(user_id, add_urls, remove_image_ids, max_favorites)
+    if result["added"] or result["removed"]:
+        store.flush()
+    return result
 
 def get_user_favorites(user_id):
     """Get the URLs of favorite images for a user."""
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT i.id, i.url
-                FROM user_favorites uf
-                JOIN images i ON uf.image_id = i.id
-                WHERE uf.user_id = %s
-                ORDER BY i.id
-            """, (user_id,))
-            return [{"id": row[0], "url": row[1]} for row in cur.fetchall()]
+    return get_store().get_user_favorites(user_id)
 
 def add_user_favorite_by_url(user_id, url):
     """Add a favorite image for a user by URL, assuming the image already exists in the database."""
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id FROM images WHERE url = %s", (url,))
-            result = cur.fetchone()
-            
-            if result is None:
-                print(f"Error: Image with URL {url} not found in the database.")
-                return None
-            
-            image_id = result[0]
-            
-            cur.execute(
-                "INSERT INTO user_favorites (user_id, image_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                (user_id, image_id)
-            )
-            
-            if cur.rowcount == 0:
-                print(f"Favorite already exists for user {user_id} with image URL {url}")
-            else:
-                print(f"Added favorite for user {user_id} with image URL {url}")
-    
-    update_user_embedding(user_id)
+    store = get_store()
+    image_id, added = store.add_user_favorite_by_url(user_id, url)
+    if image_id is None:
+        print(f"Error: Image with URL {url} not found in the database.")
+        return None
+    if not added:
+        print(f"Favorite already exists for user {user_id} with image URL {url}")
+        return
+    store.flush()
+    print(f"Added favorite for user {user_id} with image URL {url}")
+
+# Async variants for the web routes. psycopg2 blocks, so each call runs on a worker
+# thread with its own pooled connection and independent lookups can overlap.
+
+async def aget_user_cards(user_ids, limit=3):
+    """Async get_user_cards."""
+    return await asyncio.to_thread(get_user_cards, user_ids, limit)
+
+async def aget_image_neighbors(url, limit=IMAGE_NEIGHBORS_K):
+    """Async get_image_neighbors."""
+    return await asyncio.to_thread(get_image_neighbors, url, limit)
+
+async def aget_recommendations(user_id, limit=RECOMMENDATIONS_N):
+    """Async get_recommendations."""
+    return await asyncio.to_thread(get_recommendations, user_id, limit)
+
+async def amutate_user_favorites(user_id, add_urls=(), remove_image_ids=(), max_favorites=None):
+    """Async mutate_user_favorites."""
+    return await asyncio.to_thread(mutate_user_favorites, user_id, add_urls, remove_image_ids, max_favorites)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the schema, embed the image folder and seed demo favorites.")
+    parser.add_argument(
+        "command", nargs="?", default="init", choices=["init", "rebuild-user-embeddings", "rebuild-image-neighbors", "refresh-recommendations", "watch", "snapshot"],
+        help="'rebuild-user-embeddings' recomputes every user embedding from their favorites and exits; "
+        "'rebuild-image-neighbors' recomputes the stored neighbours of every image and exits; "
+        "'refresh-recommendations' recomputes recommendations of users whose embedding changed and exits; "
+        "'watch' keeps ingesting new and modified images until interrupted; "
+        "'snapshot' appends new embeddings to the memory-mapped snapshot and exits",
+    )
+    parser.add_argument("--image-folder", default="./static/images")
+    parser.add_argument("--batch-size", type=int, default=32, help="images per encode_image call")
+    parser.add_argument("--workers", type=int, default=None, help="threads used to decode and preprocess images")
+    parser.add_argument("--encoder-backend", choices=BACKENDS, default=ENCODER_BACKEND, help="CLIP inference backend, see encoders.py")
+    parser.add_argument("--draft-decode", action="store_true", default=ENCODER_DRAFT_DECODE, help="decode JPEGs at reduced size before preprocessing")
+    parser.add_argument("--processes", type=int, default=1, help="encode on this many worker processes, one shard each")
+    parser.add_argument("--threads-per-process", type=int, default=None, help="torch threads per worker process (default: cores / processes)")
+    parser.add_argument("--no-cache", action="store_true", help="re-encode and rewrite every image, ignoring the embedding cache")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="watch: seconds between folder scans")
+    parser.add_argument("--queue-size", type=int, default=256, help="watch: files queued before the scanner waits")
+    parser.add_argument("--max-latency", type=float, default=1.0, help="watch: seconds to wait filling a batch")
+    parser.add_argument("--rescan-interval", type=float, default=300.0, help="watch: seconds between full scans that catch files rewritten in place")
+    parser.add_argument("--snapshot-dir", default="data/snapshot", help="snapshot: directory of the snapshot files")
+    parser.add_argument("--full", action="store_true", help="snapshot: write a new generation of the snapshot instead of appending")
+    args = parser.parse_args()
+    set_encoder(ClipEncoder(args.encoder_backend, draft=args.draft_decode))
+
+    if args.command == "rebuild-user-embeddings":
+        rebuild_user_embeddings()
+        raise SystemExit
+    if args.command == "rebuild-image-neighbors":
+        rebuild_image_neighbors()
+        raise SystemExit
+    if args.command == "refresh-recommendations":
+        refresh_recommendations()
+        raise SystemExit
+    if args.command == "snapshot":
+        export_snapshot(args.snapshot_dir, full=args.full)
+        raise SystemExit
+    if args.command == "watch":
+        from ingest_watch import watch_images_folder
+
+        watch_images_folder(
+            args.image_folder, batch_size=args.batch_size, num_workers=args.workers, queue_size=args.queue_size,
+            poll_interval=args.poll_interval, max_latency=args.max_latency, rescan_interval=args.rescan_interval,
+        )
+        raise SystemExit
+
     create_tables()
     initialize_users()
     
     # Process images
-    image_folder = "./static/images"
-    process_images_folder(image_folder)
+    if args.processes > 1:
+        from ingest_shards import process_images_folder_sharded
+
+        process_images_folder_sharded(
+            args.image_folder, num_processes=args.processes, batch_size=args.batch_size,
+            threads_per_process=args.threads_per_process, use_cache=not args.no_cache,
+        )
+    else:
+        process_images_folder(
+            args.image_folder, batch_size=args.batch_size, num_workers=args.workers, use_cache=not args.no_cache
+        )
+    generate_thumbnails(args.image_folder, num_workers=args.workers)
+    if IMAGE_NEIGHBORS_K > 0:
+        rebuild_image_neighbors()
     
     # Add some favorites for demonstration
     add_user_favorite(1, 1)
@@ -211,6 +418,7 @@ if __name__ == "__main__":
     add_user_favorite(3, 3)
     add_user_favorite(4, 2)
     add_user_favorite(4, 4)
+    refresh_recommendations()
     
     # Get similar users
     target_user_id = 1
@@ -0,0 +1,218 @@
+"""CLIP encoders: the image tower for ingestion, with selectable CPU inference
+backends, and the text tower alone for search queries.
+
+An encoder has a `name` (part of the embedding cache key), `preprocess(image)`
+turning an opened PIL image into a tensor, and `encode(tensors)` returning a
+float32 numpy batch of embeddings. ClipEncoder runs the CLIP image tower on
+one of the BACKENDS:
+
+    eager      stock encode_image under no_grad, the reference
+    optimized  inference_mode with channels-last weights and inputs
+    traced     TorchScript trace of the image tower, frozen for inference
+    int8       dynamic int8 quantization of the tower's Linear layers
+
+With `draft`, JPEGs are decoded at a reduced scale close to the model's input
+size instead of at full resolution. Since backends change the embeddings
+slightly, check them against the reference before switching:
+
+    python encoders.py check --image-folder ./static/images --backends optimized traced int8
+"""
+import argparse
+import os
+import threading
+import time
+from itertools import islice
+import numpy as np
+from PIL import Image
+from metrics import span
+
+MODEL_NAME = "ViT-B/32"
+BACKENDS = ("eager", "optimized", "traced", "int8")
+ENCODER_BACKEND = os.environ.get("ENCODER_BACKEND", "eager")
+ENCODER_DRAFT_DECODE = os.environ.get("ENCODER_DRAFT_DECODE", "0") == "1"
+
+
+class ClipEncoder:
+    """The CLIP image tower: `preprocess` turns a PIL image into a tensor, `encode` embeds a batch of them.
+
+    CLIP is loaded on first use, so processes that only touch the store (the
+    web server) never import torch or hold the model weights.
+    """
+
+    def __init__(self, backend=ENCODER_BACKEND, draft=ENCODER_DRAFT_DECODE, model_name=MODEL_NAME):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {BACKENDS}")
+        self.backend = backend
+        self.draft = draft
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        # The reference configuration keeps the plain model name, so existing caches stay valid
+        suffix = ("" if self.backend == "eager" else f"+{self.backend}") + ("+draft" if self.draft else "")
+        return self.model_name + suffix
+
+    def __getstate__(self):
+        # Sent to ingestion worker processes, which load their own copy of the model
+        return {"backend": self.backend, "draft": self.draft, "model_name": self.model_name}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def load(self):
+        """Return (image_tower, preprocess, device, dtype, input_size), loading CLIP the first time it is needed."""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    with span("model.load", backend=self.backend):
+                        self._model = self._load()
+        return self._model
+
+    def _load(self):
+        import torch
+        import clip
+        device = "cuda" if torch.cuda.is_available() and self.backend != "int8" else "cpu"
+        model, preprocess = clip.load(self.model_name, device=device)
+        tower = model.visual.eval()
+        input_size = tower.input_resolution
+        if self.backend == "optimized":
+            tower = tower.to(memory_format=torch.channels_last)
+        elif self.backend == "traced":
+            example = torch.zeros(1, 3, input_size, input_size, dtype=model.dtype, device=device)
+            with torch.inference_mode():
+                tower = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.trace(tower, example)))
+        elif self.backend == "int8":
+            tower = torch.ao.quantization.quantize_dynamic(tower, {torch.nn.Linear}, dtype=torch.qint8)
+        return tower, preprocess, device, model.dtype, input_size
+
+    def preprocess(self, image):
+        _, preprocess, _, _, input_size = self.load()
+        if self.draft:
+            # JPEG decoding picks the smallest 1/2, 1/4 or 1/8 scale still covering the input size
+            image.draft("RGB", (input_size, input_size))
+        return preprocess(image)
+
+    def encode(self, image_tensors):
+        import torch
+        tower, _, device, dtype, _ = self.load()
+        batch = torch.stack(image_tensors).to(device, dtype)
+        if self.backend == "eager":
+            with torch.no_grad():
+                image_features = tower(batch)
+        else:
+            if self.backend == "optimized":
+                batch = batch.contiguous(memory_format=torch.channels_last)
+            with torch.inference_mode():
+                image_features = tower(batch)
+        return image_features.float().cpu().numpy()
+
+
+class ClipTextEncoder:
+    """The CLIP text tower alone: `encode_text` embeds a batch of query strings.
+
+    The vision tower is dropped right after loading, so search workers hold
+    only the text weights. CLIP's own encode_text reads its dtype from the
+    vision tower, hence the forward pass is spelled out here.
+    """
+
+    def __init__(self, model_name=MODEL_NAME):
+        self.model_name = model_name
+        self.name = f"{model_name}/text"
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Return (model, device, dtype), loading CLIP the first time it is needed."""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    with span("model.load", backend="text"):
+                        self._model = self._load()
+        return self._model
+
+    def _load(self):
+        import torch
+        import clip
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model, _ = clip.load(self.model_name, device=device)
+        dtype = model.dtype
+        del model.visual
+        if device == "cuda":
+            torch.cuda.empty_cache()
+        return model.eval(), device, dtype
+
+    def encode_text(self, texts):
+        import torch
+        import clip
+        model, device, dtype = self.load()
+        tokens = clip.tokenize(list(texts), truncate=True).to(device)
+        with torch.inference_mode():
+            x = model.token_embedding(tokens).type(dtype) + model.positional_embedding.type(dtype)
+            x = model.transformer(x.permute(1, 0, 2)).permute(1, 0, 2)
+            x = model.ln_final(x).type(dtype)
+            # Features at the end-of-text token, which has the highest token id
+            features = x[torch.arange(x.shape[0]), tokens.argmax(dim=-1)] @ model.text_projection
+        return features.float().cpu().numpy()
+
+
+def _cosines(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+def _encode_paths(encoder, paths, batch_size):
+    embeddings = []
+    paths = iter(paths)
+    while batch := list(islice(paths, batch_size)):
+        tensors = []
+        for path in batch:
+            with Image.open(path) as image:
+                tensors.append(encoder.preprocess(image))
+        embeddings.append(encoder.encode(tensors))
+    return np.concatenate(embeddings)
+
+
+def check_agreement(image_paths, backends, draft=False, batch_size=32):
+    """Cosine agreement and throughput of each backend against the eager reference on the same images.
+
+    Returns {name: {"mean_cosine", "min_cosine", "images_per_sec"}}, the
+    reference included.
+    """
+    results = {}
+    reference = None
+    for encoder in [ClipEncoder("eager", draft=False)] + [ClipEncoder(backend, draft=draft) for backend in backends]:
+        encoder.load()
+        _encode_paths(encoder, image_paths[:batch_size], batch_size)  # warm up
+        start = time.perf_counter()
+        embeddings = _encode_paths(encoder, image_paths, batch_size)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = embeddings
+        cosines = _cosines(reference, embeddings)
+        results[encoder.name] = {
+            "mean_cosine": float(cosines.mean()),
+            "min_cosine": float(cosines.min()),
+            "images_per_sec": len(image_paths) / elapsed,
+        }
+    return results
+
+
+if __name__ == "__main__":
+    from embeddings import iter_image_paths
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["check"])
+    parser.add_argument("--image-folder", default="./static/images")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=[backend for backend in BACKENDS if backend != "eager"])
+    parser.add_argument("--draft", action="store_true", help="also decode JPEGs at reduced size for the checked backends")
+    parser.add_argument("--limit", type=int, default=128, help="images to encode with each backend")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    paths = sorted(iter_image_paths(args.image_folder))[:args.limit]
+    for name, result in check_agreement(paths, args.backends, draft=args.draft, batch_size=args.batch_size).items():
+        print(f"{name:24s} mean cosine {result['mean_cosine']:.5f}  min cosine {result['min_cosine']:.5f}  "
+              f"{result['images_per_sec']:.1f} images/sec")
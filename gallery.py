@@ -0,0 +1,80 @@
+import os
+import threading
+from fasthtml.common import to_xml
+from metrics import span
+
+
+class GalleryIndex:
+    """Category image listings and their rendered HTML, built once and kept current.
+
+    Listings are scanned at startup. A background thread stats each category
+    directory every `poll_interval` seconds and rescans only the ones whose
+    mtime changed (files added, removed or renamed); refresh() forces a full
+    rescan. Rendered fragments are cached per category and dropped whenever
+    that category's listing changes.
+    """
+
+    def __init__(self, image_dir, categories, limit=10, pattern="*.jpg", poll_interval=5.0):
+        self.image_dir = image_dir
+        self.categories = list(categories)
+        self.limit = limit
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._mtimes = {}
+        self._fragments = {}
+        self._watcher = None
+        self.refresh()
+
+    def _directory(self, category):
+        return self.image_dir / category.lower()
+
+    def _mtime(self, category):
+        try:
+            return os.stat(self._directory(category)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _scan(self, category):
+        mtime = self._mtime(category)
+        names = sorted(path.name for path in self._directory(category).glob(self.pattern))[: self.limit]
+        with self._lock:
+            self._listings[category] = names
+            self._mtimes[category] = mtime
+            self._fragments.pop(category, None)
+
+    def refresh(self, categories=None):
+        """Rescan the given categories, or all of them."""
+        for category in categories or self.categories:
+            self._scan(category)
+
+    def images(self, category):
+        """Filenames shown for a category."""
+        with self._lock:
+            return list(self._listings[category])
+
+    def rendered(self, category, render):
+        """HTML of render(category, filenames), cached until the category changes."""
+        with self._lock:
+            fragment = self._fragments.get(category)
+        if fragment is None:
+            with span("render", component="category_section"):
+                fragment = to_xml(render(category, self.images(category)))
+            with self._lock:
+                self._fragments.setdefault(category, fragment)
+        return fragment
+
+    def start_watcher(self):
+        """Poll the category directories in a daemon thread; a no-op when poll_interval is 0."""
+        if self.poll_interval <= 0 or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, name="gallery-watcher", daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        stop = threading.Event()
+        while not stop.wait(self.poll_interval):
+            changed = [category for category in self.categories if self._mtime(category) != self._mtimes.get(category)]
+            if changed:
+                self.refresh(changed)
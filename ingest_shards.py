@@ -0,0 +1,165 @@
+"""Sharded ingestion: encode the image folder on several worker processes.
+
+The sorted image list is split round-robin into one shard per process. Each
+worker loads its own copy of the encoder, limits torch to `threads_per_process`
+intra-op threads, and streams encoded batches back over a bounded queue to the
+parent, which is the only writer: it bulk-upserts every batch, appends new
+embeddings to the embedding cache and prints per-shard progress.
+
+Resuming relies on the embedding cache's record of written rows, saved with a
+store flush every 30 seconds: workers hash every file but skip decoding and
+encoding those whose content the store already holds, so an interrupted run
+picks up roughly where it stopped. Workers also open the embedding cache
+read-only and send back cached vectors instead of encoding them again.
+"""
+import multiprocessing
+import os
+import queue
+import time
+from itertools import islice
+import embeddings
+from embedding_cache import EmbeddingCache, file_digest
+
+PROGRESS_INTERVAL = 5.0
+
+
+def _init_worker(encoder, threads):
+    # Set before torch is first imported so its OpenMP pool starts at the right size
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    embeddings.set_encoder(encoder)
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+
+
+def _encode_shard(shard_id, paths, written_digests, cache_dir, encoder, threads, batch_size, results):
+    """Worker process: hash, preprocess and encode one shard, putting each batch on `results`.
+
+    Images whose content is in the embedding cache under `cache_dir` are sent
+    back with their cached vector rather than encoded.
+    """
+    _init_worker(encoder, threads)
+    embedding_cache = EmbeddingCache(cache_dir, encoder.name, read_only=True) if cache_dir else None
+    try:
+        paths = iter(paths)
+        while chunk := list(islice(paths, batch_size)):
+            cached, rows, tensors, skipped = [], [], [], 0
+            for path in chunk:
+                try:
+                    digest = file_digest(path)
+                    if digest == written_digests.get(path):
+                        skipped += 1
+                        continue
+                    embedding = embedding_cache.get(digest) if embedding_cache is not None else None
+                    if embedding is not None:
+                        cached.append((path, digest, embedding))
+                        continue
+                    tensors.append(embeddings.load_image_tensor(path))
+                    rows.append((path, digest))
+                except Exception as e:
+                    print(f"Skipping {path}: {e}")
+                    skipped += 1
+            batch_embeddings = embeddings.get_image_embeddings(tensors) if tensors else []
+            encoded = [(path, digest, embedding) for (path, digest), embedding in zip(rows, batch_embeddings)]
+            results.put(("batch", shard_id, cached + encoded, skipped))
+    except BaseException as e:
+        results.put(("failed", shard_id, repr(e), 0))
+        raise
+    results.put(("done", shard_id, None, 0))
+
+
+def process_images_folder_sharded(folder_path, num_processes=None, batch_size=32, threads_per_process=None, use_cache=True):
+    """Like process_images_folder, but encoding on `num_processes` worker processes."""
+    num_processes = num_processes or os.cpu_count() or 1
+    threads_per_process = threads_per_process or max(1, (os.cpu_count() or 1) // num_processes)
+    store = embeddings.get_store()
+    embedding_cache = EmbeddingCache(embeddings.EMBEDDING_CACHE_DIR, embeddings.get_encoder().name) if use_cache else None
+    written_digests = {}
+    if embedding_cache is not None:
+        # Only trust the cache's record of written rows for urls the store still has
+        for url in store.get_image_urls():
+            digest = embedding_cache.written_digest(url)
+            if digest is not None:
+                written_digests[url] = digest
+
+    paths = sorted(embeddings.iter_image_paths(folder_path))
+    shards = [paths[i::num_processes] for i in range(num_processes)]
+    progress = [0] * num_processes
+    print(f"Ingesting {len(paths)} images on {num_processes} processes x {threads_per_process} threads")
+
+    # Spawned rather than forked: workers must not inherit the parent's database
+    # connections, and torch is not fork-safe once its thread pools are running
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue(maxsize=2 * num_processes)
+    workers = [
+        context.Process(
+            target=_encode_shard, name=f"ingest-shard-{shard_id}",
+            args=(shard_id, shard, {path: written_digests[path] for path in shard if path in written_digests},
+                  embeddings.EMBEDDING_CACHE_DIR if use_cache else None,
+                  embeddings.get_encoder(), threads_per_process, batch_size, results),
+        )
+        for shard_id, shard in enumerate(shards)
+    ]
+    start_time = last_save = last_report = time.perf_counter()
+    for worker in workers:
+        worker.start()
+
+    written = 0
+    running = set(range(num_processes))
+    failed = set()
+    try:
+        while running:
+            try:
+                kind, shard_id, payload, skipped = results.get(timeout=1.0)
+            except queue.Empty:
+                for shard_id in list(running):
+                    # A clean exit still has its "done" message in flight
+                    if not workers[shard_id].is_alive() and workers[shard_id].exitcode != 0:
+                        running.discard(shard_id)
+                        failed.add(shard_id)
+                        print(f"Shard {shard_id} exited with code {workers[shard_id].exitcode}")
+                continue
+            if kind != "batch":
+                running.discard(shard_id)
+                if kind == "failed":
+                    failed.add(shard_id)
+                    print(f"Shard {shard_id} failed: {payload}")
+                continue
+
+            if payload:
+                embeddings.add_images_to_database([(path, embedding) for path, _, embedding in payload])
+                if embedding_cache is not None:
+                    embedding_cache.put_many([digest for _, digest, _ in payload], [embedding for _, _, embedding in payload])
+                    embedding_cache.mark_written([path for path, _, _ in payload], [digest for _, digest, _ in payload])
+            written += len(payload)
+            progress[shard_id] += len(payload) + skipped
+
+            now = time.perf_counter()
+            if now - last_save > 30:
+                store.flush()
+                if embedding_cache is not None:
+                    embedding_cache.save()
+                last_save = now
+            if now - last_report > PROGRESS_INTERVAL:
+                done = sum(progress)
+                shard_status = " ".join(f"{i}:{count}/{len(shard)}" for i, (count, shard) in enumerate(zip(progress, shards)))
+                print(f"Processed {done}/{len(paths)} images ({done / (now - start_time):.1f} images/sec) shards {shard_status}")
+                last_report = now
+    finally:
+        store.flush()
+        if embedding_cache is not None:
+            embedding_cache.save()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    processed = sum(progress)
+    elapsed = time.perf_counter() - start_time
+    print(f"Finished {processed} images in {elapsed:.1f}s ({processed / max(elapsed, 1e-9):.1f} images/sec), "
+          f"wrote {written}")
+    if failed:
+        raise RuntimeError(f"Shards {sorted(failed)} did not finish; rerun to resume them")
+    return processed
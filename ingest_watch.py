@@ -0,0 +1,276 @@
+"""Continuous ingestion: watch the image folder and embed files as they appear or change.
+
+A scanner thread polls the folder every `poll_interval` seconds and pushes
+new or modified files into a bounded queue; when the queue is full the
+scanner blocks, so a burst of uploads cannot run ahead of the encoder.
+Adding, removing or renaming a file changes its directory's mtime, so a poll
+only lists and stats the files of directories whose mtime moved (or that
+still held unsettled files) and costs one stat per directory otherwise.
+Files rewritten in place leave the directory mtime alone; they are picked up
+by the full scan every `rescan_interval` seconds.
+
+The consumer drains the queue in micro-batches of up to `batch_size` files,
+waiting at most `max_latency` seconds to fill one, then encodes and upserts
+them like process_images_folder. A batch that fails is retried with backoff,
+and after INGEST_RETRIES attempts its files go back to the scanner for a later
+poll. After each committed batch the (mtime, size) of every file in it is
+appended to the checkpoint, so a restart only picks up what changed since.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from embeddings import (
+    EMBEDDING_CACHE_DIR,
+    IMAGE_EXTENSIONS,
+    get_encoder,
+    ingest_batch,
+    prepare_image,
+)
+from embedding_cache import EmbeddingCache
+from store import get_store
+
+INGEST_CHECKPOINT = os.environ.get("INGEST_CHECKPOINT", "data/ingest_checkpoint.json")
+# Checkpoint entries the append-only log may hold before it is folded into the JSON file
+CHECKPOINT_LOG_COMPACT = 10000
+# Attempts at a failing batch before its files are handed back to the scanner for a later poll
+INGEST_RETRIES = 3
+
+
+class Checkpoint:
+    """Path -> [mtime_ns, size] of every file already ingested.
+
+    The whole map is saved atomically as JSON. Committed batches only append
+    their entries to <path>.log, one JSON line per file; the log is folded
+    back into the JSON file on load and once it outgrows the map (or
+    CHECKPOINT_LOG_COMPACT entries), so a batch costs O(batch) to record.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = f"{path}.log"
+        self.files = {}
+        self._logged = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f)
+        if os.path.exists(self.log_path):
+            with open(self.log_path) as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # cut short by a crash
+                    file_path, signature = json.loads(line)
+                    self.files[file_path] = signature
+            # Also drops a torn last line, so later appends start on a line of their own
+            self.save()
+
+    def add(self, items):
+        """Record (path, signature) pairs and persist them by appending to the log."""
+        for path, signature in items:
+            self.files[path] = signature
+        if self._logged + len(items) > max(CHECKPOINT_LOG_COMPACT, len(self.files)):
+            self.save()
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.log_path, "a") as f:
+            f.writelines(json.dumps([path, signature]) + "\n" for path, signature in items)
+        self._logged += len(items)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.files, f)
+        os.replace(tmp_path, self.path)
+        # The JSON file now holds every entry; replaying a log left by a crash here is harmless
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self._logged = 0
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class FolderWatcher:
+    def __init__(self, folder_path, checkpoint, work_queue, poll_interval=2.0, settle_time=1.0, rescan_interval=300.0):
+        self.folder_path = folder_path
+        self.checkpoint = checkpoint
+        self.queue = work_queue
+        self.poll_interval = poll_interval
+        # Files modified more recently than this may still be uploading
+        self.settle_time = settle_time
+        self.rescan_interval = rescan_interval
+        self.stop = threading.Event()
+        self._queued = {}  # path -> signature enqueued and not yet checkpointed
+        self._lock = threading.Lock()
+        # Directory -> (mtime_ns, subdirectories) as of its last listing, for directories
+        # whose files were all settled and then already checkpointed or queued
+        self._directories = {}
+        self._last_full_scan = time.monotonic()
+
+    def scan_once(self):
+        if time.monotonic() - self._last_full_scan >= self.rescan_interval:
+            self._directories.clear()
+            self._last_full_scan = time.monotonic()
+        now_ns = time.time_ns()
+        pending = [self.folder_path]
+        while pending:
+            directory = pending.pop()
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                self._directories.pop(directory, None)
+                continue
+            known = self._directories.get(directory)
+            if known is not None and known[0] == mtime_ns:
+                pending.extend(known[1])
+                continue
+            subdirectories, files = [], []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                        elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                            files.append(entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            pending.extend(sorted(subdirectories, reverse=True))
+            settled = True
+            for path in sorted(files):
+                if self.stop.is_set():
+                    return
+                settled &= self._enqueue_if_changed(path, now_ns)
+            # A directory touched within the settle time may change again within the same mtime tick
+            if settled and now_ns - mtime_ns >= self.settle_time * 1e9:
+                self._directories[directory] = (mtime_ns, subdirectories)
+            else:
+                self._directories.pop(directory, None)
+
+    def _enqueue_if_changed(self, path, now_ns):
+        """Queue the file unless it is checkpointed or queued as is; False while it may still be uploading."""
+        try:
+            signature = _signature(path)
+        except FileNotFoundError:
+            return True
+        if now_ns - signature[0] < self.settle_time * 1e9:
+            return False
+        with self._lock:
+            if signature in (self.checkpoint.files.get(path), self._queued.get(path)):
+                return True
+            self._queued[path] = signature
+        # Blocks while the queue is full: backpressure on the scanner
+        while not self.stop.is_set():
+            try:
+                self.queue.put((path, signature), timeout=0.5)
+                break
+            except queue.Full:
+                pass
+        return True
+
+    def run(self):
+        while not self.stop.is_set():
+            self.scan_once()
+            self.stop.wait(self.poll_interval)
+
+    def committed(self, items):
+        """Record ingested (path, signature) pairs in the checkpoint and persist them."""
+        with self._lock:
+            for path, signature in items:
+                if self._queued.get(path) == signature:
+                    del self._queued[path]
+            self.checkpoint.add(items)
+
+    def release(self, items):
+        """Forget (path, signature) pairs that failed to ingest, so the next poll queues them again."""
+        with self._lock:
+            for path, signature in items:
+                if self._queued.get(path) == signature:
+                    del self._queued[path]
+            # Failures are rare, so the next poll simply lists every directory again
+            self._directories.clear()
+
+
+def _next_batch(work_queue, batch_size, max_latency, stop):
+    """Block for the first item, then collect more until the batch is full or max_latency passes."""
+    while not stop.is_set():
+        try:
+            batch = [work_queue.get(timeout=0.5)]
+            break
+        except queue.Empty:
+            continue
+    else:
+        return []
+    deadline = time.monotonic() + max_latency
+    while len(batch) < batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(work_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _ingest(batch, pool, embedding_cache, stored_urls):
+    """Prepare, encode and upsert one batch of (path, signature) pairs and persist the store and cache.
+
+    Returns (encoded, written) counts.
+    """
+    prepared = []
+    for (path, signature), future in [(item, pool.submit(prepare_image, item[0], embedding_cache)) for item in batch]:
+        try:
+            prepared.append(((path, signature), future.result()))
+        except Exception as e:
+            # Unreadable files are checkpointed too, so they are retried only once they change
+            print(f"Skipping {path}: {e}")
+    encoded, written = ingest_batch([(path, result) for (path, _), result in prepared], embedding_cache, stored_urls)
+    get_store().flush()
+    embedding_cache.save()
+    return encoded, written
+
+
+def watch_images_folder(folder_path, batch_size=32, num_workers=None, queue_size=256, poll_interval=2.0,
+                        max_latency=1.0, rescan_interval=300.0, checkpoint_path=INGEST_CHECKPOINT):
+    """Ingest new and modified images under folder_path until interrupted."""
+    num_workers = num_workers or min(8, os.cpu_count() or 1)
+    checkpoint = Checkpoint(checkpoint_path)
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, get_encoder().name)
+    stored_urls = set(get_store().get_image_urls())
+    work_queue = queue.Queue(maxsize=queue_size)
+    watcher = FolderWatcher(
+        folder_path, checkpoint, work_queue, poll_interval=poll_interval, rescan_interval=rescan_interval,
+    )
+    scanner = threading.Thread(target=watcher.run, name="ingest-scanner", daemon=True)
+    scanner.start()
+    print(f"Watching {folder_path} ({len(checkpoint.files)} files already ingested)")
+
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            while batch := _next_batch(work_queue, batch_size, max_latency, watcher.stop):
+                start = time.perf_counter()
+                for attempt in range(1, INGEST_RETRIES + 1):
+                    try:
+                        encoded, written = _ingest(batch, pool, embedding_cache, stored_urls)
+                        break
+                    except Exception as e:
+                        print(f"Ingesting {len(batch)} files failed (attempt {attempt}/{INGEST_RETRIES}): {e}")
+                        if attempt < INGEST_RETRIES:
+                            watcher.stop.wait(2 ** attempt)
+                else:
+                    watcher.release(batch)
+                    continue
+                watcher.committed(batch)
+                elapsed = time.perf_counter() - start
+                print(f"Ingested {len(batch)} files, encoded {encoded}, wrote {written} "
+                      f"in {elapsed:.2f}s, {work_queue.qsize()} queued")
+    except KeyboardInterrupt:
+        print("Stopping watcher")
+    finally:
+        watcher.stop.set()
+        scanner.join()
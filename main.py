@@ -1,13 +1,32 @@
+import asyncio
+import json
+import os
+import sys
+import time
+
+_startup_start = time.perf_counter()
+
 from fasthtml.common import *
 from pathlib import Path
+from starlette.responses import StreamingResponse
 from embeddings import (
-    get_user_favorites,
-    delete_user_favorite,
-    add_user_favorite_by_url,
-    get_similar_users,
+    aget_user_cards,
+    amutate_user_favorites,
+    aget_image_neighbors,
+    aget_recommendations,
+    start_recommendation_refresher,
+    list_users,
 )
+from store import get_cache_stats
+from thumbnails import image_routes, thumbnail_url
+from gallery import GalleryIndex
+from user_registry import UserRegistry, user_color
+from search import asearch_images, get_query_embedder
+from similarity_feed import SimilarityFeed
+from metrics import MetricsMiddleware, register_collector, render_prometheus, span
 
-app, rt = fast_app()
+# Image routes go first so they win over fast_app's catch-all static file route
+app, rt = fast_app(routes=image_routes, middleware=[Middleware(MetricsMiddleware)])
 
 # Database setup
 db = database("data/images.db")
@@ -19,47 +38,69 @@ UserImage = user_images.dataclass()
 # Image directory and categories
 image_dir = Path("static/images")
 categories = ["catsinsink", "corgi", "otters", "waterporn", "earthporn"]
-users = ["John Doe", "Jane Doe", "Bob Smith", "Sarah Lee"]
-users_dict = {"John Doe": 1, "Jane Doe": 2, "Bob Smith": 3, "Sarah Lee": 4}
-reversed_users_dict = {1: "John Doe", 2: "Jane Doe", 3: "Bob Smith", 4: "Sarah Lee"}
-user_colors = {
-    "John Doe": "#FF5733",  # Red-ish color
-    "Jane Doe": "#33FF57",  # Green-ish color
-    "Bob Smith": "#3357FF",  # Blue-ish color
-    "Sarah Lee": "#FF33A1",  # Pink-ish color
-}
-reverse_user_colors = {
-    1: "#FF5733",  # Red-ish color
-    2: "#33FF57",  # Green-ish color
-    3: "#3357FF",  # Blue-ish color
-    4: "#FF33A1",  # Pink-ish color
-}
+MAX_FAVORITES = 4
+USERS_PAGE_SIZE = int(os.environ.get("USERS_PAGE_SIZE", 12))
+# Seconds between comment lines on an idle similarity stream, so proxies keep it open
+SSE_KEEPALIVE_INTERVAL = float(os.environ.get("SSE_KEEPALIVE_INTERVAL", 15))
+
+# Users come from the store; cards are rendered one page at a time
+registry = UserRegistry(list_users, poll_interval=float(os.environ.get("USER_REGISTRY_POLL_INTERVAL", 60)))
+registry.start_watcher()
+
+# Category listings are scanned once and rendered once; only user cards are built per request
+gallery = GalleryIndex(image_dir, categories, poll_interval=float(os.environ.get("GALLERY_POLL_INTERVAL", 5)))
+gallery.start_watcher()
+# Recommendations are recomputed off the request path, only for users whose embedding changed: by the
+# refresh-recommendations command, or in this process when RECOMMENDATION_REFRESH_INTERVAL is set
+start_recommendation_refresher(float(os.environ.get("RECOMMENDATION_REFRESH_INTERVAL", 0)))
+# Similarity sections that change after a mutation are pushed to open pages over SSE
+similarity_feed = SimilarityFeed()
+
+
+def cache_metrics():
+    stats = {**(get_cache_stats() or {}), "query_embeddings": get_query_embedder().cache.stats()}
+    return [
+        (f"store_cache_{field}_total", "counter", f"Store cache {field}",
+         {(("cache", cache),): values[field] for cache, values in stats.items()})
+        for field in ("hits", "misses")
+    ]
+
+
+register_collector(cache_metrics)
+
+# Import and setup time for this worker; the data layer must not pull in torch/CLIP
+startup_time = time.perf_counter() - _startup_start
+print(f"main.py ready in {startup_time:.3f}s (torch loaded: {'torch' in sys.modules})")
 
 
 def image_item(filename, category):
     return Div(
         Img(
-            src=f"/static/images/{category.lower()}/{filename}",
+            src=f"/thumbs/100/{category.lower()}/{filename}",
             alt=filename,
             cls="category-image",
+            data_full=f"/static/images/{category.lower()}/{filename}",
         ),
         Button(
-            "...",
-            cls="quick-add-btn",
-            hx_post="/add_image",
-            hx_vals=f"{{user: '', image_path: '{category.lower()}/{filename}'}}",
+            "≈",
+            cls="more-like-this-btn",
+            title="More like this",
+            hx_get="/more_like_this",
+            hx_vals=json.dumps({"image": f"{category.lower()}/{filename}"}),
+            hx_target="#more-like-this",
         ),
+        # Opens the user picker in the page script, which posts to /add_image
+        Button("...", cls="quick-add-btn"),
         cls="image-item",
         data_path=f"{category.lower()}/{filename}",
     )
 
 
-def category_section(category):
-    images = list((image_dir / category.lower()).glob("*.jpg"))[:10]
+def category_section(category, filenames):
     return Div(
         H2(category),
         Div(
-            *[image_item(img.name, category) for img in images],
+            *[image_item(filename, category) for filename in filenames],
             cls="category-images",
             id=f"{category.lower()}-images",
         ),
@@ -67,14 +108,19 @@ def category_section(category):
     )
 
 
-def user_image(image, user):
+def user_image(image, user_id):
     return Div(
-        Img(src=f"{image['url']}", alt=f"{image['url']}", cls="user-image"),
+        Img(
+            src=thumbnail_url(image["url"], 80),
+            alt=f"{image['url']}",
+            cls="user-image",
+            data_full=f"{image['url']}",
+        ),
         Button(
             "Delete",
             cls="delete-btn",
-            hx_delete=f"/delete_image/{user}/{image['id']}",
-            hx_target=f"#{user.replace(' ', '_')}_images",
+            hx_delete=f"/delete_image/{user_id}/{image['id']}",
+            hx_target=f"#user-{user_id}-images",
             hx_swap="outerHTML",
         ),
         cls="user-image-container",
@@ -82,18 +128,13 @@ def user_image(image, user):
     )
 
 
-def user_similarity_section(name):
-    user_id = users_dict[name]
-    timestamp_results = get_similar_users(user_id)
-    similar_users = timestamp_results["results"]
-    elapsed_time = timestamp_results["elapsed_time"]
-
+def user_similarity_section(user_id, similar_users, elapsed_time):
     similar_users_html = [
         P(
-            f"{reversed_users_dict[user_id]}: {similarity:.3f}",
-            style=f"color: {reverse_user_colors[user_id]};",
+            f"{registry.name(other_id) if other_id in registry else username}: {similarity:.3f}",
+            style=f"color: {user_color(other_id)};",
         )
-        for user_id, user_name, similarity in similar_users
+        for other_id, username, similarity in similar_users
         if similarity is not None
     ]
     elapsed_time_html = P(f"DB query time: {elapsed_time:.4f} seconds")
@@ -103,41 +144,82 @@ def user_similarity_section(name):
         *similar_users_html,
         elapsed_time_html,
         cls="user-similarity",
-        id=f"{name.replace(' ', '_')}_similarity",
-        hx_swap_oob="true",
+        id=f"user-{user_id}-similarity",
     )
 
 
-def user_images_container(name):
-    user_id = users_dict[name]
-    favorites = get_user_favorites(user_id)
+def user_images_container(user_id, favorites):
     return Div(
-        *[user_image(img, name) for img in favorites],
-        id=f"{name.replace(' ', '_')}_images",
+        *[user_image(img, user_id) for img in favorites],
+        id=f"user-{user_id}-images",
         cls="user-images sortable-list",
     )
 
 
-def user_card(name):
-    username = f"@{name.lower().replace(' ', '')}"
-    user_color = user_colors[name]
+def user_card(user_id, card, elapsed_time):
+    color = user_color(user_id)
     return Div(
-        H3(name, style=f"color: {user_color};"),
-        P(username, style=f"color: {user_color};"),
-        user_images_container(name),
-        user_similarity_section(name),
+        H3(registry.name(user_id), style=f"color: {color};"),
+        P(f"@{registry.username(user_id)}", style=f"color: {color};"),
+        user_images_container(user_id, card["favorites"]),
+        user_similarity_section(user_id, card["similar"], elapsed_time),
+        Button(
+            "Recommend",
+            cls="user-select-btn",
+            hx_get=f"/recommendations/{user_id}",
+            hx_target="#recommendations",
+        ),
         cls="user-card",
-        style=f"border-color: {user_color};",
+        style=f"border-color: {color};",
+        data_user_id=str(user_id),
+    )
+
+
+def pagination(page, page_count):
+    return Nav(
+        A("« Previous", href=f"/?page={page - 1}") if page > 1 else Span("« Previous"),
+        Span(f"Page {page} of {page_count} ({len(registry)} users)"),
+        A("Next »", href=f"/?page={page + 1}") if page < page_count else Span("Next »"),
+        cls="pagination",
     )
 
 
 @rt("/")
-def get():
+async def get(page: int = 1):
+    page = min(max(page, 1), registry.page_count(USERS_PAGE_SIZE))
+    user_ids = registry.page(page, USERS_PAGE_SIZE)
+    # Favorites and neighbours of the whole page come from one batched store call
+    cards = await aget_user_cards(user_ids)
+    with span("render", component="home"):
+        return home_page(user_ids, cards, page)
+
+
+def home_page(user_ids, cards, page):
     return Titled(
         "PG VectorScale Embeddings Demo",
         Script(src="https://cdn.jsdelivr.net/npm/sortablejs@1.15.0/Sortable.min.js"),
-        Div(*[category_section(cat) for cat in categories], cls="categories-container"),
-        Div(*[user_card(name) for name in users], cls="users-container"),
+        Input(
+            type="search",
+            name="q",
+            placeholder="Search images...",
+            hx_get="/search",
+            hx_trigger="input changed delay:300ms, search",
+            hx_target="#search-results",
+            cls="search-input",
+        ),
+        Div(id="search-results"),
+        Div(id="more-like-this"),
+        Div(id="recommendations"),
+        Div(
+            *[NotStr(gallery.rendered(cat, category_section)) for cat in categories],
+            cls="categories-container",
+        ),
+        pagination(page, registry.page_count(USERS_PAGE_SIZE)),
+        Div(
+            *[user_card(user_id, cards["results"][user_id], cards["elapsed_time"]) for user_id in user_ids],
+            cls="users-container",
+            data_page=str(page),
+        ),
         Style(
             """
             body { background-color: #1a1a1a; color: #ffffff; }
@@ -152,20 +234,54 @@ def get():
             .user-image-container { position: relative; cursor: pointer; }
             .user-image { width: 80px; height: 80px; object-fit: cover; }
             .delete-btn { position: absolute; top: 0; right: 0; background-color: #ff4d4d; color: white; border: none; padding: 2px 5px; cursor: pointer; font-size: 0.8em; }
+            .more-like-this-btn { position: absolute; bottom: 0; left: 0; background-color: #3357FF; color: white; border: none; padding: 2px 5px; cursor: pointer; font-size: 0.8em; }
+            .more-like-this, .search-results, .recommendations { margin-bottom: 20px; }
+            .search-input { width: 100%; padding: 8px; margin-bottom: 20px; background-color: #2a2a2a; color: #ffffff; border: 1px solid #444; }
             .quick-add-btn { position: absolute; bottom: 0; right: 0; background-color: #4CAF50; color: white; border: none; padding: 2px 5px; cursor: pointer; font-size: 0.8em; }
             .sortable-drag { opacity: 0.5; }
             .modal { position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.7); display: flex; justify-content: center; align-items: center; z-index: 1000; }
             .modal-content { background: #2a2a2a; padding: 20px; border-radius: 5px; max-width: 90%; max-height: 90%; overflow: auto; }
             .modal-image { max-width: 100%; max-height: 80vh; object-fit: contain; }
             .user-select-btn { margin: 5px; padding: 5px 10px; background-color: #4CAF50; color: white; border: none; cursor: pointer; }
+            .pagination { display: flex; gap: 20px; align-items: center; margin-top: 40px; }
+            .pagination a { color: #4CAF50; }
         """
         ),
         Script(
             """
             document.addEventListener('DOMContentLoaded', function() {
+                // Similarity sections of this page's users are replaced as the server pushes changes
+                const page = document.querySelector('.users-container').dataset.page;
+                const similarityStream = new EventSource(`/similarity/stream?page=${page}`);
+                similarityStream.addEventListener('similarity', function(e) {
+                    const template = document.createElement('template');
+                    template.innerHTML = e.data;
+                    Array.from(template.content.children).forEach(section => {
+                        const current = document.getElementById(section.id);
+                        if (current) current.replaceWith(section);
+                    });
+                });
+
                 const categoryLists = document.querySelectorAll('.category-images');
                 const userLists = document.querySelectorAll('.sortable-list');
 
+                // Drops arriving within a short window are sent as one bulk request per user
+                const pendingAdds = {};
+                function queueAdd(list, imagePath) {
+                    const userId = list.closest('.user-card').dataset.userId;
+                    const pending = pendingAdds[userId] || (pendingAdds[userId] = { paths: [], timer: null });
+                    pending.paths.push(imagePath);
+                    clearTimeout(pending.timer);
+                    pending.timer = setTimeout(function() {
+                        delete pendingAdds[userId];
+                        htmx.ajax('POST', `/favorites/${userId}`, {
+                            target: `#${list.id}`,
+                            swap: 'outerHTML',
+                            values: { add: pending.paths }
+                        });
+                    }, 200);
+                }
+
                 categoryLists.forEach(list => {
                     new Sortable(list, {
                         group: {
@@ -186,13 +302,7 @@ def get():
                         },
                         animation: 150,
                         onAdd: function(evt) {
-                            const imagePath = evt.item.dataset.path;
-                            const userName = evt.to.id.replace('_images', '').replace('_', ' ');
-                            htmx.ajax('POST', '/add_image', {
-                                target: evt.to,
-                                swap: 'outerHTML',
-                                values: { user: userName, image_path: imagePath }
-                            });
+                            queueAdd(evt.to, evt.item.dataset.path);
                             evt.item.remove();  // Remove the cloned item
                         }
                     });
@@ -221,7 +331,7 @@ def get():
                 document.body.addEventListener('click', function(e) {
                     const img = e.target.closest('img');
                     if (img && (img.classList.contains('category-image') || img.classList.contains('user-image'))) {
-                        showImageModal(img.src, img.alt);
+                        showImageModal(img.dataset.full || img.src, img.alt);
                     }
 
                     if (e.target.classList.contains('quick-add-btn')) {
@@ -236,7 +346,7 @@ def get():
                             <div class="modal-content">
                                 <h3>Select a user to add the image to:</h3>
                                 ${Array.from(userCards).map(card => `
-                                    <button class="user-select-btn" data-user="${card.querySelector('h3').textContent}">${card.querySelector('h3').textContent}</button>
+                                    <button class="user-select-btn" data-user-id="${card.dataset.userId}">${card.querySelector('h3').textContent}</button>
                                 `).join('')}
                             </div>
                         `;
@@ -252,13 +362,13 @@ def get():
                         // Add event listeners to user selection buttons
                         modal.querySelectorAll('.user-select-btn').forEach(btn => {
                             btn.addEventListener('click', function() {
-                                const userName = this.dataset.user;
-                                const userImagesContainer = document.getElementById(`${userName.replace(' ', '_')}_images`);
+                                const userId = this.dataset.userId;
+                                const userImagesContainer = document.getElementById(`user-${userId}-images`);
                                 
                                 htmx.ajax('POST', '/add_image', {
                                     target: userImagesContainer,
                                     swap: 'outerHTML',
-                                    values: { user: userName, image_path: imagePath }
+                                    values: { user: userId, image_path: imagePath }
                                 });
 
                                 modal.remove();
@@ -273,32 +383,163 @@ def get():
 
 
 @rt("/add_image")
-def post(user: str, image_path: str):
-    user_id = users_dict[user]
-    favorites = get_user_favorites(user_id)
-    if len(favorites) >= 4:
-        return user_images_container(user), user_similarity_section(user)
-    if not any(img["url"] == image_path for img in favorites):
-        add_user_favorite_by_url(user_id=user_id, url=f"./static/images/{image_path}")
-    return (
-        user_images_container(user),
-        *[user_similarity_section(name) for name in users],
+async def post(user: int, image_path: str):
+    return await mutate_favorites(user, add=[image_path])
+
+
+@rt("/delete_image/{user_id}/{image_id}")
+async def delete(user_id: int, image_id: int):
+    return await mutate_favorites(user_id, remove=[image_id])
+
+
+@rt("/favorites/{user_id}")
+async def post(req, user_id: int):
+    """Apply a burst of adds (image paths under static/images) and removes (image ids) in one round trip.
+
+    Accepts a JSON body {"add": [...], "remove": [...]} or repeated `add` and `remove` form fields.
+    """
+    if req.headers.get("content-type", "").startswith("application/json"):
+        try:
+            body = await req.json()
+        except ValueError:
+            return Response("Body is not valid JSON", status_code=400)
+        if not isinstance(body, dict):
+            return Response('Expected a JSON object {"add": [...], "remove": [...]}', status_code=400)
+        add, remove = body.get("add", []), body.get("remove", [])
+    else:
+        form = await req.form()
+        add, remove = form.getlist("add"), form.getlist("remove")
+    if not isinstance(add, list) or not all(isinstance(path, str) for path in add):
+        return Response("`add` must be a list of image paths", status_code=400)
+    # bool is a subclass of int, so true would otherwise remove image 1
+    if not isinstance(remove, list) or not all(type(image_id) in (int, str) for image_id in remove):
+        return Response("`remove` must be a list of image ids", status_code=400)
+    try:
+        remove = [int(image_id) for image_id in remove]
+    except ValueError:
+        return Response("`remove` must be a list of image ids", status_code=400)
+    return await mutate_favorites(user_id, add=add, remove=remove)
+
+
+async def mutate_favorites(user_id, add=(), remove=()):
+    """Apply favorite changes in one store call and render the user's favorites.
+
+    Similarity sections that change as a result reach open pages through the
+    similarity stream rather than this response.
+    """
+    if user_id not in registry:
+        return Response(f"Unknown user {user_id}", status_code=404)
+    result = await amutate_user_favorites(
+        user_id, add_urls=[f"./static/images/{path}" for path in add], remove_image_ids=remove,
+        max_favorites=MAX_FAVORITES,
+    )
+    if result["added"] or result["removed"]:
+        similarity_feed.notify([user_id])
+    with span("render", component="user_images_container"):
+        return user_images_container(user_id, result["favorites"])
+
+
+def sse_message(event, data):
+    """One server-sent event; every line of a multi-line payload needs its own data field."""
+    return f"event: {event}\n" + "".join(f"data: {line}\n" for line in data.splitlines()) + "\n"
+
+
+@rt("/similarity/stream")
+async def get(page: int = 1):
+    """Server-sent events carrying the similarity sections of a page's users whenever they change."""
+    subscription = await similarity_feed.subscribe(registry.page(page, USERS_PAGE_SIZE))
+
+    async def events():
+        try:
+            while True:
+                try:
+                    changes, elapsed_time = await asyncio.wait_for(subscription.get(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                with span("render", component="user_similarity_section"):
+                    html = "".join(
+                        to_xml(user_similarity_section(user_id, similar, elapsed_time)) for user_id, similar in changes.items()
+                    )
+                yield sse_message("similarity", html)
+        finally:
+            similarity_feed.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# The image is a query parameter because paths ending in .jpg belong to fast_app's static route
+@rt("/more_like_this")
+async def get(image: str):
+    """Nearest images to a gallery image, read from the precomputed neighbour graph."""
+    neighbors = await aget_image_neighbors(f"./static/images/{image}")
+    with span("render", component="more_like_this"):
+        if not neighbors:
+            return Div(P(f"No neighbours stored for {image} yet."), cls="more-like-this")
+        return scored_images(f"More like {image}", neighbors, "more-like-this")
+
+
+@rt("/search")
+async def get(q: str = "", limit: int = 20):
+    """Images matching a text query, nearest first."""
+    if not q.strip():
+        return Div(cls="search-results")
+    results = await asearch_images(q, min(limit, 100))
+    with span("render", component="search_results"):
+        return scored_images(f"Results for \"{q}\"", results, "search-results")
+
+
+@rt("/recommendations/{user_id}")
+async def get(user_id: int):
+    """A user's precomputed recommendations: one read of the stored list."""
+    if user_id not in registry:
+        return Response(f"Unknown user {user_id}", status_code=404)
+    recommendations = await aget_recommendations(user_id)
+    name = registry.name(user_id)
+    with span("render", component="recommendations"):
+        if not recommendations:
+            return Div(P(f"No recommendations for {name} yet."), cls="recommendations")
+        return scored_images(f"Recommended for {name}", recommendations, "recommendations", score_key="score")
+
+
+def scored_images(title, images, cls, score_key="similarity"):
+    """Thumbnail grid of scored {"url", score_key} results, opening the original in the modal."""
+    return Div(
+        H3(title),
+        Div(
+            *[
+                Div(
+                    Img(src=thumbnail_url(image["url"], 100), alt=image["url"], cls="category-image", data_full=image["url"]),
+                    P(f"{image[score_key]:.3f}"),
+                    cls="image-item",
+                )
+                for image in images
+            ],
+            cls="category-images",
+        ),
+        cls=cls,
     )
 
 
-@rt("/delete_image/{user}/{image_id}")
-def delete(user: str, image_id: int):
-    user_id = users_dict[user]
-    delete_user_favorite(user_id=user_id, image_id=image_id)
-    return (
-        user_images_container(user),
-        *[user_similarity_section(name) for name in users],
-    )
+@rt("/gallery/refresh")
+def post():
+    gallery.refresh()
+    return JSONResponse({category: len(gallery.images(category)) for category in categories})
+
 
+@rt("/users/refresh")
+def post():
+    return JSONResponse({"users": registry.refresh()})
 
-@rt("/static/images/{category}/{filename}")
-def serve_image(category: str, filename: str):
-    return FileResponse(image_dir / category / filename)
+
+@rt("/metrics")
+def get():
+    return Response(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@rt("/cache_stats")
+def get():
+    return JSONResponse(get_cache_stats())
 
 
 if __name__ == "__main__":
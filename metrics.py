@@ -0,0 +1,160 @@
+"""Lightweight timers, counters and a Prometheus text exporter.
+
+    with span("sql", statement="similar_users"):
+        ...
+    inc("images_encoded_total", len(batch))
+
+Spans feed the `span_duration_seconds` histogram, labelled by span name and
+any extra labels. With METRICS_ENABLED=0, span() returns a shared no-op
+context manager and inc() returns immediately.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+
+# Latency buckets in seconds, from sub-millisecond queries to multi-second encodes
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NULL_SPAN = nullcontext()
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_counters = {}  # (name, labels) -> value
+_help = {
+    "span_duration_seconds": "Duration of instrumented operations",
+    "http_request_duration_seconds": "Duration of HTTP requests",
+}
+_collectors = []
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    """Record one observation in a latency histogram."""
+    if not METRICS_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[bisect_left(BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+
+def inc(name, value=1, **labels):
+    """Add to a counter."""
+    if not METRICS_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+class _Span:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe("span_duration_seconds", time.perf_counter() - self.start, span=self.name, **self.labels)
+
+
+def span(name, **labels):
+    """Context manager timing a block into span_duration_seconds{span=name}."""
+    if not METRICS_ENABLED:
+        return _NULL_SPAN
+    return _Span(name, labels)
+
+
+def register_collector(collect):
+    """Add a callable returning (name, type, help, {labels dict as tuple: value}) tuples at scrape time."""
+    _collectors.append(collect)
+
+
+def _escape(value):
+    """A label value escaped for the text format: backslash, double quote and newline."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {key: list(values) for key, values in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for name in sorted({name for name, _ in histograms}):
+        lines += [f"# HELP {name} {_help.get(name, name)}", f"# TYPE {name} histogram"]
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), values):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    for name in sorted({name for name, _ in counters}):
+        lines += [f"# HELP {name} {_help.get(name, name)}", f"# TYPE {name} counter"]
+        lines += [f"{name}{_format_labels(labels)} {value}" for (metric, labels), value in sorted(counters.items()) if metric == name]
+    for collect in _collectors:
+        for name, kind, help_text, samples in collect():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in samples.items()]
+    return "\n".join(lines) + "\n"
+
+
+HTTP_METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request, labelled by method, first path segment and status.
+
+    Requests that matched no route or ended in a 404 are labelled route="other",
+    so scanners probing random paths add no series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Only the first segment, so ids and filenames do not explode label cardinality;
+            # the router adds "endpoint" to the scope when a route matched
+            if "endpoint" in scope and status["code"] != 404:
+                route = "/" + scope["path"].lstrip("/").split("/", 1)[0]
+            else:
+                route = "other"
+            method = scope["method"] if scope["method"] in HTTP_METHODS else "other"
+            observe("http_request_duration_seconds", time.perf_counter() - start,
+                    method=method, route=route, status=status["code"])
@@ -0,0 +1,830 @@
+import os
+import tempfile
+import threading
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are not checked
+    fcntl = None
+from ann import IVFIndex, top_k_indices, top_k_rows
+from quantize import approximate_scores, code_shape, quantize
+from store import ANN, ANN_NLIST, ANN_NPROBE, EMBEDDING_DIM, QUANTIZATION, RESCORE_FACTOR, VectorStore
+
+ANN_METHODS = ("exact", "ivf")
+# Favorite changes logged since the last full save before flush() rewrites the .npz instead of appending
+FAVORITE_LOG_COMPACT = 10000
+
+# Lock path -> open lock file, for every store file this process has claimed to write
+_writer_locks = {}
+_writer_locks_lock = threading.Lock()
+
+
+def _claim_writer(path):
+    """Hold the single-writer lock of a store file until the process exits; RuntimeError if another process has it."""
+    lock_path = f"{os.path.abspath(path)}.lock"
+    with _writer_locks_lock:
+        if fcntl is None or lock_path in _writer_locks:
+            return
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        lock_file = open(lock_path, "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.seek(0)
+            owner = lock_file.read().strip() or "unknown"
+            lock_file.close()
+            raise RuntimeError(
+                f"{path} is being written by another process (pid {owner}); the numpy store has a single writer, "
+                "so stop it first or use the Postgres store"
+            ) from None
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        _writer_locks[lock_path] = lock_file
+
+
+class _Matrix:
+    """Row-appendable contiguous matrix that grows by doubling its capacity.
+
+    With a `spill` directory the rows live in a memory-mapped temporary file
+    there rather than in process memory, so only the pages being read stay
+    resident and the kernel can write the rest back and drop them.
+    """
+
+    def __init__(self, dim, rows=None, dtype=np.float32, spill=None, capacity=0):
+        rows = np.zeros((0, dim), dtype=dtype) if rows is None else np.asarray(rows, dtype=dtype)
+        self.spill = spill
+        self._data = self._allocate(max(len(rows), capacity, 16), dim, dtype)
+        self._data[:len(rows)] = rows
+        self.size = len(rows)
+
+    def _allocate(self, capacity, dim, dtype):
+        if self.spill is None:
+            return np.zeros((capacity, dim), dtype=dtype)
+        # Unlinked as soon as it is created; the mapping keeps it alive
+        with tempfile.TemporaryFile(dir=self.spill) as f:
+            return np.memmap(f, dtype=dtype, mode="w+", shape=(capacity, dim))
+
+    @classmethod
+    def wrap(cls, rows, spill=None):
+        """A matrix over an existing array, such as a memory map, used in place until it has to grow."""
+        matrix = cls.__new__(cls)
+        matrix.spill = spill
+        matrix._data = rows
+        matrix.size = len(rows)
+        return matrix
+
+    @property
+    def rows(self):
+        return self._data[:self.size]
+
+    @property
+    def mapped(self):
+        return isinstance(self._data, np.memmap)
+
+    def _reserve(self, size):
+        if size > len(self._data):
+            grown = self._allocate(max(2 * len(self._data), size, 16), self._data.shape[1], self._data.dtype)
+            grown[:self.size] = self.rows
+            self._data = grown
+
+    def append(self, row):
+        self._reserve(self.size + 1)
+        self._data[self.size] = row
+        self.size += 1
+        return self.size - 1
+
+    def put(self, rows, values):
+        """Overwrite the given rows, growing the matrix to cover rows past the end; a repeated row keeps its last value."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        self._reserve(int(rows.max()) + 1)
+        self.size = max(self.size, int(rows.max()) + 1)
+        self._data[rows] = np.asarray(values).reshape(len(rows), -1)
+
+
+def _normalize(rows):
+    """Rows scaled to unit length; zero rows stay zero."""
+    rows = np.asarray(rows, dtype=np.float32)
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    return rows / np.where(norms > 0, norms, 1)
+
+
+class NumpyStore(VectorStore):
+    """In-process VectorStore keeping embeddings in contiguous float32 matrices.
+
+    User similarity is a single matrix-vector product over unit-normalised
+    favorite sums followed by an argpartition top-k. State is persisted to a
+    single .npz file on flush() when `path` is given. Favorite changes alone
+    only append a line each to a log next to it (`<path>.favorites.log`),
+    replayed on load, so a click does not rewrite the image matrix; the .npz
+    absorbs the log on the next full save.
+
+    One process at a time may write the file: the first change a process
+    makes takes an exclusive lock on `<path>.lock`, held until it exits, and
+    changes in any other process raise RuntimeError rather than being lost
+    when both rewrite the .npz. Other processes can still load the file to
+    read it, as of when they loaded it, so ingesting while the web server
+    takes favorites needs the Postgres store.
+
+    With a `quantization` other than float32, similar-user and image scans
+    run over compact codes of the unit vectors (see quantize.py), and only the
+    best `rescore_factor * limit` candidates are rescored in full precision.
+    The codes are the only vectors kept in process memory then: full-precision
+    rows live in memory-mapped files next to `path` (or in the temp
+    directory), which the rescoring reads a few rows of at a time.
+
+    With `ann="ivf"`, similar users and image search probe `nprobe` buckets of
+    an IVF index (see ann.py) instead, scoring the candidates in full
+    precision; quantization then only applies to exact scans. Indexes are
+    trained on first use and retrained once their rows have doubled.
+
+    With a `snapshot` directory (see snapshots.py) whose images match the
+    .npz, the image matrix is mapped copy-on-write from the snapshot instead
+    of being read into memory, so a new process starts without loading it.
+    """
+
+    def __init__(self, path=None, dim=EMBEDDING_DIM, quantization=QUANTIZATION, rescore_factor=RESCORE_FACTOR,
+                 ann=ANN, nlist=ANN_NLIST, nprobe=ANN_NPROBE, snapshot=None):
+        if ann not in ANN_METHODS:
+            raise ValueError(f"Unknown ANN method {ann!r}, expected one of {ANN_METHODS}")
+        self.path = path
+        self.dim = dim
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        self.ann = ann
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.snapshot = snapshot
+        self._code_dtype, self._code_width = code_shape(quantization, dim)
+        # Directory of the memory-mapped full-precision rows, None to keep them in memory
+        self._spill = None
+        if quantization != "float32":
+            self._spill = os.path.dirname(os.path.abspath(path)) if path else tempfile.gettempdir()
+        self._lock = threading.RLock()
+        self._dirty = False  # state beyond favorites changed, so flush() rewrites the .npz
+        self._favorite_changes = []  # ("+" or "-", user id, image id, user version) not yet logged
+        self._logged = 0  # lines in the favorites log
+
+        self._image_ids = []
+        self._image_urls = []
+        self._image_versions = []  # bumped when a url is re-ingested with a different embedding
+        self._image_rows = {}  # image id -> row
+        self._url_rows = {}  # url -> row
+        self._images = _Matrix(dim, spill=self._spill)
+        # Materialised image k-NN graph: neighbour rows (-1 when absent) and cosine similarities, best first
+        self._neighbors = None
+        self._neighbor_sims = None
+        self._units = None  # unit-normalised image embeddings, built on first use and kept up to date
+        self._image_codes, self._image_scales = self._code_matrices(0)
+        self._image_index = None
+        self._user_index = None
+
+        self._user_ids = []
+        self._usernames = []
+        self._display_names = []  # "" when unset
+        self._user_rows = {}  # user id -> row
+        self._user_units = _Matrix(dim, spill=self._spill)  # sum / ||sum||, zero for users without favorites
+        self._user_norms = []  # ||sum||, so units * norms is the running sum of favorite embeddings
+        self._user_counts = []
+        self._user_versions = []  # bumped on every embedding change
+        self._favorites = {}  # user id -> set of image ids
+        self._recommendations = {}  # user id -> (embedding version, image rows, scores)
+        self._user_codes, self._user_scales = self._code_matrices(0)
+
+        if path and os.path.exists(path):
+            self._load(path)
+
+    def _code_matrices(self, size):
+        """(codes, int8 scales) matrices of `size` zero rows; empty when scans run in float32."""
+        if self.quantization == "float32":
+            size = 0
+        return (
+            _Matrix(self._code_width, np.zeros((size, self._code_width)), dtype=self._code_dtype),
+            _Matrix(1, np.zeros((size, 1))),
+        )
+
+    def _put_codes(self, codes, scales, rows, units):
+        if self.quantization != "float32":
+            row_codes, row_scales = quantize(units, self.quantization)
+            codes.put(rows, row_codes)
+            scales.put(rows, np.zeros(len(rows)) if row_scales is None else row_scales)
+
+    def _claim(self):
+        """Called before the first change: refuse it if another process writes the file."""
+        if self.path:
+            _claim_writer(self.path)
+
+    def initialize_users(self, usernames, display_names=None):
+        with self._lock:
+            self._claim()
+            known = {username: row for row, username in enumerate(self._usernames)}
+            for username, display_name in zip(usernames, display_names or [None] * len(usernames)):
+                row = known.get(username)
+                if row is None:
+                    known[username] = self._user_rows[self._add_user(username, display_name)]
+                elif display_name and not self._display_names[row]:
+                    self._display_names[row] = display_name
+                    self._dirty = True
+
+    def list_users(self):
+        with self._lock:
+            return [
+                (user_id, username, display_name or None)
+                for user_id, username, display_name in zip(self._user_ids, self._usernames, self._display_names)
+            ]
+
+    def _add_user(self, username, display_name=None):
+        user_id = (self._user_ids[-1] if self._user_ids else 0) + 1
+        self._user_rows[user_id] = self._user_units.append(np.zeros(self.dim, dtype=np.float32))
+        self._user_norms.append(0.0)
+        if self.quantization != "float32":
+            self._user_codes.append(0)
+            self._user_scales.append(0)
+        self._user_ids.append(user_id)
+        self._usernames.append(username)
+        self._display_names.append(display_name or "")
+        self._user_counts.append(0)
+        self._user_versions.append(0)
+        self._favorites[user_id] = set()
+        self._dirty = True
+        return user_id
+
+    def add_images(self, rows):
+        with self._lock:
+            self._claim()
+            changed = []
+            for url, embedding in rows:
+                row = self._url_rows.get(url)
+                if row is None:
+                    image_id = (self._image_ids[-1] if self._image_ids else 0) + 1
+                    row = self._images.append(embedding)
+                    self._image_ids.append(image_id)
+                    self._image_urls.append(url)
+                    self._image_versions.append(0)
+                    self._image_rows[image_id] = row
+                    self._url_rows[url] = row
+                elif np.array_equal(self._images.rows[row], np.asarray(embedding, dtype=np.float32)):
+                    continue
+                else:
+                    self._images.rows[row] = embedding
+                    self._image_versions[row] += 1
+                changed.append(row)
+                self._dirty = True
+            if changed:
+                self._update_image_units(changed)
+
+    def _update_image_units(self, rows):
+        """Bring the unit vectors, codes and index entries of changed or appended image rows up to date."""
+        if self._units is None and self.quantization == "float32":
+            return  # built from scratch on first use
+        units = _normalize(self._images.rows[rows])
+        if self._units is not None:
+            self._units.put(rows, units)
+        self._put_codes(self._image_codes, self._image_scales, rows, units)
+        if self._image_index is not None:
+            self._image_index.assign(rows, units)
+
+    def get_image_urls(self):
+        with self._lock:
+            return list(self._image_urls)
+
+    def add_user_favorite(self, user_id, image_id):
+        with self._lock:
+            self._claim()
+            favorites = self._favorites.get(user_id)
+            if favorites is None or image_id not in self._image_rows or image_id in favorites:
+                return False
+            favorites.add(image_id)
+            self._apply_delta(user_id, self._images.rows[self._image_rows[image_id]], 1)
+            self._log_favorite("+", user_id, image_id)
+            return True
+
+    def add_user_favorite_by_url(self, user_id, url):
+        with self._lock:
+            row = self._url_rows.get(url)
+            if row is None:
+                return None, False
+            image_id = self._image_ids[row]
+            return image_id, self.add_user_favorite(user_id, image_id)
+
+    def image_id_by_url(self, url):
+        with self._lock:
+            row = self._url_rows.get(url)
+            return None if row is None else self._image_ids[row]
+
+    def mutate_favorites(self, user_id, add_urls=(), remove_image_ids=(), max_favorites=None):
+        # The base implementation is atomic here because the lock is reentrant
+        with self._lock:
+            return super().mutate_favorites(user_id, add_urls, remove_image_ids, max_favorites)
+
+    def delete_user_favorite(self, user_id, image_id):
+        with self._lock:
+            self._claim()
+            favorites = self._favorites.get(user_id)
+            if not favorites or image_id not in favorites:
+                return False
+            favorites.remove(image_id)
+            self._apply_delta(user_id, self._images.rows[self._image_rows[image_id]], -1)
+            self._log_favorite("-", user_id, image_id)
+            return True
+
+    def _apply_delta(self, user_id, embedding, sign):
+        row = self._user_rows[user_id]
+        self._user_counts[row] += sign
+        total = self._user_units.rows[row] * self._user_norms[row] + sign * embedding
+        self._set_user_sum(row, total if self._user_counts[row] else 0)
+
+    def _log_favorite(self, op, user_id, image_id):
+        self._favorite_changes.append((op, user_id, image_id, self._user_versions[self._user_rows[user_id]]))
+
+    def _set_user_sum(self, row, total):
+        self._user_versions[row] += 1
+        norm = float(np.linalg.norm(total))
+        if not self._user_counts[row] or norm == 0:
+            norm = 0.0
+        self._user_units.rows[row] = np.asarray(total) / norm if norm else 0
+        self._user_norms[row] = norm
+        if self._user_index is not None:
+            self._user_index.assign([row], self._user_units.rows[row:row + 1])
+        self._put_codes(self._user_codes, self._user_scales, [row], self._user_units.rows[row:row + 1])
+
+    def _rebuild_user_sum(self, user_id):
+        row = self._user_rows[user_id]
+        image_rows = sorted(self._image_rows[image_id] for image_id in self._favorites[user_id])
+        self._user_counts[row] = len(image_rows)
+        self._set_user_sum(row, self._images.rows[image_rows].sum(axis=0) if image_rows else 0)
+
+    def update_user_embedding(self, user_id):
+        with self._lock:
+            self._claim()
+            self._rebuild_user_sum(user_id)
+            self._dirty = True
+
+    def rebuild_user_embeddings(self):
+        with self._lock:
+            self._claim()
+            for user_id in self._user_ids:
+                self._rebuild_user_sum(user_id)
+            self._dirty = True
+            return len(self._user_ids)
+
+    def _approximate(self, search_params):
+        return self.ann == "ivf" and not (search_params or {}).get("exact")
+
+    def _trained(self, index, vectors):
+        if index is None or len(vectors) > 2 * index.trained_size:
+            index = IVFIndex.train(vectors, self.nlist or None)
+        return index
+
+    def get_similar_users(self, target_user_id, limit, search_params=None):
+        if (self.quantization != "float32" and not (search_params or {}).get("exact")) or self._approximate(search_params):
+            return self.get_similar_users_bulk([target_user_id], limit, search_params)[target_user_id]
+        with self._lock:
+            target_row = self._user_rows.get(target_user_id)
+            if target_row is None or not self._user_counts[target_row]:
+                return []
+            units = self._user_units.rows
+            scores = units @ units[target_row]
+            # Exclude the target and users without an embedding, like the IS NOT NULL filters in SQL
+            scores[np.asarray(self._user_counts) == 0] = -np.inf
+            scores[target_row] = -np.inf
+            rows = top_k_indices(scores, min(limit, int(np.isfinite(scores).sum())))
+            return [(self._user_ids[row], self._usernames[row], float(scores[row])) for row in rows]
+
+    def get_similar_users_bulk(self, user_ids, limit, search_params=None):
+        with self._lock:
+            results = {user_id: [] for user_id in user_ids}
+            targets = [
+                (user_id, self._user_rows[user_id]) for user_id in results
+                if user_id in self._user_rows and self._user_counts[self._user_rows[user_id]]
+            ]
+            if not targets:
+                return results
+            target_rows = np.asarray([row for _, row in targets])
+            units = self._user_units.rows
+            if self._approximate(search_params):
+                self._user_index = self._trained(self._user_index, units)
+                nprobe = search_params.get("nprobe", self.nprobe) if search_params else self.nprobe
+                # One extra candidate, since the target itself is usually its own best match
+                for (user_id, target_row), (rows, row_scores) in zip(
+                    targets, self._user_index.search(units, units[target_rows], limit + 1, nprobe)
+                ):
+                    results[user_id] = [
+                        (self._user_ids[row], self._usernames[row], float(score))
+                        for row, score in zip(rows, row_scores) if row != target_row
+                    ][:limit]
+                return results
+            quantization = "float32" if (search_params or {}).get("exact") else self.quantization
+            if quantization == "float32":
+                scores = units[target_rows] @ units.T
+            else:
+                scores = approximate_scores(
+                    self._user_codes.rows, self._user_scales.rows[:, 0], units[target_rows], quantization
+                )
+            scores[:, np.asarray(self._user_counts) == 0] = -np.inf
+            scores[np.arange(len(targets)), target_rows] = -np.inf
+            if quantization == "float32":
+                candidates = top_k_rows(scores, limit)
+            else:
+                # Shortlist on the codes, then rank the shortlist by exact cosine similarity
+                shortlist = top_k_rows(scores, self.rescore_factor * limit)
+                valid = np.isfinite(np.take_along_axis(scores, shortlist, axis=1))
+                scores = np.full(scores.shape, -np.inf, dtype=np.float32)
+                exact = np.einsum("qd,qkd->qk", units[target_rows], units[shortlist])
+                np.put_along_axis(scores, shortlist, np.where(valid, exact, -np.inf), axis=1)
+                candidates = np.take_along_axis(shortlist, top_k_rows(np.where(valid, exact, -np.inf), limit), axis=1)
+            for (user_id, _), row_scores, rows in zip(targets, scores, candidates):
+                results[user_id] = [
+                    (self._user_ids[row], self._usernames[row], float(row_scores[row]))
+                    for row in rows if np.isfinite(row_scores[row])
+                ]
+            return results
+
+    def memory_usage(self):
+        """Bytes of vectors in process memory, in memory-mapped files, and of the user vectors scanned per query."""
+        with self._lock:
+            usage = {"resident": 8 * len(self._user_norms), "mapped": 0}
+            matrices = (self._images, self._units, self._image_codes, self._image_scales,
+                        self._user_units, self._user_codes, self._user_scales)
+            for matrix in filter(None, matrices):
+                usage["mapped" if matrix.mapped else "resident"] += matrix.rows.nbytes
+            if self.quantization == "float32":
+                usage["scanned_per_query"] = self._user_units.rows.nbytes
+            else:
+                scales = self._user_scales.rows.nbytes if self.quantization == "int8" else 0
+                usage["scanned_per_query"] = self._user_codes.rows.nbytes + scales
+            return usage
+
+    def get_user_favorites(self, user_id):
+        with self._lock:
+            return [
+                {"id": image_id, "url": self._image_urls[self._image_rows[image_id]]}
+                for image_id in sorted(self._favorites.get(user_id, ()))
+            ]
+
+    def get_user_cards(self, user_ids, limit):
+        # One lock hold, so favorites and neighbours come from the same state
+        with self._lock:
+            return super().get_user_cards(user_ids, limit)
+
+    def _image_units(self, block=8192):
+        if self._units is None:
+            images = self._images.rows
+            self._units = _Matrix(self.dim, spill=self._spill, capacity=len(images))
+            for start in range(0, len(images), block):
+                self._units.put(np.arange(start, min(start + block, len(images))), _normalize(images[start:start + block]))
+        return self._units.rows
+
+    def _build_image_codes(self, block=8192):
+        units = self._image_units()
+        self._image_codes, self._image_scales = self._code_matrices(0)
+        for start in range(0, len(units), block):
+            rows = np.arange(start, min(start + block, len(units)))
+            self._put_codes(self._image_codes, self._image_scales, rows, units[start:start + block])
+
+    def _nearest_images(self, embedding, limit, search_params=None):
+        """(rows, scores) of the `limit` images nearest an embedding, best first."""
+        units = self._image_units()
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self._approximate(search_params):
+            self._image_index = self._trained(self._image_index, units)
+            nprobe = search_params.get("nprobe", self.nprobe) if search_params else self.nprobe
+            [(rows, scores)] = self._image_index.search(units, embedding, limit, nprobe)
+            return rows, scores
+        if self.quantization != "float32" and not (search_params or {}).get("exact"):
+            # Shortlist on the resident codes, then rescore the few mapped full-precision rows it names
+            approximate = approximate_scores(
+                self._image_codes.rows, self._image_scales.rows[:, 0], embedding, self.quantization
+            )[0]
+            shortlist = np.sort(top_k_indices(approximate, self.rescore_factor * limit))
+            exact = units[shortlist] @ embedding
+            best = top_k_indices(exact, limit)
+            return shortlist[best], exact[best]
+        scores = units @ embedding
+        rows = top_k_indices(scores, limit)
+        return rows, scores[rows]
+
+    def search_images(self, embedding, limit, search_params=None):
+        with self._lock:
+            rows, scores = self._nearest_images(embedding, limit, search_params)
+            return [
+                {"id": self._image_ids[row], "url": self._image_urls[row], "similarity": float(score)}
+                for row, score in zip(rows, scores)
+            ]
+
+    def _store_neighbors(self, units, rows, k, block=1024):
+        """Recompute the neighbour lists of the given image rows, block by block."""
+        for start in range(0, len(rows), block):
+            block_rows = rows[start:start + block]
+            scores = units[block_rows] @ units.T
+            scores[np.arange(len(block_rows)), block_rows] = -np.inf
+            top = top_k_rows(scores, k)
+            sims = np.take_along_axis(scores, top, axis=1)
+            self._neighbors[block_rows] = -1
+            self._neighbor_sims[block_rows] = -np.inf
+            self._neighbors[block_rows, :top.shape[1]] = np.where(np.isfinite(sims), top, -1)
+            self._neighbor_sims[block_rows, :top.shape[1]] = sims
+
+    def rebuild_image_neighbors(self, k):
+        with self._lock:
+            self._claim()
+            units = self._image_units()
+            self._neighbors = np.full((len(units), k), -1, dtype=np.int32)
+            self._neighbor_sims = np.full((len(units), k), -np.inf, dtype=np.float32)
+            self._store_neighbors(units, np.arange(len(units)), k)
+            self._dirty = True
+            return len(units)
+
+    def update_image_neighbors(self, urls, k):
+        with self._lock:
+            self._claim()
+            if self._neighbors is None:
+                return
+            if self._neighbors.shape[1] != k:
+                self.rebuild_image_neighbors(k)
+                return
+            changed = np.asarray(sorted({self._url_rows[url] for url in urls if url in self._url_rows}), dtype=np.int64)
+            if not len(changed):
+                return
+            units = self._image_units()
+            missing = len(units) - len(self._neighbors)
+            if missing:
+                self._neighbors = np.vstack([self._neighbors, np.full((missing, k), -1, dtype=np.int32)])
+                self._neighbor_sims = np.vstack([self._neighbor_sims, np.full((missing, k), -np.inf, dtype=np.float32)])
+            self._store_neighbors(units, changed, k)
+            # Other lists go stale if they mention a changed image or a changed image now beats their worst entry
+            to_changed = units @ units[changed].T
+            to_changed[changed, np.arange(len(changed))] = -np.inf
+            affected = np.isin(self._neighbors, changed).any(axis=1) | (to_changed.max(axis=1) > self._neighbor_sims[:, -1])
+            affected[changed] = False
+            self._store_neighbors(units, np.flatnonzero(affected), k)
+            self._dirty = True
+
+    def get_image_neighbors(self, url, limit):
+        with self._lock:
+            row = self._url_rows.get(url)
+            if row is None or self._neighbors is None or row >= len(self._neighbors):
+                return []
+            return [
+                {"id": self._image_ids[neighbor], "url": self._image_urls[neighbor], "similarity": float(similarity)}
+                for neighbor, similarity in zip(self._neighbors[row, :limit], self._neighbor_sims[row, :limit])
+                if neighbor >= 0
+            ]
+
+    def refresh_recommendations(self, limit, candidates, neighbours, social_weight, user_ids=None, block=64):
+        """See VectorStore; the lock is held per user, not for the whole pass.
+
+        Each user's inputs are gathered under the lock (the candidate scan sees
+        the same codes and index as queries do), scored outside it, and swapped
+        in under the lock again, so searches and favorite changes interleave
+        with a long refresh. A result is dropped if the user's favorites changed
+        meanwhile; the next pass finds the user stale again.
+        """
+        with self._lock:
+            self._claim()
+            if user_ids is None:
+                user_ids = [
+                    user_id for user_id, version in zip(self._user_ids, self._user_versions)
+                    if self._recommendations.get(user_id, (None,))[0] != version
+                ]
+        for start in range(0, len(user_ids), block):
+            batch = user_ids[start:start + block]
+            # Neighbours and candidate images come from the same scans as queries, codes and index included
+            similar_users = self.get_similar_users_bulk(batch, neighbours)
+            for user_id in batch:
+                image_rows, scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+                with self._lock:
+                    row = self._user_rows[user_id]
+                    version = self._user_versions[row]
+                    rows = None
+                    if self._user_counts[row] and len(self._image_ids):
+                        target = self._user_units.rows[row].copy()
+                        social = {}
+                        for other_id, _, similarity in similar_users[user_id]:
+                            for image_id in self._favorites[other_id]:
+                                image_row = self._image_rows[image_id]
+                                social[image_row] = social.get(image_row, 0.0) + similarity
+                        nearest, _ = self._nearest_images(target, candidates)
+                        rows = set(nearest.tolist()) | set(social)
+                        rows -= {self._image_rows[image_id] for image_id in self._favorites[user_id]}
+                        rows = np.asarray(sorted(rows), dtype=np.int64)
+                        # Fancy indexing copies, so the scoring below reads nothing shared
+                        units = self._image_units()[rows]
+                if rows is not None:
+                    boosts = np.asarray([social.get(image_row, 0.0) for image_row in rows], dtype=np.float32)
+                    candidate_scores = units @ target + social_weight * boosts
+                    best = top_k_indices(candidate_scores, limit)
+                    image_rows, scores = rows[best], candidate_scores[best]
+                with self._lock:
+                    if self._user_versions[self._user_rows[user_id]] == version:
+                        self._recommendations[user_id] = (version, image_rows, scores)
+                        self._dirty = True
+        return len(user_ids)
+
+    def get_recommendations(self, user_id, limit):
+        with self._lock:
+            _, image_rows, scores = self._recommendations.get(user_id, (None, (), ()))
+            return [
+                {"id": self._image_ids[image_row], "url": self._image_urls[image_row], "score": float(score)}
+                for image_row, score in zip(image_rows[:limit], scores[:limit])
+            ]
+
+    def iter_image_embeddings(self, after_id=0, batch_size=10000):
+        with self._lock:
+            # Ids grow with rows, so the images past after_id are a suffix
+            start = int(np.searchsorted(np.asarray(self._image_ids, dtype=np.int64), after_id, side="right"))
+            end = len(self._image_ids)
+        for offset in range(start, end, batch_size):
+            with self._lock:
+                stop = min(offset + batch_size, end)
+                yield (
+                    np.asarray(self._image_ids[offset:stop], dtype=np.int64),
+                    np.asarray(self._image_versions[offset:stop], dtype=np.int64),
+                    self._image_urls[offset:stop],
+                    np.array(self._images.rows[offset:stop]),
+                )
+
+    def get_image_versions(self):
+        with self._lock:
+            return np.asarray(self._image_ids, dtype=np.int64), np.asarray(self._image_versions, dtype=np.int64)
+
+    def iter_user_embeddings(self, known=None, batch_size=10000):
+        known = known or {}
+        with self._lock:
+            rows = [
+                row for row, (user_id, version) in enumerate(zip(self._user_ids, self._user_versions))
+                if known.get(user_id) != version
+            ]
+        for offset in range(0, len(rows), batch_size):
+            with self._lock:
+                batch = np.asarray(rows[offset:offset + batch_size], dtype=np.int64)
+                counts = np.asarray(self._user_counts, dtype=np.float32)[batch]
+                norms = np.asarray(self._user_norms, dtype=np.float32)[batch]
+                yield (
+                    np.asarray(self._user_ids, dtype=np.int64)[batch],
+                    np.asarray(self._user_versions, dtype=np.int64)[batch],
+                    self._user_units.rows[batch] * (norms / np.where(counts > 0, counts, 1))[:, None],
+                )
+
+    @property
+    def _log_path(self):
+        return f"{self.path}.favorites.log"
+
+    def flush(self):
+        with self._lock:
+            if not self.path:
+                return
+            if self._dirty or self._logged + len(self._favorite_changes) > FAVORITE_LOG_COMPACT:
+                self._save(self.path)
+                # The .npz now holds every favorite, so the log starts over
+                if os.path.exists(self._log_path):
+                    os.remove(self._log_path)
+                self._dirty = False
+                self._favorite_changes = []
+                self._logged = 0
+            elif self._favorite_changes:
+                with open(self._log_path, "a") as f:
+                    f.writelines(f"{op} {user_id} {image_id} {version}\n" for op, user_id, image_id, version in self._favorite_changes)
+                self._logged += len(self._favorite_changes)
+                self._favorite_changes = []
+
+    def _save(self, path):
+        favorite_pairs = [(user_id, image_id) for user_id, images in self._favorites.items() for image_id in images]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        neighbors = {} if self._neighbors is None else {"neighbors": self._neighbors, "neighbor_sims": self._neighbor_sims}
+        # Recommendations are padded to one width, with image id -1 past each user's last one
+        width = max((len(image_rows) for _, image_rows, _ in self._recommendations.values()), default=0)
+        recommended_images = np.full((len(self._recommendations), width), -1, dtype=np.int64)
+        recommended_scores = np.zeros((len(self._recommendations), width), dtype=np.float32)
+        image_ids = np.asarray(self._image_ids, dtype=np.int64)
+        for i, (_, image_rows, scores) in enumerate(self._recommendations.values()):
+            recommended_images[i, :len(image_rows)] = image_ids[image_rows]
+            recommended_scores[i, :len(scores)] = scores
+        np.savez(
+            tmp_path,
+            image_ids=image_ids,
+            image_urls=np.asarray(self._image_urls, dtype=str),
+            image_versions=np.asarray(self._image_versions, dtype=np.int64),
+            images=self._images.rows,
+            user_ids=np.asarray(self._user_ids, dtype=np.int64),
+            usernames=np.asarray(self._usernames, dtype=str),
+            display_names=np.asarray(self._display_names, dtype=str),
+            favorites=np.asarray(favorite_pairs, dtype=np.int64).reshape(-1, 2),
+            user_versions=np.asarray(self._user_versions, dtype=np.int64),
+            recommended_users=np.asarray(list(self._recommendations), dtype=np.int64),
+            recommended_versions=np.asarray([version for version, _, _ in self._recommendations.values()], dtype=np.int64),
+            recommended_images=recommended_images,
+            recommended_scores=recommended_scores,
+            **neighbors,
+        )
+        os.replace(tmp_path, path)
+
+    def _load(self, path):
+        with np.load(path) as data:
+            self._image_ids = data["image_ids"].tolist()
+            self._image_urls = data["image_urls"].tolist()
+            self._image_versions = (
+                data["image_versions"].tolist() if "image_versions" in data.files else [0] * len(self._image_ids)
+            )
+            images, units = self._snapshot_images()
+            # Without a matching snapshot the matrix is read from the .npz
+            self._images = images if images is not None else _Matrix(self.dim, data["images"], spill=self._spill)
+            self._units = units
+            self._image_index = None
+            self._user_index = None
+            self._user_ids = data["user_ids"].tolist()
+            self._usernames = data["usernames"].tolist()
+            # Files written before display names existed lack the key
+            self._display_names = data["display_names"].tolist() if "display_names" in data.files else [""] * len(self._usernames)
+            favorite_pairs = data["favorites"].tolist()
+            user_versions = data["user_versions"].tolist() if "user_versions" in data.files else None
+            if "neighbors" in data.files:
+                self._neighbors = data["neighbors"]
+                self._neighbor_sims = data["neighbor_sims"]
+            recommended = (
+                zip(data["recommended_users"].tolist(), data["recommended_versions"].tolist(),
+                    data["recommended_images"], data["recommended_scores"])
+                if "recommended_users" in data.files else ()
+            )
+        self._image_rows = {image_id: row for row, image_id in enumerate(self._image_ids)}
+        self._url_rows = {url: row for row, url in enumerate(self._image_urls)}
+        self._user_rows = {user_id: row for row, user_id in enumerate(self._user_ids)}
+        self._user_units = _Matrix(self.dim, spill=self._spill, capacity=len(self._user_ids))
+        self._user_units.size = len(self._user_ids)
+        self._user_norms = [0.0] * len(self._user_ids)
+        self._user_codes, self._user_scales = self._code_matrices(len(self._user_ids))
+        if self.quantization != "float32":
+            self._build_image_codes()
+        self._user_counts = [0] * len(self._user_ids)
+        self._user_versions = [0] * len(self._user_ids)
+        self._recommendations = {}
+        for user_id, version, image_ids, scores in recommended:
+            if user_id not in self._user_rows:
+                continue
+            kept = [(self._image_rows[image_id], score) for image_id, score in zip(image_ids.tolist(), scores.tolist())
+                    if image_id in self._image_rows]
+            self._recommendations[user_id] = (
+                version, np.asarray([row for row, _ in kept], dtype=np.int64), np.asarray([score for _, score in kept], dtype=np.float32),
+            )
+        self._favorites = {user_id: set() for user_id in self._user_ids}
+        for user_id, image_id in favorite_pairs:
+            self._favorites[user_id].add(image_id)
+        logged_versions = self._replay_favorite_log()
+        # Sums are derived data, so they are rebuilt rather than stored
+        for user_id in self._user_ids:
+            self._rebuild_user_sum(user_id)
+        if user_versions is not None:
+            # Versions carry over restarts, so snapshot exports only pick up real changes
+            self._user_versions = user_versions
+            for user_id, version in logged_versions.items():
+                self._user_versions[self._user_rows[user_id]] = version
+        self._dirty = False
+        self._favorite_changes = []
+
+    def _replay_favorite_log(self):
+        """Apply the favorite changes logged since the .npz was written. Returns {user id: last logged version}."""
+        self._logged = 0
+        versions = {}
+        if not os.path.exists(self._log_path):
+            return versions
+        with open(self._log_path) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # cut short by a crash
+                op, user_id, image_id, version = line.split()
+                user_id, image_id, version = int(user_id), int(image_id), int(version)
+                self._logged += 1
+                if user_id not in self._favorites or image_id not in self._image_rows:
+                    continue
+                if op == "+":
+                    self._favorites[user_id].add(image_id)
+                else:
+                    self._favorites[user_id].discard(image_id)
+                versions[user_id] = version
+        return versions
+
+    def _snapshot_images(self):
+        """(images, unit rows) mapped from the snapshot, or None for either it cannot provide.
+
+        The snapshot is used only when it holds exactly this store's images:
+        ids and versions must both match, so a snapshot exported before an
+        image was re-ingested is refused rather than serving its old embedding.
+        """
+        if not self.snapshot:
+            return None, None
+        from snapshots import open_snapshot
+
+        snapshot = open_snapshot(self.snapshot, mode="c")
+        if (
+            snapshot is None
+            or not np.array_equal(snapshot.image_ids, self._image_ids)
+            or not np.array_equal(snapshot.image_versions, self._image_versions)
+        ):
+            print(f"Snapshot in {self.snapshot} does not match {self.path}, loading images from the .npz instead")
+            return None, None
+        units = None if snapshot.image_units is None else _Matrix.wrap(snapshot.image_units, spill=self._spill)
+        return _Matrix.wrap(snapshot.images, spill=self._spill), units
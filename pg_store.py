@@ -0,0 +1,358 @@
+import numpy as np
+from psycopg2.extras import execute_values
+from db import apply_search_params, get_connection, execute_prepared
+from metrics import span
+from store import EMBEDDING_DIM, VectorStore
+
+
+class PostgresStore(VectorStore):
+    """VectorStore backed by Postgres with pgvector and the vectorscale diskann index."""
+
+    def create_tables(self):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    CREATE EXTENSION IF NOT EXISTS vectorscale CASCADE;
+
+                    CREATE TABLE IF NOT EXISTS users (
+                        id SERIAL PRIMARY KEY,
+                        username TEXT UNIQUE NOT NULL,
+                        embedding VECTOR(512)
+                    );
+
+                    -- Running sum and count of favorite embeddings, so the mean can be updated incrementally
+                    ALTER TABLE users ADD COLUMN IF NOT EXISTS embedding_sum VECTOR(512);
+                    ALTER TABLE users ADD COLUMN IF NOT EXISTS favorite_count INTEGER NOT NULL DEFAULT 0;
+                    -- Bumped on every embedding change, so stale recommendations can be found
+                    ALTER TABLE users ADD COLUMN IF NOT EXISTS embedding_version BIGINT NOT NULL DEFAULT 0;
+                    ALTER TABLE users ADD COLUMN IF NOT EXISTS display_name TEXT;
+
+                    CREATE TABLE IF NOT EXISTS images (
+                        id SERIAL PRIMARY KEY,
+                        url TEXT UNIQUE NOT NULL,
+                        embedding VECTOR(512)
+                    );
+                    -- Bumped when a url is re-ingested with a different embedding, so snapshots can spot stale rows
+                    ALTER TABLE images ADD COLUMN IF NOT EXISTS embedding_version BIGINT NOT NULL DEFAULT 0;
+
+                    CREATE TABLE IF NOT EXISTS user_favorites (
+                        user_id INTEGER REFERENCES users(id),
+                        image_id INTEGER REFERENCES images(id),
+                        PRIMARY KEY (user_id, image_id)
+                    );
+
+                    CREATE INDEX IF NOT EXISTS users_embedding_idx ON users USING diskann (embedding);
+                    CREATE INDEX IF NOT EXISTS images_embedding_idx ON images USING diskann (embedding);
+
+                    -- Materialised k-NN graph of images: one row per image, neighbours nearest first
+                    CREATE TABLE IF NOT EXISTS image_neighbors (
+                        image_id INTEGER PRIMARY KEY REFERENCES images(id) ON DELETE CASCADE,
+                        neighbor_ids INTEGER[] NOT NULL,
+                        similarities REAL[] NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS image_neighbors_neighbor_ids_idx ON image_neighbors USING gin (neighbor_ids);
+
+                    -- Precomputed top-N images per user, and the embedding version they were computed from
+                    CREATE TABLE IF NOT EXISTS user_recommendations (
+                        user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+                        image_ids INTEGER[] NOT NULL,
+                        scores REAL[] NOT NULL,
+                        embedding_version BIGINT NOT NULL,
+                        refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    );
+                """)
+                # Users with favorites from before the running sum existed have no embedding_sum yet, and
+                # the incremental updates would otherwise start their sum from the next favorite alone
+                cur.execute("""
+                    UPDATE users u
+                    SET favorite_count = agg.favorite_count,
+                        embedding_version = u.embedding_version + 1,
+                        embedding_sum = agg.embedding_sum,
+                        embedding = agg.embedding
+                    FROM (
+                        SELECT uf.user_id AS id, COUNT(i.id) AS favorite_count,
+                               SUM(i.embedding) AS embedding_sum, AVG(i.embedding) AS embedding
+                        FROM user_favorites uf
+                        JOIN images i ON uf.image_id = i.id
+                        GROUP BY uf.user_id
+                    ) agg
+                    WHERE u.id = agg.id AND u.embedding_sum IS NULL
+                """)
+                if cur.rowcount:
+                    print(f"Backfilled the favorite embedding sum of {cur.rowcount} users")
+
+    def initialize_users(self, usernames, display_names=None):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                with span("sql", statement="initialize_users"):
+                    execute_values(
+                        cur,
+                        "INSERT INTO users (username, display_name) VALUES %s ON CONFLICT (username) "
+                        "DO UPDATE SET display_name = COALESCE(users.display_name, EXCLUDED.display_name)",
+                        list(zip(usernames, display_names or [None] * len(usernames))),
+                    )
+
+    def list_users(self):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                with span("sql", statement="list_users"):
+                    cur.execute("SELECT id, username, display_name FROM users ORDER BY id")
+                    return cur.fetchall()
+
+    def add_images(self, rows):
+        # ON CONFLICT cannot touch the same row twice in one statement, so keep the last embedding per url
+        unique_rows = {url: embedding for url, embedding in rows}
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                with span("sql", statement="add_images"):
+                    execute_values(
+                        cur,
+                        "INSERT INTO images (url, embedding) VALUES %s ON CONFLICT (url) "
+                        "DO UPDATE SET embedding = EXCLUDED.embedding, embedding_version = images.embedding_version + 1 "
+                        "WHERE images.embedding IS DISTINCT FROM EXCLUDED.embedding",
+                        [(url, embedding.tolist()) for url, embedding in unique_rows.items()],
+                        page_size=len(unique_rows) or 1,
+                    )
+
+    def get_image_urls(self):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                with span("sql", statement="image_urls"):
+                    cur.execute("SELECT url FROM images")
+                return [row[0] for row in cur.fetchall()]
+
+    def add_user_favorite(self, user_id, image_id):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "insert_favorite", (user_id, image_id))
+                if cur.rowcount == 0:
+                    return False
+                execute_prepared(cur, "favorite_added", (user_id, image_id))
+                return True
+
+    def add_user_favorite_by_url(self, user_id, url):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "image_id_by_url", (url,))
+                result = cur.fetchone()
+                if result is None:
+                    return None, False
+
+                image_id = result[0]
+                execute_prepared(cur, "insert_favorite", (user_id, image_id))
+                if cur.rowcount == 0:
+                    return image_id, False
+                execute_prepared(cur, "favorite_added", (user_id, image_id))
+                return image_id, True
+
+    def image_id_by_url(self, url):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "image_id_by_url", (url,))
+                result = cur.fetchone()
+                return None if result is None else result[0]
+
+    def mutate_favorites(self, user_id, add_urls=(), remove_image_ids=(), max_favorites=None):
+        result = {"added": [], "removed": [], "favorites": []}
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                # Serialises concurrent mutations of this user, so the limit check cannot race
+                execute_prepared(cur, "lock_user", (user_id,))
+                execute_prepared(cur, "mutate_favorites", (user_id, list(add_urls), list(remove_image_ids), max_favorites))
+                for image_id, url, status in cur.fetchall():
+                    if status != "removed":
+                        result["favorites"].append({"id": image_id, "url": url})
+                    if status != "kept":
+                        result[status].append(image_id)
+        return result
+
+    def delete_user_favorite(self, user_id, image_id):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "delete_favorite", (user_id, image_id))
+                if cur.rowcount == 0:
+                    return False
+                execute_prepared(cur, "favorite_removed", (user_id, image_id))
+                return True
+
+    def update_user_embedding(self, user_id):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "update_user_embedding", (user_id,))
+
+    def rebuild_user_embeddings(self):
+        with get_connection() as conn:
+            with conn.cursor() as cur, span("sql", statement="rebuild_user_embeddings"):
+                cur.execute("""
+                    UPDATE users u
+                    SET favorite_count = agg.favorite_count,
+                        embedding_version = u.embedding_version + 1,
+                        embedding_sum = agg.embedding_sum,
+                        embedding = agg.embedding
+                    FROM (
+                        SELECT u.id, COUNT(i.id) AS favorite_count,
+                               SUM(i.embedding) AS embedding_sum, AVG(i.embedding) AS embedding
+                        FROM users u
+                        LEFT JOIN user_favorites uf ON uf.user_id = u.id
+                        LEFT JOIN images i ON uf.image_id = i.id
+                        GROUP BY u.id
+                    ) agg
+                    WHERE u.id = agg.id
+                """)
+                return cur.rowcount
+
+    def get_similar_users(self, target_user_id, limit, search_params=None):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                apply_search_params(cur, search_params)
+                execute_prepared(cur, "similar_users", (target_user_id, target_user_id, limit))
+                return cur.fetchall()
+
+    def get_similar_users_bulk(self, user_ids, limit, search_params=None):
+        results = {user_id: [] for user_id in user_ids}
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                apply_search_params(cur, search_params)
+                execute_prepared(cur, "similar_users_bulk", (list(results), limit))
+                for target_id, user_id, username, similarity in cur.fetchall():
+                    results[target_id].append((user_id, username, similarity))
+        return results
+
+    def get_user_favorites(self, user_id):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "user_favorites", (user_id,))
+                return [{"id": row[0], "url": row[1]} for row in cur.fetchall()]
+
+    def get_user_cards(self, user_ids, limit):
+        results = {user_id: {"favorites": [], "similar": []} for user_id in user_ids}
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                apply_search_params(cur)
+                execute_prepared(cur, "user_cards", (list(results), limit))
+                # psycopg2 decodes the json columns into lists
+                for user_id, favorites, similar in cur.fetchall():
+                    results[user_id] = {"favorites": favorites, "similar": [tuple(row) for row in similar]}
+        return results
+
+    def refresh_recommendations(self, limit, candidates, neighbours, social_weight, user_ids=None, batch_size=200):
+        refreshed = 0
+        while True:
+            with get_connection() as conn:
+                with conn.cursor() as cur:
+                    if user_ids is None:
+                        execute_prepared(cur, "stale_recommendations", (batch_size,))
+                        batch = [row[0] for row in cur.fetchall()]
+                    else:
+                        batch, user_ids = list(user_ids[:batch_size]), user_ids[batch_size:]
+                    if not batch:
+                        return refreshed
+                    apply_search_params(cur)
+                    execute_prepared(cur, "refresh_recommendations", (batch, limit, candidates, neighbours, social_weight))
+                    refreshed += len(batch)
+
+    def get_recommendations(self, user_id, limit):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "user_recommendations", (user_id, limit))
+                return [{"id": row[0], "url": row[1], "score": row[2]} for row in cur.fetchall()]
+
+    def search_images(self, embedding, limit, search_params=None):
+        # pgvector's text form, which the vector-typed parameter parses directly
+        vector = "[" + ",".join(str(float(value)) for value in embedding) + "]"
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                apply_search_params(cur, search_params)
+                execute_prepared(cur, "search_images", (vector, limit))
+                return [{"id": row[0], "url": row[1], "similarity": row[2]} for row in cur.fetchall()]
+
+    def rebuild_image_neighbors(self, k, batch_size=500):
+        with get_connection() as conn:
+            with conn.cursor() as cur, span("sql", statement="image_ids"):
+                cur.execute("SELECT id FROM images WHERE embedding IS NOT NULL ORDER BY id")
+                image_ids = [row[0] for row in cur.fetchall()]
+        # One transaction per batch, so a long rebuild never holds locks on the whole table
+        for start in range(0, len(image_ids), batch_size):
+            with get_connection() as conn:
+                with conn.cursor() as cur:
+                    apply_search_params(cur)
+                    execute_prepared(cur, "refresh_image_neighbors", (image_ids[start:start + batch_size], k))
+            print(f"Image neighbours: {min(start + batch_size, len(image_ids))}/{len(image_ids)}")
+        return len(image_ids)
+
+    def update_image_neighbors(self, urls, k):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                with span("sql", statement="image_neighbors_built"):
+                    cur.execute("SELECT EXISTS (SELECT 1 FROM image_neighbors)")
+                    built = cur.fetchone()[0]
+                if not built:
+                    return
+                execute_prepared(cur, "image_ids_by_url", (list(urls),))
+                changed = [row[0] for row in cur.fetchall()]
+                if not changed:
+                    return
+                apply_search_params(cur)
+                execute_prepared(cur, "refresh_image_neighbors", (changed, k))
+                execute_prepared(cur, "image_neighbors_affected", (changed, k))
+                changed_ids = set(changed)
+                affected = [row[0] for row in cur.fetchall() if row[0] not in changed_ids]
+                if affected:
+                    execute_prepared(cur, "refresh_image_neighbors", (affected, k))
+
+    def get_image_neighbors(self, url, limit):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "image_neighbors", (url, limit))
+                return [{"id": row[0], "url": row[1], "similarity": row[2]} for row in cur.fetchall()]
+
+    def iter_image_embeddings(self, after_id=0, batch_size=10000):
+        # A named cursor streams rows from one server-side query instead of materialising them all
+        with get_connection() as conn:
+            with conn.cursor(name="image_embeddings") as cur, span("sql", statement="image_embeddings"):
+                cur.itersize = batch_size
+                cur.execute(
+                    "SELECT id, embedding_version, url, embedding::real[] FROM images "
+                    "WHERE id > %s AND embedding IS NOT NULL ORDER BY id",
+                    (after_id,),
+                )
+                while rows := cur.fetchmany(batch_size):
+                    ids, versions, urls, embeddings = zip(*rows)
+                    yield (
+                        np.asarray(ids, dtype=np.int64),
+                        np.asarray(versions, dtype=np.int64),
+                        list(urls),
+                        np.asarray(embeddings, dtype=np.float32),
+                    )
+
+    def get_image_versions(self):
+        with get_connection() as conn:
+            with conn.cursor() as cur, span("sql", statement="image_versions"):
+                cur.execute("SELECT id, embedding_version FROM images WHERE embedding IS NOT NULL ORDER BY id")
+                rows = cur.fetchall()
+        ids, versions = zip(*rows) if rows else ((), ())
+        return np.asarray(ids, dtype=np.int64), np.asarray(versions, dtype=np.int64)
+
+    def iter_user_embeddings(self, known=None, batch_size=10000):
+        known = known or {}
+        with get_connection() as conn:
+            with conn.cursor(name="user_embeddings") as cur, span("sql", statement="user_embeddings"):
+                cur.itersize = batch_size
+                cur.execute(
+                    """
+                    SELECT u.id, u.embedding_version, u.embedding::real[]
+                    FROM users u
+                    LEFT JOIN unnest(%s::int[], %s::bigint[]) AS k(id, version) ON k.id = u.id
+                    WHERE k.version IS DISTINCT FROM u.embedding_version
+                    ORDER BY u.id
+                    """,
+                    (list(known), list(known.values())),
+                )
+                while rows := cur.fetchmany(batch_size):
+                    ids, versions, embeddings = zip(*rows)
+                    zero = [0.0] * EMBEDDING_DIM
+                    yield (
+                        np.asarray(ids, dtype=np.int64),
+                        np.asarray(versions, dtype=np.int64),
+                        np.asarray([zero if embedding is None else embedding for embedding in embeddings], dtype=np.float32),
+                    )
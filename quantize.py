@@ -0,0 +1,70 @@
+"""Compact embedding codes for candidate search.
+
+    codes, scales = quantize(rows, "int8")
+    scores = approximate_scores(codes, scales, queries, "int8")
+
+float16 halves each vector, int8 stores one signed byte per dimension plus a
+float32 scale per vector (max |x| / 127), and binary keeps only the sign bit of
+each dimension, packed 8 per byte, and scores by negative Hamming distance.
+Scores are only good enough to shortlist candidates; callers rescore the
+shortlist against the full-precision vectors.
+
+The codes save memory, not time: numpy has no float16 or int8 matrix
+product, so those scans decode block by block and run slower than a float32
+scan (float16 decoding especially). Only the binary scan is faster.
+"""
+import numpy as np
+
+QUANTIZATIONS = ("float32", "float16", "int8", "binary")
+
+# Rows decoded to float32 at a time, bounding the temporary memory of a scan
+_SCAN_BLOCK = 8192
+
+
+def code_shape(kind, dim):
+    """(dtype, width) of one vector's code."""
+    if kind == "float32":
+        return np.float32, dim
+    if kind == "float16":
+        return np.float16, dim
+    if kind == "int8":
+        return np.int8, dim
+    if kind == "binary":
+        return np.uint8, (dim + 7) // 8
+    raise ValueError(f"Unknown quantization {kind!r}, expected one of {QUANTIZATIONS}")
+
+
+def quantize(rows, kind):
+    """Codes for a (n, dim) float32 matrix, and per-row scales for int8 (None otherwise)."""
+    rows = np.asarray(rows, dtype=np.float32)
+    if kind == "int8":
+        scales = np.abs(rows).max(axis=1) / 127
+        safe = np.where(scales > 0, scales, 1)
+        return np.rint(rows / safe[:, None]).astype(np.int8), scales.astype(np.float32)
+    if kind == "binary":
+        return np.packbits(rows > 0, axis=1), None
+    dtype, _ = code_shape(kind, rows.shape[1])
+    return rows.astype(dtype), None
+
+
+def approximate_scores(codes, scales, queries, kind):
+    """(n_queries, n_codes) similarity estimates of float32 queries against stored codes."""
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+    if kind == "binary":
+        query_codes = np.packbits(queries > 0, axis=1)
+        for i, query_code in enumerate(query_codes):
+            for start in range(0, len(codes), _SCAN_BLOCK):
+                block = codes[start:start + _SCAN_BLOCK]
+                scores[i, start:start + len(block)] = -np.bitwise_count(block ^ query_code).sum(axis=1, dtype=np.int32)
+        return scores
+    # One decode buffer reused across blocks; allocating a float32 copy per block costs as much as the product
+    buffer = np.empty((min(_SCAN_BLOCK, len(codes)), codes.shape[1]), dtype=np.float32)
+    for start in range(0, len(codes), _SCAN_BLOCK):
+        block = buffer[:len(codes[start:start + _SCAN_BLOCK])]
+        np.copyto(block, codes[start:start + _SCAN_BLOCK])
+        block_scores = queries @ block.T
+        if kind == "int8":
+            block_scores *= scales[start:start + len(block)]
+        scores[:, start:start + len(block)] = block_scores
+    return scores
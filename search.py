@@ -0,0 +1,102 @@
+"""Text-to-image search.
+
+Queries are embedded with the CLIP text tower and matched against image
+embeddings by the store. Query embeddings are kept in an LRU cache keyed by
+the normalised query text, and queries that miss it within a few
+milliseconds of each other are embedded together in one encode_text call;
+identical queries in flight share one result.
+"""
+import asyncio
+import os
+import numpy as np
+from cache import LRUCache
+from encoders import ClipTextEncoder
+from metrics import inc, span
+from store import get_store
+
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 4096))
+# How long the first query of a batch waits for others to join it, and the most queries per encode_text call
+SEARCH_BATCH_WAIT_MS = float(os.environ.get("SEARCH_BATCH_WAIT_MS", 5))
+SEARCH_MAX_BATCH = int(os.environ.get("SEARCH_MAX_BATCH", 64))
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+class QueryEmbedder:
+    """Cached, micro-batched query embeddings for use from one event loop."""
+
+    def __init__(self, encoder, cache_size=SEARCH_CACHE_SIZE, max_wait=SEARCH_BATCH_WAIT_MS / 1000, max_batch=SEARCH_MAX_BATCH):
+        self.encoder = encoder
+        self.cache = LRUCache(cache_size)
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._pending = {}  # query -> future awaiting the next batch
+        self._flush_handle = None
+
+    async def embed(self, query):
+        """Unit-normalised embedding of a query string."""
+        query = normalize_query(query)
+        embedding = self.cache.get(query)
+        if embedding is not None:
+            return embedding
+        future = self._pending.get(query)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._pending[query] = loop.create_future()
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            asyncio.get_running_loop().create_task(self._encode(batch))
+
+    async def _encode(self, batch):
+        queries = list(batch)
+        try:
+            with span("search.encode"):
+                embeddings = await asyncio.to_thread(self.encoder.encode_text, queries)
+            inc("search_query_batches_total")
+            inc("search_queries_encoded_total", len(queries))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        for query, embedding in zip(queries, embeddings):
+            self.cache.put(query, embedding)
+            if not batch[query].done():
+                batch[query].set_result(embedding)
+
+
+_embedder = None
+
+
+def get_query_embedder():
+    """The process-wide QueryEmbedder, created with the CLIP text tower on first use."""
+    global _embedder
+    if _embedder is None:
+        _embedder = QueryEmbedder(ClipTextEncoder())
+    return _embedder
+
+
+def set_query_embedder(embedder):
+    """Swap the query embedder, e.g. for one with a stand-in encoder."""
+    global _embedder
+    _embedder = embedder
+
+
+async def asearch_images(query, limit=20):
+    """Images whose embeddings best match a text query, as {"id", "url", "similarity"} dicts."""
+    inc("search_queries_total")
+    embedding = await get_query_embedder().embed(query)
+    return await asyncio.to_thread(get_store().search_images, embedding, limit)
@@ -0,0 +1,163 @@
+"""Pushes changed "similar users" lists to subscribed pages.
+
+Browsers subscribe with the user ids of the page they show. Favorite
+mutations are reported with notify(); those arriving within a short window
+are coalesced into one recompute. A recompute only covers watched users the
+mutation can have affected: the mutated users themselves, users whose last
+top-k listed one of them, and users whose top-k one of them can now enter.
+Top-k membership is not symmetric, so the last set is found by comparing
+each watched list's worst similarity with the mutated user's similarity to
+its owner: exact for owners among the mutated user's `fanout` nearest
+neighbours, and bounded by the last of those neighbours for everyone else,
+who is then recomputed whenever the bound does not rule an entry out.
+Each recomputed list is compared with the one last pushed at display
+precision, and subscribers receive only the lists that changed.
+
+Lists are kept per process, so a web worker only pushes changes for the
+mutations it served itself.
+"""
+import asyncio
+import os
+import time
+from collections import Counter
+from metrics import inc, span
+from store import get_store
+
+# How long the first mutation of a burst waits for others to join its recompute
+SIMILARITY_FEED_DEBOUNCE_MS = float(os.environ.get("SIMILARITY_FEED_DEBOUNCE_MS", 250))
+# Nearest neighbours of a mutated user fetched to bound its similarity to watched users;
+# a larger fanout rules out more lists without recomputing them
+SIMILARITY_FEED_FANOUT = int(os.environ.get("SIMILARITY_FEED_FANOUT", 50))
+
+
+def _display_key(similar_users):
+    # Similarities at the precision the page shows, so float noise is not pushed
+    return [(user_id, None if similarity is None else round(similarity, 3)) for user_id, _, similarity in similar_users]
+
+
+class Subscription:
+    """One page's stream: the user ids it shows and a queue of ({user_id: similar users}, elapsed_time) updates."""
+
+    def __init__(self, user_ids):
+        self.user_ids = set(user_ids)
+        self.queue = asyncio.Queue()
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class SimilarityFeed:
+    """Debounced, diffed top-k similar-user updates for use from one event loop."""
+
+    def __init__(self, limit=3, debounce=SIMILARITY_FEED_DEBOUNCE_MS / 1000, fanout=SIMILARITY_FEED_FANOUT):
+        self.limit = limit
+        self.debounce = debounce
+        self.fanout = fanout
+        self._subscriptions = set()
+        self._watchers = Counter()  # user id -> subscriptions showing it
+        self._previous = {}  # watched user id -> last pushed similar users
+        self._pending = set()
+        self._flush_handle = None
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self, user_ids):
+        """Start watching a page of users. Call unsubscribe() with the result when the stream ends."""
+        subscription = Subscription(user_ids)
+        self._subscriptions.add(subscription)
+        self._watchers.update(subscription.user_ids)
+        unknown = [user_id for user_id in subscription.user_ids if user_id not in self._previous]
+        if unknown:
+            self._previous.update(await asyncio.to_thread(get_store().get_similar_users_bulk, unknown, self.limit))
+        inc("similarity_feed_subscriptions_total")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscriptions.discard(subscription)
+        self._watchers.subtract(subscription.user_ids)
+        for user_id in subscription.user_ids:
+            if self._watchers[user_id] <= 0:
+                del self._watchers[user_id]
+                self._previous.pop(user_id, None)
+
+    def notify(self, user_ids):
+        """Report users whose embeddings changed; the recompute runs once the debounce window closes."""
+        self._pending.update(user_ids)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.debounce, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        mutated, self._pending = self._pending, set()
+        if mutated and self._subscriptions:
+            asyncio.get_running_loop().create_task(self._push(mutated))
+
+    async def _push(self, mutated):
+        # One recompute at a time, so pushes reach subscribers in mutation order
+        async with self._lock:
+            try:
+                changed, elapsed_time = await self._changes(mutated)
+            except Exception as e:
+                print(f"Similarity feed update failed: {e}")
+                return
+        if not changed:
+            return
+        inc("similarity_feed_sections_changed_total", len(changed))
+        for subscription in self._subscriptions:
+            updates = {user_id: changed[user_id] for user_id in subscription.user_ids if user_id in changed}
+            if updates:
+                subscription.queue.put_nowait((updates, elapsed_time))
+
+    def _may_have_entered(self, user_id, bounds):
+        """Whether a mutated user can now rank in user_id's last pushed top-k.
+
+        `bounds` holds, per mutated user, its exact similarity to its fanout
+        neighbours and an upper bound on its similarity to everyone else.
+        """
+        similarities = [similarity for _, _, similarity in self._previous.get(user_id, [])]
+        if len(similarities) < self.limit or None in similarities:
+            return True
+        worst = min(similarities)
+        for exact, beyond in bounds:
+            bound = exact.get(user_id, beyond)
+            if bound is None or bound >= worst:
+                return True
+        return False
+
+    async def _changes(self, mutated):
+        """Recompute the watched users the mutations can have affected. Returns ({user_id: similar users}, elapsed_time)."""
+        store = get_store()
+        affected = set(mutated)
+        affected.update(
+            user_id for user_id, similar in self._previous.items()
+            if any(other_id in mutated for other_id, _, _ in similar)
+        )
+        with span("similarity_feed.affected"):
+            neighbours = await asyncio.to_thread(store.get_similar_users_bulk, list(mutated), self.fanout)
+        bounds = []
+        for similar in neighbours.values():
+            exact = {other_id: similarity for other_id, _, similarity in similar}
+            if len(similar) < self.fanout:
+                beyond = float("-inf")  # the fanout reached every user
+            else:
+                # Users past the fanout are at most as similar as its last entry
+                beyond = similar[-1][2] if similar else float("inf")
+            bounds.append((exact, beyond))
+        affected &= self._watchers.keys()
+        affected.update(
+            user_id for user_id in self._watchers.keys() - affected if self._may_have_entered(user_id, bounds)
+        )
+        inc("similarity_feed_flushes_total")
+        if not affected:
+            return {}, 0.0
+        start_time = time.time()
+        current = await asyncio.to_thread(store.get_similar_users_bulk, list(affected), self.limit)
+        elapsed_time = time.time() - start_time
+        inc("similarity_feed_users_recomputed_total", len(affected))
+        changed = {}
+        for user_id, similar in current.items():
+            if user_id not in self._watchers:
+                continue  # the last page showing it went away meanwhile
+            if _display_key(similar) != _display_key(self._previous.get(user_id, [])):
+                changed[user_id] = similar
+            self._previous[user_id] = similar
+        return changed, elapsed_time
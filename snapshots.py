@@ -0,0 +1,231 @@
+"""Memory-mapped embedding snapshots.
+
+A snapshot is a directory holding a manifest and one generation directory of
+flat files that numpy can map without copying:
+
+    manifest.json           dim, the current generation and the number of valid rows of each file
+    gen-<n>/images.f32      image embeddings, float32 rows of EMBEDDING_DIM, contiguous
+    gen-<n>/images.units.f32 the same rows scaled to unit length, so searches need no normalised copy
+    gen-<n>/images.ids      int64 image id of each row
+    gen-<n>/images.versions int64 embedding version of each row
+    gen-<n>/images.urls     url of each row, one per line
+    gen-<n>/users.f32       user embeddings (the mean of their favorites, zero without any)
+    gen-<n>/users.ids       int64 user id of each row
+    gen-<n>/users.versions  int64 embedding version of each row
+
+Exports append to the current generation: images with ids past the last
+exported one, and a new row for every user whose embedding version changed,
+so the newest row of a user id wins. Readers map only the rows the manifest
+lists and appends never touch those, so an interrupted export leaves the
+previous snapshot readable.
+
+Image rows cannot be replaced in place, so when an exported image was
+re-ingested since (its version changed), or with `--full`, the export writes
+a new generation instead and publishes it by replacing the manifest. The old
+generation is then unlinked; processes that still map it keep reading it.
+
+    snapshot = open_snapshot("data/snapshot")
+    scores = snapshot.images @ query            # pages in only what it touches
+    ids, rows = snapshot.latest_user_rows()
+
+Export with `python embeddings.py snapshot --snapshot-dir data/snapshot`.
+"""
+import json
+import os
+import shutil
+import numpy as np
+from store import EMBEDDING_DIM
+
+MANIFEST = "manifest.json"
+
+
+def read_manifest(directory):
+    """The snapshot's manifest, or None when the directory holds no snapshot."""
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _generation_dir(generation):
+    return f"gen-{generation}"
+
+
+def _map(path, dtype, shape, mode):
+    # np.memmap refuses empty files, and an empty snapshot has nothing to share anyway
+    if not shape[0]:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+
+class Snapshot:
+    """Read side of a snapshot: its files mapped with np.memmap, sized by the manifest.
+
+    `mode` is passed to np.memmap; "c" gives copy-on-write arrays whose writes
+    stay in this process.
+    """
+
+    def __init__(self, directory, manifest, mode="r"):
+        self.directory = os.path.join(directory, _generation_dir(manifest["generation"]))
+        self.dim = manifest["dim"]
+        images, users = manifest["images"], manifest["users"]
+        self.images = _map(self._path("images.f32"), np.float32, (images["rows"], self.dim), mode)
+        # None for generations written before unit rows were exported
+        self.image_units = (
+            _map(self._path("images.units.f32"), np.float32, (images["rows"], self.dim), mode)
+            if not images["rows"] or os.path.exists(self._path("images.units.f32")) else None
+        )
+        self.image_ids = _map(self._path("images.ids"), np.int64, (images["rows"],), "r")
+        self.image_versions = _map(self._path("images.versions"), np.int64, (images["rows"],), "r")
+        self.users = _map(self._path("users.f32"), np.float32, (users["rows"], self.dim), mode)
+        self.user_ids = _map(self._path("users.ids"), np.int64, (users["rows"],), "r")
+        self.user_versions = _map(self._path("users.versions"), np.int64, (users["rows"],), "r")
+        self._urls_bytes = images["urls_bytes"]
+        self._image_urls = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def image_urls(self):
+        """Url of each image row, read on first use."""
+        if self._image_urls is None:
+            with open(self._path("images.urls"), "rb") as f:
+                self._image_urls = f.read(self._urls_bytes).decode().splitlines()
+        return self._image_urls
+
+    def latest_user_rows(self):
+        """(user ids, rows) pairing every user id with its newest row, ordered by id."""
+        ids, first_from_end = np.unique(self.user_ids[::-1], return_index=True)
+        return ids, len(self.user_ids) - 1 - first_from_end
+
+
+def open_snapshot(directory, mode="r"):
+    """Map the snapshot in `directory`, or return None when there is none."""
+    manifest = read_manifest(directory)
+    if manifest is None:
+        return None
+    if manifest["dim"] != EMBEDDING_DIM:
+        raise ValueError(f"Snapshot in {directory} has dim {manifest['dim']}, expected {EMBEDDING_DIM}")
+    return Snapshot(directory, manifest, mode)
+
+
+def _unit_rows(embeddings):
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms > 0, norms, 1)
+
+
+class _Appender:
+    """Appends to one snapshot file after cutting it back to the bytes the manifest vouches for."""
+
+    def __init__(self, path, valid_bytes):
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.file.truncate(valid_bytes)
+        self.file.seek(valid_bytes)
+        self.size = valid_bytes
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+def _images_changed(store, snapshot):
+    """Whether any image in the snapshot is gone from the store or has a different version there."""
+    if not len(snapshot.image_ids):
+        return False
+    ids, versions = store.get_image_versions()
+    if not len(ids):
+        return True
+    positions = np.minimum(np.searchsorted(ids, snapshot.image_ids), len(ids) - 1)
+    return bool(np.any((ids[positions] != snapshot.image_ids) | (versions[positions] != snapshot.image_versions)))
+
+
+def export_snapshot(store, directory, full=False, batch_size=10000):
+    """Append the store's new image and changed user embeddings to the snapshot in `directory`.
+
+    With `full`, or when an exported image changed, a new generation is
+    written from scratch instead. Returns {"images": rows written, "users":
+    rows written, "full": whether a new generation was written}.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    snapshot = open_snapshot(directory) if manifest and not full else None
+    if snapshot is not None and _images_changed(store, snapshot):
+        print(f"Images in {directory} were re-ingested since the last export, writing a new generation")
+        snapshot = None
+    elif snapshot is not None and snapshot.image_units is None:
+        print(f"Snapshot in {directory} predates unit image rows, writing a new generation")
+        snapshot = None
+    previous = manifest["generation"] if manifest else None
+    if snapshot is None:
+        generation = (previous or 0) + 1
+        images = {"rows": 0, "last_id": 0, "urls_bytes": 0}
+        users = {"rows": 0}
+        # Left over from an interrupted full export, never listed by a manifest
+        shutil.rmtree(os.path.join(directory, _generation_dir(generation)), ignore_errors=True)
+    else:
+        generation = previous
+        images, users = manifest["images"], manifest["users"]
+    known = {}
+    if snapshot is not None:
+        ids, rows = snapshot.latest_user_rows()
+        known = dict(zip(ids.tolist(), snapshot.user_versions[rows].tolist()))
+    row_bytes = 4 * EMBEDDING_DIM
+    data_dir = os.path.join(directory, _generation_dir(generation))
+    os.makedirs(data_dir, exist_ok=True)
+
+    def path(name):
+        return os.path.join(data_dir, name)
+
+    files = {
+        "images.f32": _Appender(path("images.f32"), images["rows"] * row_bytes),
+        "images.units.f32": _Appender(path("images.units.f32"), images["rows"] * row_bytes),
+        "images.ids": _Appender(path("images.ids"), images["rows"] * 8),
+        "images.versions": _Appender(path("images.versions"), images["rows"] * 8),
+        "images.urls": _Appender(path("images.urls"), images["urls_bytes"]),
+        "users.f32": _Appender(path("users.f32"), users["rows"] * row_bytes),
+        "users.ids": _Appender(path("users.ids"), users["rows"] * 8),
+        "users.versions": _Appender(path("users.versions"), users["rows"] * 8),
+    }
+    written = {"images": 0, "users": 0, "full": snapshot is None}
+    try:
+        for ids, versions, urls, embeddings in store.iter_image_embeddings(images["last_id"], batch_size):
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            files["images.f32"].write(embeddings.tobytes())
+            files["images.units.f32"].write(_unit_rows(embeddings).tobytes())
+            files["images.ids"].write(np.asarray(ids, dtype=np.int64).tobytes())
+            files["images.versions"].write(np.asarray(versions, dtype=np.int64).tobytes())
+            files["images.urls"].write("".join(f"{url}\n" for url in urls).encode())
+            images["last_id"] = int(ids[-1])
+            written["images"] += len(ids)
+        for ids, versions, embeddings in store.iter_user_embeddings(known, batch_size):
+            files["users.f32"].write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+            files["users.ids"].write(np.asarray(ids, dtype=np.int64).tobytes())
+            files["users.versions"].write(np.asarray(versions, dtype=np.int64).tobytes())
+            written["users"] += len(ids)
+    finally:
+        for appender in files.values():
+            appender.close()
+
+    images["rows"] += written["images"]
+    images["urls_bytes"] = files["images.urls"].size
+    users["rows"] += written["users"]
+    tmp_path = os.path.join(directory, f"{MANIFEST}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {"dim": EMBEDDING_DIM, "dtype": "float32", "generation": generation, "images": images, "users": users},
+            f, indent=2,
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(directory, MANIFEST))
+    if previous is not None and previous != generation:
+        # Unlinking keeps the files alive for processes that still map them
+        shutil.rmtree(os.path.join(directory, _generation_dir(previous)), ignore_errors=True)
+    return written
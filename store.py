@@ -0,0 +1,234 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+
+EMBEDDING_DIM = 512
+
+# Which VectorStore implementation backs the functions in embeddings.py: "postgres" or "numpy"
+STORE_BACKEND = os.environ.get("EMBEDDINGS_STORE", "postgres")
+NUMPY_STORE_PATH = os.environ.get("NUMPY_STORE_PATH", "data/vectors.npz")
+# Codes the numpy backend keeps in memory and scans for similar users and image search: float32,
+# float16, int8 or binary (see quantize.py); other than float32, full-precision rows are memory-mapped
+QUANTIZATION = os.environ.get("EMBEDDINGS_QUANTIZATION", "float32")
+# Candidates rescored in full precision per requested result when quantized
+RESCORE_FACTOR = int(os.environ.get("RESCORE_FACTOR", 4))
+# How the numpy backend finds similar users and images: "exact" scans everything, "ivf" probes
+# ANN_NPROBE of ANN_NLIST k-means buckets (0 picks about 4 * sqrt(rows), see ann.py)
+ANN = os.environ.get("EMBEDDINGS_ANN", "exact")
+ANN_NLIST = int(os.environ.get("ANN_NLIST", 0))
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 8))
+# Neighbours materialised per image for "more like this"
+IMAGE_NEIGHBORS_K = int(os.environ.get("IMAGE_NEIGHBORS_K", 10))
+# Stored recommendations per user, drawn from the images nearest the user's embedding plus
+# the favorites of their most similar users, the latter boosted by SOCIAL_WEIGHT x similarity
+RECOMMENDATIONS_N = int(os.environ.get("RECOMMENDATIONS_N", 20))
+RECOMMENDATION_CANDIDATES = int(os.environ.get("RECOMMENDATION_CANDIDATES", 100))
+RECOMMENDATION_NEIGHBOURS = int(os.environ.get("RECOMMENDATION_NEIGHBOURS", 10))
+RECOMMENDATION_SOCIAL_WEIGHT = float(os.environ.get("RECOMMENDATION_SOCIAL_WEIGHT", 0.5))
+# Embedding snapshot the numpy backend maps its image matrix from at startup, if set (see snapshots.py)
+NUMPY_SNAPSHOT_DIR = os.environ.get("NUMPY_SNAPSHOT_DIR", "")
+# Entries kept by the favorites and similarity caches in front of the store; 0 (the default)
+# disables caching. The cache only sees this process's writes, so writes from other processes
+# show up once entries are STORE_CACHE_TTL seconds old (see cache.py)
+STORE_CACHE_SIZE = int(os.environ.get("STORE_CACHE_SIZE", 0))
+STORE_CACHE_TTL = float(os.environ.get("STORE_CACHE_TTL", 5))
+
+
+class VectorStore(ABC):
+    """Storage and similarity search for users, images and favorites.
+
+    Each backend keeps a user's embedding as the mean of their favorite image
+    embeddings and ranks users by cosine similarity of those embeddings.
+
+    Similarity searches take optional `search_params` overriding the backend's
+    configured index parameters for that one query: {"nprobe"} for the numpy
+    backend, {"search_list_size", "rescore"} for diskann in Postgres, and
+    {"exact": True} on either for an exhaustive scan.
+    """
+
+    def create_tables(self):
+        """Create whatever schema the backend needs."""
+
+    @abstractmethod
+    def initialize_users(self, usernames, display_names=None):
+        """Create any of the given users that do not exist yet, and set display names that are still missing."""
+
+    @abstractmethod
+    def list_users(self):
+        """Return every user as an (id, username, display_name) tuple ordered by id; display_name may be None."""
+
+    @abstractmethod
+    def add_images(self, rows):
+        """Upsert (url, embedding) pairs."""
+
+    @abstractmethod
+    def get_image_urls(self):
+        """Return the urls of every stored image."""
+
+    @abstractmethod
+    def add_user_favorite(self, user_id, image_id):
+        """Add a favorite and update the user's embedding. Returns True if it was new."""
+
+    @abstractmethod
+    def add_user_favorite_by_url(self, user_id, url):
+        """Add a favorite by image URL. Returns (image_id, added), with image_id None for an unknown URL."""
+
+    @abstractmethod
+    def delete_user_favorite(self, user_id, image_id):
+        """Remove a favorite and update the user's embedding. Returns True if it existed."""
+
+    def mutate_favorites(self, user_id, add_urls=(), remove_image_ids=(), max_favorites=None):
+        """Remove and then add several favorites, update the user's embedding and return the outcome.
+
+        Adds of unknown urls, of images that were already favorites, and past
+        `max_favorites` are skipped, earlier urls winning. Returns {"added":
+        [image ids], "removed": [image ids], "favorites": get_user_favorites()}.
+        Backends override this to apply everything in one transaction.
+        """
+        favorites = self.get_user_favorites(user_id)
+        existing = {image["id"] for image in favorites}
+        removed = [image_id for image_id in dict.fromkeys(remove_image_ids) if self.delete_user_favorite(user_id, image_id)]
+        added = []
+        for url in add_urls:
+            if max_favorites is not None and len(existing) - len(removed) + len(added) >= max_favorites:
+                break
+            image_id = self.image_id_by_url(url)
+            if image_id is not None and image_id not in existing and self.add_user_favorite(user_id, image_id):
+                added.append(image_id)
+        if added or removed:
+            favorites = self.get_user_favorites(user_id)
+        return {"added": added, "removed": removed, "favorites": favorites}
+
+    @abstractmethod
+    def image_id_by_url(self, url):
+        """Return the id of the image with this url, or None."""
+
+    @abstractmethod
+    def update_user_embedding(self, user_id):
+        """Recompute one user's embedding from scratch."""
+
+    @abstractmethod
+    def rebuild_user_embeddings(self):
+        """Recompute every user's embedding from scratch. Returns the number of users."""
+
+    @abstractmethod
+    def get_similar_users(self, target_user_id, limit, search_params=None):
+        """Return up to `limit` (id, username, similarity) tuples, most similar first."""
+
+    def get_similar_users_bulk(self, user_ids, limit, search_params=None):
+        """Return {user_id: get_similar_users(user_id, limit)} for many users at once.
+
+        Backends override this to answer in a single round trip or matrix product.
+        """
+        return {user_id: self.get_similar_users(user_id, limit, search_params) for user_id in user_ids}
+
+    @abstractmethod
+    def get_user_favorites(self, user_id):
+        """Return the user's favorites as {"id", "url"} dicts ordered by image id."""
+
+    def get_user_cards(self, user_ids, limit):
+        """Return {user_id: {"favorites": get_user_favorites(), "similar": get_similar_users(limit)}} for a page of users.
+
+        Backends override this to load the whole page in a single round trip.
+        """
+        similar = self.get_similar_users_bulk(user_ids, limit)
+        return {user_id: {"favorites": self.get_user_favorites(user_id), "similar": similar[user_id]} for user_id in user_ids}
+
+    @abstractmethod
+    def rebuild_image_neighbors(self, k):
+        """Recompute and store the k nearest neighbours of every image. Returns the number of images."""
+
+    @abstractmethod
+    def update_image_neighbors(self, urls, k):
+        """Refresh stored neighbours after the images at `urls` were inserted or changed.
+
+        Covers the changed images themselves, images whose stored lists
+        mention them, and images whose lists one of them now enters by beating
+        the lowest kept similarity. Does nothing until the graph has been
+        built once, so a first bulk ingest is not slowed down.
+        """
+
+    @abstractmethod
+    def get_image_neighbors(self, url, limit):
+        """Return up to `limit` stored neighbours of an image as {"id", "url", "similarity"} dicts, nearest first."""
+
+    @abstractmethod
+    def search_images(self, embedding, limit, search_params=None):
+        """Return the `limit` images most similar to an embedding as {"id", "url", "similarity"} dicts."""
+
+    @abstractmethod
+    def refresh_recommendations(self, limit, candidates, neighbours, social_weight, user_ids=None):
+        """Recompute stored recommendations for `user_ids`, or for every user whose embedding changed since.
+
+        Returns the number of users refreshed.
+        """
+
+    @abstractmethod
+    def get_recommendations(self, user_id, limit):
+        """Return up to `limit` stored recommendations as {"id", "url", "score"} dicts, best first."""
+
+    @abstractmethod
+    def iter_image_embeddings(self, after_id=0, batch_size=10000):
+        """Yield (ids, versions, urls, embeddings) batches of the images with id > after_id, in id order.
+
+        ids and versions are int64 arrays and embeddings a float32 (n, EMBEDDING_DIM) array.
+        """
+
+    @abstractmethod
+    def get_image_versions(self):
+        """Return (ids, versions) int64 arrays of every image, in id order.
+
+        An image's version is bumped whenever it is re-ingested with a different embedding.
+        """
+
+    @abstractmethod
+    def iter_user_embeddings(self, known=None, batch_size=10000):
+        """Yield (ids, versions, embeddings) batches of the users whose embedding version differs from `known`.
+
+        `known` maps user id to the version a consumer already has. Embeddings
+        are the mean of the user's favorites, zero for users without any.
+        """
+
+    def flush(self):
+        """Persist pending writes, for backends that buffer them."""
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the process-wide store selected by EMBEDDINGS_STORE."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = _create_store(STORE_BACKEND)
+                if STORE_CACHE_SIZE > 0:
+                    from cache import CachedStore
+                    _store = CachedStore(_store, maxsize=STORE_CACHE_SIZE, ttl=STORE_CACHE_TTL)
+    return _store
+
+
+def set_store(store):
+    """Replace the process-wide store, e.g. with an in-memory one for benchmarks."""
+    global _store
+    with _store_lock:
+        _store = store
+
+
+def get_cache_stats():
+    """Hit/miss counters of the store cache, or None when caching is disabled."""
+    store = get_store()
+    return store.stats() if hasattr(store, "stats") else None
+
+
+def _create_store(backend):
+    # Backends are imported lazily so the numpy store runs without psycopg2 installed
+    if backend == "postgres":
+        from pg_store import PostgresStore
+        return PostgresStore()
+    if backend == "numpy":
+        from numpy_store import NumpyStore
+        return NumpyStore(NUMPY_STORE_PATH, snapshot=NUMPY_SNAPSHOT_DIR or None)
+    raise ValueError(f"Unknown EMBEDDINGS_STORE {backend!r}, expected 'postgres' or 'numpy'")
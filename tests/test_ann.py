@@ -0,0 +1,42 @@
+import numpy as np
+from ann import IVFIndex, top_k_indices, top_k_rows
+
+
+def unit_rows(count, dim=16, seed=0):
+    rows = np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def test_top_k_helpers_return_the_best_first():
+    scores = np.array([0.1, 0.9, 0.5, 0.7], dtype=np.float32)
+    assert top_k_indices(scores, 2).tolist() == [1, 3]
+    assert top_k_indices(scores, 10).tolist() == [1, 3, 2, 0]
+    assert top_k_rows(np.stack([scores, -scores]), 2).tolist() == [[1, 3], [0, 2]]
+
+
+def test_probing_every_bucket_is_an_exact_scan():
+    vectors = unit_rows(500)
+    queries = unit_rows(5, seed=1)
+    index = IVFIndex.train(vectors, nlist=10)
+    for query, (rows, scores) in zip(queries, index.search(vectors, queries, k=8, nprobe=10)):
+        assert rows.tolist() == top_k_indices(vectors @ query, 8).tolist()
+        assert np.allclose(scores, vectors[rows] @ query)
+
+
+def test_zero_rows_are_never_returned():
+    vectors = unit_rows(100)
+    vectors[::2] = 0
+    index = IVFIndex.train(vectors, nlist=4)
+    [(rows, _)] = index.search(vectors, vectors[1], k=100, nprobe=4)
+    assert len(rows) == 50 and all(row % 2 for row in rows)
+    assert IVFIndex.train(np.zeros((5, 16), dtype=np.float32)).search(np.zeros((5, 16)), np.ones(16), 3, 1)[0][0].size == 0
+
+
+def test_assign_moves_changed_rows_between_buckets():
+    vectors = unit_rows(200)
+    index = IVFIndex.train(vectors, nlist=8)
+    vectors[0] = vectors[150]
+    grown = np.vstack([vectors, vectors[150:151]])
+    index.assign([0, 200], grown[[0, 200]])
+    [(rows, _)] = index.search(grown, grown[150], k=3, nprobe=1)
+    assert set(rows.tolist()) == {0, 150, 200}
@@ -0,0 +1,91 @@
+import numpy as np
+import cache
+from cache import CachedStore, LRUCache
+from numpy_store import NumpyStore
+from store import EMBEDDING_DIM
+
+
+class CountingStore(NumpyStore):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def get_similar_users_bulk(self, user_ids, limit, search_params=None):
+        self.calls += 1
+        return super().get_similar_users_bulk(user_ids, limit, search_params)
+
+
+def make_cached_store():
+    backend = CountingStore()
+    rng = np.random.default_rng(0)
+    backend.add_images([(f"./img{i}.jpg", rng.standard_normal(EMBEDDING_DIM).astype(np.float32)) for i in range(10)])
+    backend.initialize_users(["a", "b", "c"])
+    for user_id, image_id in ((1, 1), (2, 2), (3, 3)):
+        backend.add_user_favorite(user_id, image_id)
+    return CachedStore(backend), backend
+
+
+def test_lru_evicts_the_least_recently_used_entry():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None and cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2, "maxsize": 2}
+
+
+def test_similarity_is_cached_until_a_favorite_changes():
+    store, backend = make_cached_store()
+    first = store.get_similar_users(1, 2)
+    assert store.get_similar_users(1, 2) == first
+    assert backend.calls == 1
+
+    store.add_user_favorite(2, 1)
+    changed = store.get_similar_users(1, 2)
+    assert backend.calls == 2
+    assert changed == backend.get_similar_users_bulk([1], 2)[1]
+
+
+def test_favorites_are_invalidated_per_user():
+    store, _ = make_cached_store()
+    assert store.get_user_favorites(1) == [{"id": 1, "url": "./img0.jpg"}]
+    store.get_user_favorites(2)
+    store.mutate_favorites(1, add_urls=["./img4.jpg"])
+    assert [image["id"] for image in store.get_user_favorites(1)] == [1, 5]
+    # The mutation stored the new favorites and left user 2's entry alone
+    assert store.favorites.stats()["misses"] == 2
+
+
+def test_search_params_bypass_the_cache():
+    store, backend = make_cached_store()
+    store.get_similar_users_bulk([1], 2, {"exact": True})
+    store.get_similar_users_bulk([1], 2, {"exact": True})
+    assert backend.calls == 2
+    assert store.similarity.stats()["size"] == 0
+
+
+def test_user_cards_batch_every_miss_into_one_call():
+    store, backend = make_cached_store()
+    store.get_similar_users(1, 3)
+    cards = store.get_user_cards([1, 2, 3], 3)
+    assert backend.calls == 2
+    assert cards[2]["favorites"] == [{"id": 2, "url": "./img1.jpg"}]
+    assert store.get_user_cards([1, 2, 3], 3) == cards
+    assert backend.calls == 2
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    store, backend = make_cached_store()
+    store.get_similar_users(1, 2)
+    now[0] += 4
+    store.get_similar_users(1, 2)
+    assert backend.calls == 1
+
+    # A write made by another process only shows once the entry has expired
+    backend.add_user_favorite(2, 1)
+    now[0] += 1
+    assert store.get_similar_users(1, 2) == backend.get_similar_users_bulk([1], 2)[1]
+    assert backend.calls == 3
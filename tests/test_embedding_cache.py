@@ -0,0 +1,51 @@
+import numpy as np
+from embedding_cache import EmbeddingCache
+
+DIM = 4
+
+
+def vectors(*values):
+    return [np.full(DIM, value, dtype=np.float32) for value in values]
+
+
+def test_put_many_and_get(tmp_path):
+    cache = EmbeddingCache(tmp_path, "model", dim=DIM)
+    cache.put_many(["a", "b"], vectors(1, 2))
+    assert len(cache) == 2
+    assert np.array_equal(cache.get("b"), vectors(2)[0])
+    assert cache.get("missing") is None
+
+
+def test_duplicate_digests_in_one_batch_keep_rows_aligned(tmp_path):
+    cache = EmbeddingCache(tmp_path, "model", dim=DIM)
+    cache.put_many(["dup", "dup"], vectors(1, 1))
+    cache.put_many(["x"], vectors(2))
+    assert len(cache) == 2
+    assert np.array_equal(cache.get("dup"), vectors(1)[0])
+    assert np.array_equal(cache.get("x"), vectors(2)[0])
+
+
+def test_reopen_drops_unsaved_rows(tmp_path):
+    cache = EmbeddingCache(tmp_path, "model", dim=DIM)
+    cache.put_many(["a"], vectors(1))
+    cache.mark_written(["a.jpg"], ["a"])
+    cache.save()
+    cache.put_many(["b"], vectors(2))
+
+    reopened = EmbeddingCache(tmp_path, "model", dim=DIM)
+    assert len(reopened) == 1 and "b" not in reopened
+    assert reopened.is_written("a.jpg", "a")
+    reopened.put_many(["c"], vectors(3))
+    assert np.array_equal(reopened.get("c"), vectors(3)[0])
+
+
+def test_read_only_cache_leaves_the_writers_unsaved_rows(tmp_path):
+    cache = EmbeddingCache(tmp_path, "model", dim=DIM)
+    cache.put_many(["a"], vectors(1))
+    cache.save()
+    cache.put_many(["b"], vectors(2))
+
+    reader = EmbeddingCache(tmp_path, "model", dim=DIM, read_only=True)
+    assert np.array_equal(reader.get("a"), vectors(1)[0])
+    assert reader.get("b") is None
+    assert np.array_equal(cache.get("b"), vectors(2)[0])
@@ -0,0 +1,114 @@
+import os
+import queue
+import time
+from ingest_watch import Checkpoint, FolderWatcher
+
+
+def write_image(path, age=10):
+    """Write a file and backdate it, its directory and the directories created for it."""
+    created = [parent for parent in path.parents if not parent.exists()]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"image")
+    backdate(path, path.parent, *created, age=age)
+
+
+def backdate(*paths, age=10):
+    old = time.time() - age
+    for path in paths:
+        os.utime(path, (old, old))
+
+
+def drain(work_queue):
+    items = []
+    while not work_queue.empty():
+        items.append(work_queue.get_nowait()[0])
+    return sorted(items)
+
+
+def make_watcher(tmp_path, **kwargs):
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    return FolderWatcher(str(tmp_path / "images"), checkpoint, queue.Queue(), **kwargs)
+
+
+def test_scan_queues_new_files_once(tmp_path):
+    write_image(tmp_path / "images" / "a" / "1.jpg")
+    write_image(tmp_path / "images" / "b" / "2.png")
+    watcher = make_watcher(tmp_path)
+    watcher.scan_once()
+    assert drain(watcher.queue) == [str(tmp_path / "images" / "a" / "1.jpg"), str(tmp_path / "images" / "b" / "2.png")]
+    watcher.scan_once()
+    assert drain(watcher.queue) == []
+
+
+def test_unchanged_directories_are_not_listed(tmp_path, monkeypatch):
+    write_image(tmp_path / "images" / "a" / "1.jpg")
+    write_image(tmp_path / "images" / "b" / "2.jpg")
+    backdate(tmp_path / "images")
+    watcher = make_watcher(tmp_path)
+    watcher.scan_once()
+    drain(watcher.queue)
+
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: listed.append(path) or scandir(path))
+    watcher.scan_once()
+    assert listed == []
+
+    write_image(tmp_path / "images" / "b" / "3.jpg", age=5)
+    watcher.scan_once()
+    assert listed == [str(tmp_path / "images" / "b")]
+    assert drain(watcher.queue) == [str(tmp_path / "images" / "b" / "3.jpg")]
+
+
+def test_unsettled_files_are_rechecked(tmp_path):
+    path = tmp_path / "images" / "1.jpg"
+    write_image(path, age=0)
+    watcher = make_watcher(tmp_path, settle_time=60)
+    watcher.scan_once()
+    assert drain(watcher.queue) == []
+    write_image(path, age=120)
+    watcher.scan_once()
+    assert drain(watcher.queue) == [str(path)]
+
+
+def test_full_rescan_catches_files_rewritten_in_place(tmp_path):
+    path = tmp_path / "images" / "1.jpg"
+    write_image(path)
+    watcher = make_watcher(tmp_path, rescan_interval=0)
+    watcher.scan_once()
+    watcher.committed([(str(path), watcher.queue.get_nowait()[1])])
+    directory_mtime = os.stat(path.parent).st_mtime_ns
+    with open(path, "ab") as f:
+        f.write(b"more")
+    old = time.time() - 5
+    os.utime(path, (old, old))
+    os.utime(path.parent, ns=(directory_mtime, directory_mtime))
+    watcher.scan_once()
+    assert drain(watcher.queue) == [str(path)]
+
+
+def test_checkpoint_appends_batches_and_replays_them(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = Checkpoint(path)
+    checkpoint.add([("a.jpg", [1, 2])])
+    checkpoint.add([("b.jpg", [3, 4]), ("a.jpg", [5, 6])])
+    assert not os.path.exists(path)
+    with open(checkpoint.log_path, "a") as f:
+        f.write('["torn.jpg", [7')  # a crash mid-append
+    reopened = Checkpoint(path)
+    assert reopened.files == {"a.jpg": [5, 6], "b.jpg": [3, 4]}
+    assert not os.path.exists(reopened.log_path)
+    assert Checkpoint(path).files == reopened.files
+
+
+def test_released_files_are_queued_again(tmp_path):
+    path = tmp_path / "images" / "1.jpg"
+    write_image(path)
+    watcher = make_watcher(tmp_path)
+    watcher.scan_once()
+    batch = [watcher.queue.get_nowait()]
+    watcher.scan_once()
+    assert drain(watcher.queue) == []
+    watcher.release(batch)
+    watcher.scan_once()
+    assert drain(watcher.queue) == [str(path)]
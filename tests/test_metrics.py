@@ -0,0 +1,27 @@
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+import metrics
+
+
+def test_label_values_are_escaped():
+    assert metrics._format_labels([("path", 'a\\b"c\nd')]) == '{path="a\\\\b\\"c\\nd"}'
+
+
+def test_unmatched_routes_share_one_series():
+    app = Starlette(
+        routes=[Route("/users/{user_id}", lambda request: PlainTextResponse("ok"))],
+        middleware=[Middleware(metrics.MetricsMiddleware)],
+    )
+    with TestClient(app) as client:
+        client.get("/users/1")
+        client.get("/users/2")
+        client.get("/probe-one")
+        client.get("/probe-two/x")
+    routes = {
+        dict(labels)["route"] for name, labels in metrics._histograms if name == "http_request_duration_seconds"
+    }
+    assert {"/users", "other"} <= routes
+    assert not {"/probe-one", "/probe-two"} & routes
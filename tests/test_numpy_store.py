@@ -0,0 +1,218 @@
+import os
+import numpy as np
+import pytest
+import numpy_store
+from numpy_store import NumpyStore
+from store import EMBEDDING_DIM
+
+
+def make_store(path=None, num_images=30, usernames=("a", "b", "c"), seed=0, **kwargs):
+    rng = np.random.default_rng(seed)
+    store = NumpyStore(None if path is None else str(path), **kwargs)
+    store.add_images([(f"./img{i}.jpg", rng.standard_normal(EMBEDDING_DIM).astype(np.float32)) for i in range(num_images)])
+    store.initialize_users(list(usernames))
+    return store
+
+
+def test_favorite_changes_are_logged_instead_of_rewriting_the_npz(tmp_path):
+    path = tmp_path / "s.npz"
+    store = make_store(path)
+    store.flush()
+    saved = os.stat(path).st_mtime_ns
+
+    store.mutate_favorites(1, add_urls=["./img0.jpg", "./img1.jpg"])
+    store.mutate_favorites(1, remove_image_ids=[1])
+    store.add_user_favorite(2, 5)
+    store.flush()
+    assert os.stat(path).st_mtime_ns == saved
+    assert os.path.exists(f"{path}.favorites.log")
+
+    reloaded = NumpyStore(str(path))
+    assert reloaded.get_user_favorites(1) == store.get_user_favorites(1)
+    assert reloaded._user_versions == store._user_versions
+    assert reloaded.get_similar_users(1, 2) == store.get_similar_users(1, 2)
+
+
+def test_full_save_absorbs_the_favorites_log(tmp_path, monkeypatch):
+    path = tmp_path / "s.npz"
+    store = make_store(path)
+    store.add_user_favorite(1, 1)
+    store.flush()
+    store.add_images([("./new.jpg", np.ones(EMBEDDING_DIM, dtype=np.float32))])
+    store.flush()
+    assert not os.path.exists(f"{path}.favorites.log")
+    assert NumpyStore(str(path)).get_user_favorites(1) == [{"id": 1, "url": "./img0.jpg"}]
+
+    monkeypatch.setattr(numpy_store, "FAVORITE_LOG_COMPACT", 2)
+    for image_id in (2, 3, 4):
+        store.add_user_favorite(1, image_id)
+    store.flush()
+    assert not os.path.exists(f"{path}.favorites.log")
+
+
+def test_torn_log_line_is_ignored(tmp_path):
+    path = tmp_path / "s.npz"
+    store = make_store(path)
+    store.flush()
+    store.add_user_favorite(1, 1)
+    store.flush()
+    with open(f"{path}.favorites.log", "a") as f:
+        f.write("+ 1 2")
+    assert [image["id"] for image in NumpyStore(str(path)).get_user_favorites(1)] == [1]
+
+
+def rounded(similar):
+    return [(user_id, round(score, 5)) for user_id, _, score in similar]
+
+
+def brute_force_similar(store, user_id, limit):
+    units = store._user_units.rows
+    row = store._user_rows[user_id]
+    ranked = [
+        (store._user_ids[other], None, float(units[other] @ units[row]))
+        for other in range(len(units)) if other != row and store._user_counts[other]
+    ]
+    return sorted(ranked, key=lambda result: -result[2])[:limit]
+
+
+def favorite_everyone(store, per_user=3, seed=1):
+    rng = np.random.default_rng(seed)
+    for user_id in store._user_ids:
+        for image_id in rng.choice(store._image_ids, per_user, replace=False):
+            store.add_user_favorite(user_id, int(image_id))
+
+
+def test_user_embedding_is_the_mean_of_favorites():
+    store = make_store()
+    store.add_user_favorite(1, 1)
+    store.add_user_favorite(1, 2)
+    store.delete_user_favorite(1, 1)
+    assert np.allclose(store._user_units.rows[0] * store._user_norms[0], store._images.rows[1], atol=1e-5)
+    assert not store.add_user_favorite(1, 2)
+    assert not store.delete_user_favorite(1, 1)
+
+
+def test_similar_users_match_a_brute_force_scan():
+    store = make_store(usernames=[f"user{i}" for i in range(20)])
+    favorite_everyone(store)
+    store.initialize_users(["no-favorites"])
+    for user_id in (1, 7):
+        similar = store.get_similar_users(user_id, 5)
+        assert rounded(similar) == rounded(brute_force_similar(store, user_id, 5))
+        assert rounded(store.get_similar_users_bulk([user_id], 5)[user_id]) == rounded(similar)
+    assert store.get_similar_users(21, 5) == []
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8", "binary"])
+def test_quantized_scan_rescores_in_full_precision(quantization):
+    store = make_store(usernames=[f"user{i}" for i in range(20)], quantization=quantization, rescore_factor=20)
+    favorite_everyone(store)
+    # A shortlist covering every user makes the rescored result exact
+    assert rounded(store.get_similar_users(3, 5)) == rounded(store.get_similar_users(3, 5, {"exact": True}))
+
+
+def test_ivf_with_every_bucket_probed_is_exact():
+    store = make_store(num_images=200, usernames=[f"user{i}" for i in range(50)], ann="ivf", nlist=8)
+    favorite_everyone(store)
+    query = store._images.rows[0]
+    assert store.search_images(query, 5, {"nprobe": 8}) == store.search_images(query, 5, {"exact": True})
+    assert store.search_images(query, 1)[0]["url"] == "./img0.jpg"
+    exact = store.get_similar_users_bulk([1, 2], 4, {"exact": True})
+    probed = store.get_similar_users_bulk([1, 2], 4, {"nprobe": 8})
+    assert all(rounded(probed[user_id]) == rounded(exact[user_id]) for user_id in (1, 2))
+
+
+def test_mutate_favorites_respects_the_limit():
+    store = make_store()
+    result = store.mutate_favorites(1, add_urls=["./img0.jpg", "./missing.jpg", "./img1.jpg", "./img2.jpg"], max_favorites=2)
+    assert result["added"] == [1, 2]
+    result = store.mutate_favorites(1, add_urls=["./img2.jpg"], remove_image_ids=[1], max_favorites=2)
+    assert (result["added"], result["removed"]) == ([3], [1])
+    assert [image["id"] for image in result["favorites"]] == [2, 3]
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = tmp_path / "s.npz"
+    store = make_store(path, usernames=["a", "b"])
+    store.initialize_users(["a"], ["Alice"])
+    favorite_everyone(store)
+    store.rebuild_image_neighbors(3)
+    store.flush()
+
+    loaded = NumpyStore(str(path))
+    assert loaded.list_users() == [(1, "a", "Alice"), (2, "b", None)]
+    assert loaded.get_user_favorites(2) == store.get_user_favorites(2)
+    assert loaded.get_image_neighbors("./img0.jpg", 3) == store.get_image_neighbors("./img0.jpg", 3)
+    assert loaded._user_versions == store._user_versions
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8", "binary"])
+def test_quantized_store_keeps_only_codes_resident(tmp_path, quantization):
+    path = tmp_path / "s.npz"
+    store = make_store(path, num_images=50, usernames=[f"user{i}" for i in range(20)], quantization=quantization, rescore_factor=50)
+    favorite_everyone(store)
+    query = store._images.rows[3]
+    assert store.search_images(query, 5) == store.search_images(query, 5, {"exact": True})
+    usage = store.memory_usage()
+    # Images, their unit vectors and the user vectors are all mapped from files next to the store
+    assert usage["mapped"] == (50 + 50 + 20) * EMBEDDING_DIM * 4
+    assert usage["resident"] < usage["mapped"] / 3
+
+    store.flush()
+    loaded = NumpyStore(str(path), quantization=quantization, rescore_factor=50)
+    assert loaded.search_images(query, 5) == store.search_images(query, 5)
+    assert rounded(loaded.get_similar_users(4, 3)) == rounded(store.get_similar_users(4, 3))
+
+
+def unfavorited(store, user_id):
+    return next(image_id for image_id in store._image_ids if image_id not in store._favorites[user_id])
+
+
+def test_recommendations_survive_a_reload_until_favorites_change(tmp_path):
+    path = tmp_path / "s.npz"
+    store = make_store(path)
+    favorite_everyone(store)
+    assert store.refresh_recommendations(5, 10, 2, 0.5) == 3
+    store.flush()
+
+    reloaded = NumpyStore(str(path))
+    for user_id in (1, 2, 3):
+        assert reloaded.get_recommendations(user_id, 5) == pytest.approx(store.get_recommendations(user_id, 5))
+    assert reloaded.refresh_recommendations(5, 10, 2, 0.5) == 0
+    reloaded.add_user_favorite(1, unfavorited(reloaded, 1))
+    assert reloaded.refresh_recommendations(5, 10, 2, 0.5) == 1
+
+
+def test_recommendation_for_a_user_changed_mid_refresh_is_dropped(monkeypatch):
+    store = make_store()
+    favorite_everyone(store)
+    nearest_images = store._nearest_images
+    image_id = unfavorited(store, 1)
+
+    def change_favorites_meanwhile(embedding, limit):
+        if image_id not in store._favorites[1]:
+            store.add_user_favorite(1, image_id)
+        return nearest_images(embedding, limit)
+
+    monkeypatch.setattr(store, "_nearest_images", change_favorites_meanwhile)
+    store.refresh_recommendations(5, 10, 2, 0.5)
+    assert store.get_recommendations(1, 5) == []
+    assert store.get_recommendations(2, 5)
+
+
+@pytest.mark.skipif(numpy_store.fcntl is None, reason="writers are only checked where flock exists")
+def test_second_writer_process_is_refused(tmp_path):
+    written = tmp_path / "written.npz"
+    make_store(written).flush()
+    path = tmp_path / "s.npz"
+    os.replace(written, path)
+    # Another open file description on the lock file stands in for another process
+    with open(f"{path}.lock", "a+") as other:
+        numpy_store.fcntl.flock(other, numpy_store.fcntl.LOCK_EX | numpy_store.fcntl.LOCK_NB)
+        other.write("4242")
+        other.flush()
+        store = NumpyStore(str(path))
+        assert store.get_user_favorites(1) == []
+        with pytest.raises(RuntimeError, match="pid 4242"):
+            store.add_user_favorite(1, 1)
+        assert store.get_user_favorites(1) == []
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from quantize import QUANTIZATIONS, approximate_scores, code_shape, quantize
+
+
+def unit_rows(count, dim=64, seed=0):
+    rows = np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("kind", QUANTIZATIONS)
+def test_codes_have_the_declared_shape(kind):
+    codes, scales = quantize(unit_rows(10), kind)
+    dtype, width = code_shape(kind, 64)
+    assert codes.dtype == dtype and codes.shape == (10, width)
+    assert (scales is not None) == (kind == "int8")
+
+
+@pytest.mark.parametrize("kind, tolerance", [("float32", 1e-6), ("float16", 1e-2), ("int8", 5e-2)])
+def test_scores_approximate_the_dot_product(kind, tolerance):
+    rows, queries = unit_rows(100), unit_rows(3, seed=1)
+    codes, scales = quantize(rows, kind)
+    assert np.allclose(approximate_scores(codes, scales, queries, kind), queries @ rows.T, atol=tolerance)
+
+
+def test_binary_scores_are_negative_hamming_distances():
+    rows = np.array([[1, 1, -1, -1], [-1, -1, 1, 1], [1, -1, -1, -1]], dtype=np.float32)
+    codes, scales = quantize(rows, "binary")
+    assert approximate_scores(codes, scales, rows[0], "binary").tolist() == [[0, -4, -1]]
+
+
+def test_int8_keeps_zero_rows_zero():
+    codes, scales = quantize(np.zeros((2, 8)), "int8")
+    assert not codes.any() and not scales.any()
+
+
+def test_unknown_kind_is_rejected():
+    with pytest.raises(ValueError):
+        code_shape("int4", 64)
@@ -0,0 +1,60 @@
+import asyncio
+import similarity_feed
+from similarity_feed import SimilarityFeed
+
+
+class FakeStore:
+    """Similar users straight from a symmetric table of pairwise similarities."""
+
+    def __init__(self, similarities):
+        self.similarities = {}
+        for pair, similarity in similarities.items():
+            self.set(*pair, similarity)
+        self.calls = []
+
+    def set(self, a, b, similarity):
+        self.similarities.setdefault(a, {})[b] = similarity
+        self.similarities.setdefault(b, {})[a] = similarity
+
+    def get_similar_users_bulk(self, user_ids, limit):
+        self.calls.append((sorted(user_ids), limit))
+        results = {}
+        for user_id in user_ids:
+            ranked = sorted(self.similarities[user_id].items(), key=lambda item: -item[1])[:limit]
+            results[user_id] = [(other_id, f"user{other_id}", similarity) for other_id, similarity in ranked]
+        return results
+
+
+def changes_after(monkeypatch, store, mutate, watched, fanout):
+    """Watch `watched` with top-1 lists, apply the similarity changes in `mutate`, and recompute."""
+    monkeypatch.setattr(similarity_feed, "get_store", lambda: store)
+
+    async def run():
+        feed = SimilarityFeed(limit=1, fanout=fanout)
+        await feed.subscribe(watched)
+        store.calls.clear()
+        for pair, similarity in mutate.items():
+            store.set(*pair, similarity)
+        changed, _ = await feed._changes({a for a, _ in mutate})
+        return changed
+
+    return asyncio.run(run())
+
+
+# Users 1, 2 and 4 are close; 3 is far from everyone and its top-1 is 1 at 0.1
+SIMILARITIES = {(1, 2): 0.9, (1, 3): 0.1, (2, 3): 0.05, (1, 4): 0.8, (2, 4): 0.7, (3, 4): 0.0}
+
+
+def test_mutated_user_entering_a_list_outside_its_fanout(monkeypatch):
+    store = FakeStore(SIMILARITIES)
+    # 2 moves towards 3 but stays closer to 1, so 3 is not its nearest neighbour
+    changed = changes_after(monkeypatch, store, {(2, 3): 0.5}, watched=[3], fanout=1)
+    assert [other_id for other_id, _, _ in changed[3]] == [2]
+
+
+def test_lists_the_bound_rules_out_are_not_recomputed(monkeypatch):
+    # 3 lists 4 at 0.85, more than anyone past 1's two nearest neighbours can score with 1
+    store = FakeStore({**SIMILARITIES, (3, 4): 0.85})
+    changed = changes_after(monkeypatch, store, {(1, 2): 0.95}, watched=[3], fanout=2)
+    assert changed == {}
+    assert store.calls == [([1], 2)]
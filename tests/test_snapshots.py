@@ -0,0 +1,92 @@
+import os
+import numpy as np
+from numpy_store import NumpyStore
+from snapshots import export_snapshot, open_snapshot, read_manifest
+from store import EMBEDDING_DIM
+
+
+def make_store(path, num_images=20, seed=0):
+    rng = np.random.default_rng(seed)
+    store = NumpyStore(str(path))
+    store.add_images([(f"./img{i}.jpg", rng.standard_normal(EMBEDDING_DIM).astype(np.float32)) for i in range(num_images)])
+    store.initialize_users(["a", "b"])
+    store.add_user_favorite(1, 1)
+    store.add_user_favorite(2, 2)
+    return store
+
+
+def test_incremental_export_appends(tmp_path):
+    store = make_store(tmp_path / "s.npz")
+    directory = str(tmp_path / "snap")
+    assert export_snapshot(store, directory) == {"images": 20, "users": 2, "full": True}
+    assert export_snapshot(store, directory) == {"images": 0, "users": 0, "full": False}
+
+    store.add_images([("./new.jpg", np.ones(EMBEDDING_DIM, dtype=np.float32))])
+    store.add_user_favorite(1, 3)
+    assert export_snapshot(store, directory) == {"images": 1, "users": 1, "full": False}
+    snapshot = open_snapshot(directory)
+    assert snapshot.images.shape == (21, EMBEDDING_DIM)
+    assert np.array_equal(snapshot.images, store._images.rows)
+    assert snapshot.image_urls[-1] == "./new.jpg"
+    ids, rows = snapshot.latest_user_rows()
+    assert np.allclose(snapshot.users[rows[ids == 1][0]], (store._images.rows[0] + store._images.rows[2]) / 2, atol=1e-5)
+
+
+def test_reingested_image_writes_a_new_generation(tmp_path):
+    store = make_store(tmp_path / "s.npz")
+    directory = str(tmp_path / "snap")
+    export_snapshot(store, directory)
+    old = open_snapshot(directory)
+
+    store.add_images([("./img0.jpg", np.ones(EMBEDDING_DIM, dtype=np.float32))])
+    assert export_snapshot(store, directory)["full"]
+    assert read_manifest(directory)["generation"] == 2
+    assert np.array_equal(open_snapshot(directory).images[0], np.ones(EMBEDDING_DIM))
+    # Readers of the previous generation keep their mapping
+    assert not os.path.exists(old.directory)
+    assert np.array_equal(old.images[1], store._images.rows[1])
+
+
+def test_warm_start_refuses_a_stale_snapshot(tmp_path):
+    path = tmp_path / "s.npz"
+    store = make_store(path)
+    directory = str(tmp_path / "snap")
+    export_snapshot(store, directory)
+    store.flush()
+
+    warm = NumpyStore(str(path), snapshot=directory)
+    assert isinstance(warm._images.rows, np.memmap)
+    assert warm.search_images(np.ones(EMBEDDING_DIM), 3) == store.search_images(np.ones(EMBEDDING_DIM), 3)
+    # Searches read the exported unit rows instead of building a normalised copy
+    assert isinstance(warm._units.rows, np.memmap)
+
+    store.add_images([("./img0.jpg", np.ones(EMBEDDING_DIM, dtype=np.float32))])
+    store.flush()
+    cold = NumpyStore(str(path), snapshot=directory)
+    assert not isinstance(cold._images.rows, np.memmap)
+    assert np.array_equal(cold._images.rows[0], np.ones(EMBEDDING_DIM))
+
+
+def test_interrupted_append_is_cut_back(tmp_path):
+    store = make_store(tmp_path / "s.npz")
+    directory = str(tmp_path / "snap")
+    export_snapshot(store, directory)
+    images_path = os.path.join(open_snapshot(directory).directory, "images.f32")
+    with open(images_path, "ab") as f:
+        f.write(b"partial row")
+    assert open_snapshot(directory).images.shape == (20, EMBEDDING_DIM)
+    export_snapshot(store, directory)
+    assert os.path.getsize(images_path) == 20 * EMBEDDING_DIM * 4
+
+
+def test_generation_without_unit_rows_is_rewritten(tmp_path):
+    store = make_store(tmp_path / "s.npz")
+    directory = str(tmp_path / "snap")
+    export_snapshot(store, directory)
+    os.remove(os.path.join(open_snapshot(directory).directory, "images.units.f32"))
+    assert open_snapshot(directory).image_units is None
+
+    store.add_images([("./new.jpg", np.ones(EMBEDDING_DIM, dtype=np.float32))])
+    assert export_snapshot(store, directory)["full"]
+    units = open_snapshot(directory).image_units
+    assert np.allclose(np.linalg.norm(units, axis=1), 1, atol=1e-5)
@@ -0,0 +1,11 @@
+import pytest
+from store import VectorStore
+
+
+def test_incomplete_backend_fails_when_created():
+    class PartialStore(VectorStore):
+        def list_users(self):
+            return []
+
+    with pytest.raises(TypeError, match="abstract"):
+        PartialStore()
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from PIL import Image, ImageOps
+from starlette.responses import FileResponse, Response
+from starlette.routing import Route
+
+IMAGE_DIR = Path("static/images")
+THUMBNAIL_DIR = Path(os.environ.get("THUMBNAIL_DIR", "data/thumbnails"))
+# Square sizes the page renders: 100px category tiles and 80px user favorites
+THUMBNAIL_SIZES = (100, 80)
+CACHE_CONTROL = "public, max-age=86400"
+
+
+def thumbnail_path(relative_path, size):
+    """Where the thumbnail of static/images/<relative_path> is stored.
+
+    Thumbnails are always JPEG, so other images get a .jpg appended (x.png ->
+    x.png.jpg) and are served as image/jpeg.
+    """
+    path = THUMBNAIL_DIR / str(size) / relative_path
+    return path if path.suffix.lower() in (".jpg", ".jpeg") else path.with_name(f"{path.name}.jpg")
+
+
+def thumbnail_url(image_url, size):
+    """Thumbnail route for an image url such as ./static/images/corgi/image_1.jpg."""
+    relative_path = image_url.split("static/images/", 1)[-1]
+    return f"/thumbs/{size}/{relative_path}"
+
+
+def ensure_thumbnail(relative_path, size):
+    """Create the thumbnail if it is missing or older than the original, and return its path."""
+    source = IMAGE_DIR / relative_path
+    target = thumbnail_path(relative_path, size)
+    if target.exists() and target.stat().st_mtime_ns >= source.stat().st_mtime_ns:
+        return target
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with Image.open(source) as image:
+        # Let the JPEG decoder downscale while decoding instead of decoding full resolution
+        image.draft("RGB", (2 * size, 2 * size))
+        thumbnail = ImageOps.fit(image.convert("RGB"), (size, size), Image.LANCZOS)
+    # A unique temporary name, so concurrent requests for the same thumbnail never share a file
+    with tempfile.NamedTemporaryFile(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp", delete=False) as tmp:
+        try:
+            thumbnail.save(tmp, "JPEG", quality=85, optimize=True)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+    # NamedTemporaryFile creates the file readable by its owner only
+    os.chmod(tmp.name, 0o644)
+    os.replace(tmp.name, target)
+    return target
+
+
+def generate_thumbnails(folder_path=IMAGE_DIR, num_workers=None):
+    """Create missing or stale thumbnails for every image under folder_path, at every size."""
+    folder_path = Path(folder_path)
+    jobs = [
+        (str(path.relative_to(IMAGE_DIR)), size)
+        for path in sorted(folder_path.rglob("*"))
+        if path.suffix.lower() in (".png", ".jpg", ".jpeg", ".gif")
+        for size in THUMBNAIL_SIZES
+    ]
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        list(pool.map(lambda job: ensure_thumbnail(*job), jobs))
+    print(f"Thumbnails up to date for {len(jobs) // len(THUMBNAIL_SIZES)} images")
+
+
+@lru_cache(maxsize=4096)
+def _content_etag(path, mtime_ns, size):
+    # Keyed on mtime and size so a changed file is rehashed
+    with open(path, "rb") as f:
+        return '"' + hashlib.blake2b(f.read(), digest_size=16).hexdigest() + '"'
+
+
+def cached_file_response(req, path):
+    """Serve a file with a strong content ETag, answering a matching If-None-Match with 304."""
+    stat = os.stat(path)
+    etag = _content_etag(str(path), stat.st_mtime_ns, stat.st_size)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag in [tag.strip() for tag in req.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers, stat_result=stat)
+
+
+def safe_relative_path(category, filename):
+    """category/filename if it stays inside the image directory, else None."""
+    relative_path = Path(category) / filename
+    resolved = (IMAGE_DIR / relative_path).resolve()
+    if not resolved.is_relative_to(IMAGE_DIR.resolve()) or not resolved.is_file():
+        return None
+    return relative_path
+
+
+def serve_image(req):
+    """Original image, used by the modal view."""
+    relative_path = safe_relative_path(req.path_params["category"], req.path_params["filename"])
+    if relative_path is None:
+        return Response(status_code=404)
+    return cached_file_response(req, IMAGE_DIR / relative_path)
+
+
+def serve_thumbnail(req):
+    relative_path = safe_relative_path(req.path_params["category"], req.path_params["filename"])
+    if req.path_params["size"] not in THUMBNAIL_SIZES or relative_path is None:
+        return Response(status_code=404)
+    # Thumbnails are normally made at ingest time; this covers images added since
+    return cached_file_response(req, ensure_thumbnail(relative_path, req.path_params["size"]))
+
+
+image_routes = [
+    Route("/static/images/{category}/{filename}", serve_image),
+    Route("/thumbs/{size:int}/{category}/{filename}", serve_thumbnail),
+]
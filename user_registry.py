@@ -0,0 +1,71 @@
+import threading
+import time
+
+
+def user_color(user_id):
+    """A stable color per user: hues step by the golden angle, so neighbouring ids never look alike."""
+    return f"hsl({user_id * 137.508 % 360:.1f}, 85%, 60%)"
+
+
+class UserRegistry:
+    """In-memory id-to-name index of every user, paged in id order.
+
+    Loaded from `load()` (the store's list_users) at startup. A background
+    thread reloads it every `poll_interval` seconds so users created by other
+    processes appear; refresh() forces a reload.
+    """
+
+    def __init__(self, load, poll_interval=60.0):
+        self._load = load
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._ids = []
+        self._names = {}  # user id -> (username, display name)
+        self._watcher = None
+        self.refresh()
+
+    def refresh(self):
+        """Reload every user. Returns the number of users."""
+        users = self._load()
+        names = {user_id: (username, display_name or username) for user_id, username, display_name in users}
+        with self._lock:
+            self._ids = [user_id for user_id, _, _ in users]
+            self._names = names
+        return len(users)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, user_id):
+        return user_id in self._names
+
+    def username(self, user_id):
+        return self._names[user_id][0]
+
+    def name(self, user_id):
+        """Display name, falling back to the username."""
+        return self._names[user_id][1]
+
+    def page_count(self, size):
+        return max(1, -(-len(self._ids) // size))
+
+    def page(self, page, size):
+        """User ids on a 1-based page of `size` users."""
+        with self._lock:
+            return self._ids[(page - 1) * size:page * size]
+
+    def start_watcher(self):
+        """Reload in a daemon thread every poll_interval seconds; a no-op when poll_interval is 0."""
+        if self.poll_interval <= 0 or self._watcher is not None:
+            return
+
+        def watch():
+            while True:
+                time.sleep(self.poll_interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"User registry refresh failed: {e}")
+
+        self._watcher = threading.Thread(target=watch, name="user-registry-watcher", daemon=True)
+        self._watcher.start()